@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Measure how offline decoding of a capture scales with worker processes
+
+A capture of random frames is written first (or --capture is used), then
+decoded by the serial capture viewer and by decode with each number of
+workers given.  Reported are wall time, capture MB per second, CPU seconds
+and the peak resident memory of any process involved, which should stay
+flat as the capture grows.
+
+    PYTHONPATH=src python3 benchmarks/bench_decode.py --frames 500000 --workers 1,2,4,8
+
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def write_capture(path, frames, seed=0):
+    from ctserial.capture import CaptureWriter, DIRECTION_IN, DIRECTION_OUT, monotonic_ns
+    rng = random.Random(seed)
+    payload = bytes(rng.randrange(256) for _ in range(4096))
+    with CaptureWriter(path) as writer:
+        ports = [writer.add_interface('master'), writer.add_interface('slave')]
+        timestamp = monotonic_ns()
+        for number in range(frames):
+            start = rng.randrange(4000)
+            writer.write_frame(ports[number % 2], payload[start:start + rng.randint(4, 64)],
+                               timestamp + 1000 * number, DIRECTION_OUT if number % 2 else DIRECTION_IN)
+
+
+def timed(args):
+    """Run a command with its output discarded, return (wall s, cpu s, peak rss MB)."""
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable] + args, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    if status:
+        sys.exit('failed: {}'.format(' '.join(args)))
+    # the rusage of a child includes the pool workers it waited for
+    return wall, usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024.0
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    p.add_argument('--frames', type=int, default=200000, help='frames in the generated capture')
+    p.add_argument('--capture', help='decode this capture instead of a generated one')
+    p.add_argument('--workers', default='1,2,4', help='comma separated worker counts to try')
+    p.add_argument('--format', default='hexdump', choices=('hexdump', 'csv'))
+    args = p.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = args.capture
+    if path is None:
+        path = os.path.join(directory, 'bench.pcapng')
+        write_capture(path, args.frames)
+    size = os.path.getsize(path) / 1E6
+    print('{}: {:.1f} MB, {} CPUs'.format(path, size, os.cpu_count()))
+
+    cases = []
+    if args.format == 'hexdump':
+        cases.append(('capture viewer', ['-m', 'ctserial.capture', '-a', path]))
+    cases.append(('decode inline', ['-m', 'ctserial.decode', '--format', args.format, '-a', '-j', '0', path]))
+    for workers in args.workers.split(','):
+        cases.append(('decode -j {}'.format(workers),
+                      ['-m', 'ctserial.decode', '--format', args.format, '-a', '-j', workers, path]))
+
+    print('{:16s} {:>8s} {:>8s} {:>8s} {:>8s} {:>8s}'.format('case', 'wall s', 'MB/s', 'speedup', 'cpu s', 'rss MB'))
+    baseline = None
+    for name, case in cases:
+        wall, cpu, rss = timed(case)
+        baseline = baseline or wall
+        print('{:16s} {:8.2f} {:8.1f} {:8.2f} {:8.2f} {:8.1f}'.format(name, wall, size / wall, baseline / wall, cpu, rss))
+
+    if args.capture is None:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main()
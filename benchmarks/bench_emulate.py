@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Measure how fast the emulator answers as the recording grows
+
+Lookups per second are timed on response indexes of increasing size,
+with and without a masked sequence number, and should stay flat.  Then
+requests are sent over a pty in windows of back to back frames, as the
+batch sender and the fuzzer do, and requests answered per second are
+reported.
+
+    PYTHONPATH=src python3 benchmarks/bench_emulate.py --sizes 1000,100000,1000000
+
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import random
+import select
+import struct
+import time
+
+from ctserial.checksum import CRC16_MODBUS
+from ctserial.emulate import Emulator, ResponseIndex
+from ctserial.virtual import VirtualDevice
+
+
+def request(number):
+    """A Modbus RTU read of register number, with the sequence byte in front."""
+    return CRC16_MODBUS.apply(struct.pack('>BBBI', number & 0xFF, 1, 3, number))
+
+
+def build(size, mask):
+    index = ResponseIndex(mask, CRC16_MODBUS if mask else None)
+    for number in range(size):
+        index.add(request(number), CRC16_MODBUS.apply(struct.pack('>BBBBH', number & 0xFF, 1, 3, 2, number & 0xFFFF)))
+    return index
+
+
+def lookups_per_second(index, size, count=200000):
+    rng = random.Random(0)
+    requests = [request(rng.randrange(size)) for _ in range(count)]
+    start = time.perf_counter()
+    for frame in requests:
+        index.lookup(frame)
+    return count / (time.perf_counter() - start)
+
+
+def pty_rate(index, size, total, window):
+    device = VirtualDevice(Emulator(index, scale=0)).start()
+    fd = os.open(device.path, os.O_RDWR | os.O_NOCTTY)
+    rng = random.Random(1)
+    response_size = 8
+    start = time.perf_counter()
+    for _ in range(0, total, window):
+        os.write(fd, b''.join(request(rng.randrange(size)) for _ in range(window)))
+        wanted = window * response_size
+        while wanted:
+            select.select([fd], [], [], 1.0)
+            wanted -= len(os.read(fd, wanted))
+    seconds = time.perf_counter() - start
+    os.close(fd)
+    device.close()
+    return total / seconds
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    p.add_argument('--sizes', default='1000,100000', help='comma separated numbers of recorded transactions')
+    p.add_argument('--requests', type=int, default=20000, help='requests sent over the pty per run')
+    p.add_argument('--window', type=int, default=16, help='requests sent back to back before reading')
+    args = p.parse_args()
+
+    print('{:>10s} {:>6s} {:>14s} {:>14s}'.format('recorded', 'mask', 'lookups/s', 'pty req/s'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for mask in ((), (0,)):
+            index = build(size, mask)
+            print('{:10d} {:>6s} {:14.0f} {:14.0f}'.format(
+                size, 'seq' if mask else '-', lookups_per_second(index, size),
+                pty_rate(index, size, args.requests, args.window)))
+
+
+if __name__ == '__main__':
+    main()
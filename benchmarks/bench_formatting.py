@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Measure how many bytes per second each dump layout can format
+
+    PYTHONPATH=src python3 benchmarks/bench_formatting.py --size 65536
+
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import timeit
+
+from ctserial.formatting import hexdump, table_format
+
+LAYOUTS = [
+    ('sniff hex', lambda data: hexdump(data, 16, False)),
+    ('sniff hex+ascii', lambda data: hexdump(data, 16, True)),
+    ('prompt mixed', lambda data: table_format(data, 'mixed', '<-- ')),
+    ('prompt hex', lambda data: table_format(data, 'hex', '<-- ')),
+    ('prompt ascii', lambda data: table_format(data, 'ascii', '<-- ')),
+    ('prompt utf-8', lambda data: table_format(data, 'utf-8', '<-- ')),
+]
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    p.add_argument('--size', type=int, default=4096, help='bytes formatted per call')
+    p.add_argument('--repeat', type=int, default=5, help='timing runs, the best is reported')
+    args = p.parse_args()
+
+    data = os.urandom(args.size)
+    print('{:16s} {:>14s}'.format('layout', 'MB/s'))
+    for name, func in LAYOUTS:
+        timer = timeit.Timer(lambda: func(data))
+        number, _ = timer.autorange()
+        best = min(timer.repeat(args.repeat, number)) / number
+        print('{:16s} {:14.2f}'.format(name, args.size / best / 1E6))
+
+
+if __name__ == '__main__':
+    main()
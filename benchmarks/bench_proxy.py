@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Measure the forwarding latency the serial proxy adds
+
+Two pty pairs are created and the proxy bridges their slave sides in a child
+process.  Frames are written into the first master and timed until they come
+out of the second one.  The same frames are also sent through a single pty
+pair without a proxy; the latency the proxy adds is the proxied time minus
+two of those direct hops.
+
+    PYTHONPATH=src python3 benchmarks/bench_proxy.py --frames 2000
+
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import select
+import subprocess
+import sys
+import tempfile
+import time
+import tty as termios_tty
+
+clock = time.perf_counter
+
+
+def open_pty():
+    master, slave = os.openpty()
+    termios_tty.setraw(master)
+    termios_tty.setraw(slave)
+    return master, slave
+
+
+def transfer(write_fd, read_fd, payload, timeout=2.0):
+    """Write payload and return seconds until all of it was read back."""
+    start = clock()
+    os.write(write_fd, payload)
+    received = b''
+    while len(received) < len(payload):
+        if not select.select([read_fd], [], [], timeout)[0]:
+            raise RuntimeError('frame did not arrive')
+        received += os.read(read_fd, 65536)
+    return clock() - start
+
+
+def measure(write_fd, read_fd, frames, size):
+    latencies = []
+    for num in range(frames):
+        payload = bytes((num + i) & 0xFF for i in range(size))
+        latencies.append(transfer(write_fd, read_fd, payload))
+    latencies.sort()
+    return latencies
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_proxy(options, frames, size):
+    left_master, left_slave = open_pty()
+    right_master, right_slave = open_pty()
+    cmd = [sys.executable, '-m', 'ctserial.proxy', os.ttyname(left_slave), os.ttyname(right_slave)] + options
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        proc.stdout.readline()  # wait until the proxy is up
+        measure(left_master, right_master, 20, size)  # warm up
+        return measure(left_master, right_master, frames, size)
+    finally:
+        proc.terminate()
+        proc.wait()
+        for fd in (left_master, left_slave, right_master, right_slave):
+            os.close(fd)
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    p.add_argument('--frames', type=int, default=1000, help='frames to send per run')
+    p.add_argument('--size', type=int, default=8, help='frame size in bytes')
+    args = p.parse_args()
+
+    master, slave = open_pty()
+    direct = measure(master, slave, args.frames, args.size)
+    os.close(master)
+    os.close(slave)
+    hop = percentile(direct, 0.5)
+
+    workdir = tempfile.mkdtemp()
+    hook = os.path.join(workdir, 'hook.py')
+    with open(hook, 'w') as f:
+        f.write('def hook(source, frame):\n    return frame\n')
+    runs = [
+        ('direct pty hop', None),
+        ('proxy', []),
+        ('proxy + capture', ['-w', os.path.join(workdir, 'bench.pcapng')]),
+        ('proxy + hook 1ms gap', ['-k', hook, '-e', '1000']),
+    ]
+    print('{:22s} {:>10s} {:>10s} {:>10s} {:>12s}'.format('run', 'median ms', 'p99 ms', 'max ms', 'added ms'))
+    for name, options in runs:
+        latencies = direct if options is None else run_proxy(options, args.frames, args.size)
+        added = percentile(latencies, 0.5) - (hop if options is None else 2 * hop)
+        print('{:22s} {:10.3f} {:10.3f} {:10.3f} {:12.3f}'.format(
+            name, 1E3 * percentile(latencies, 0.5), 1E3 * percentile(latencies, 0.99),
+            1E3 * latencies[-1], 1E3 * added if options is not None else 0.0))
+
+
+if __name__ == '__main__':
+    main()
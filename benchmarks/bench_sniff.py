@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Compare CPU use and frame-close latency of the sniff engine with the old loop
+
+Each run opens a pty pair, starts a sniffer on the slave side in a child
+process and writes frames into the master side.  Idle CPU is measured while
+nothing is sent, frame-close latency is the time from the last byte written
+until the frame shows up on the sniffer's stdout, minus the timing delta.
+
+    PYTHONPATH=src python3 benchmarks/bench_sniff.py --ports 4
+
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import resource
+import select
+import subprocess
+import sys
+import time
+import tty as termios_tty
+
+
+def legacy_loop(ports, timing_delta):
+    """The busy-poll loop sniff.main() used before the selector engine."""
+    import serial
+    clock = time.perf_counter
+    ttys = []
+    for num, port in enumerate(ports):
+        ttys.append({'alias': 'Port' + str(num), 'buffer': b'', 'last_byte': clock(),
+                     'ser': serial.Serial(port, baudrate=9600, timeout=0)})
+    while True:
+        for tty in ttys:
+            new_data = tty['ser'].read()
+            if len(new_data) > 0:
+                tty['buffer'] += new_data
+                tty['last_byte'] = clock()
+        for tty in ttys:
+            if tty['buffer'] and (clock() - tty['last_byte']) > timing_delta:
+                sys.stdout.write('{0}\n'.format(tty['alias']))
+                sys.stdout.write(' '.join('{:02X}'.format(b) for b in tty['buffer']) + '\n')
+                sys.stdout.flush()
+                tty['buffer'] = b''
+
+
+def open_ptys(count):
+    masters, slaves = [], []
+    for _ in range(count):
+        master, slave = os.openpty()
+        termios_tty.setraw(slave)
+        masters.append(master)
+        slaves.append(os.ttyname(slave))
+        # keep the slave open so the master never sees a hangup
+        masters.append(slave)
+    return masters[::2], masters[1::2], slaves
+
+
+def start_child(engine, slaves, delta_us):
+    if engine == 'legacy':
+        cmd = [sys.executable, __file__, '--legacy-child', '--delta', str(delta_us)] + slaves
+    else:
+        cmd = [sys.executable, '-m', 'ctserial.sniff', '-e', str(delta_us)]
+        for slave in slaves:
+            cmd += ['-t', slave]
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+
+def wait_for(stream, needle, timeout=5.0):
+    data = b''
+    deadline = time.perf_counter() + timeout
+    while needle not in data:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0 or not select.select([stream], [], [], remaining)[0]:
+            raise RuntimeError('sniffer did not report frame {!r}'.format(needle))
+        data += os.read(stream.fileno(), 65536)
+    return time.perf_counter()
+
+
+def child_cpu(proc):
+    """Stop a child and return the CPU seconds it used."""
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    proc.terminate()
+    proc.wait()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+
+def run(engine, ports, delta_us, frames, idle):
+    masters, keep, slaves = open_ptys(ports)
+    proc = start_child(engine, slaves, delta_us)
+    try:
+        time.sleep(0.5)  # let the child open its ports
+        start = time.perf_counter()
+        time.sleep(idle)
+        latencies = []
+        for num in range(frames):
+            payload = bytes([0xA5, num & 0xFF, (num >> 8) & 0xFF, 0x5A])
+            os.write(masters[num % ports], payload)
+            sent = time.perf_counter()
+            closed = wait_for(proc.stdout, ' '.join('{:02X}'.format(b) for b in payload).encode())
+            latencies.append(closed - sent - delta_us / 1E6)
+        elapsed = time.perf_counter() - start
+    finally:
+        cpu = child_cpu(proc)
+        for fd in masters + keep:
+            os.close(fd)
+    latencies.sort()
+    return {
+        'engine': engine,
+        'cpu_percent': 100.0 * cpu / elapsed,
+        'latency_median_ms': 1E3 * latencies[len(latencies) // 2],
+        'latency_max_ms': 1E3 * latencies[-1],
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    p.add_argument('--ports', type=int, default=4, help='number of pty pairs to sniff')
+    p.add_argument('--delta', type=int, default=5000, help='timing delta in microseconds')
+    p.add_argument('--frames', type=int, default=50, help='frames to send per run')
+    p.add_argument('--idle', type=float, default=2.0, help='seconds of idle time per run')
+    p.add_argument('--legacy-child', action='store_true', help=argparse.SUPPRESS)
+    p.add_argument('slaves', nargs='*', help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.legacy_child:
+        legacy_loop(args.slaves, args.delta / 1E6)
+        return
+
+    print('{:8s} {:>8s} {:>14s} {:>12s}'.format('engine', 'cpu %', 'median lat ms', 'max lat ms'))
+    for engine in ('legacy', 'selector'):
+        r = run(engine, args.ports, args.delta, args.frames, args.idle)
+        print('{engine:8s} {cpu_percent:8.1f} {latency_median_ms:14.3f} {latency_max_ms:12.3f}'.format(**r))
+
+
+if __name__ == '__main__':
+    main()
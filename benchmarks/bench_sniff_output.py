@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Measure the CPU cost per frame of each sniff output format
+
+Frames of random Modbus-sized payloads are written to /dev/null exactly as
+sniff writes them to stdout: hexdump blocks flushed after every frame, or
+block buffered JSON Lines, CSV or raw records.
+
+    PYTHONPATH=src python3 benchmarks/bench_sniff_output.py --frames 100000
+
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import random
+import time
+
+from ctserial.capture import monotonic_ns
+from ctserial.sniff import RECORD_BUFFER, RecordWriter, write_hexdump
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    p.add_argument('--frames', type=int, default=100000, help='frames written per format')
+    p.add_argument('--size', type=int, default=32, help='mean payload size')
+    args = p.parse_args()
+
+    rng = random.Random(0)
+    frames = [memoryview(os.urandom(rng.randint(1, 2 * args.size))) for _ in range(args.frames)]
+    tty = {'alias': 'Port0', 'frame_start': monotonic_ns()}
+    total = sum(len(frame) for frame in frames)
+
+    print('{:16s} {:>10s} {:>10s} {:>8s}'.format('format', 'us/frame', 'MB/s', 'vs hex'))
+    baseline = None
+    cases = [('hexdump', None), ('hexdump ascii', None), ('jsonl', 'hex'), ('jsonl base64', 'base64'),
+             ('csv', 'hex'), ('raw', 'hex')]
+    for name, payload in cases:
+        start = time.process_time()
+        if payload is None:
+            with open(os.devnull, 'w') as out:
+                show_ascii = name.endswith('ascii')
+                for frame in frames:
+                    write_hexdump(out, tty, frame, 16, show_ascii)
+        else:
+            with open(os.devnull, 'wb', buffering=RECORD_BUFFER) as out:
+                records = RecordWriter(out, name.split()[0], payload)
+                for frame in frames:
+                    records.write(tty, frame)
+                records.flush()
+        seconds = time.process_time() - start
+        baseline = baseline or seconds
+        print('{:16s} {:10.2f} {:10.1f} {:8.2f}'.format(
+            name, 1E6 * seconds / len(frames), total / seconds / 1E6, seconds / baseline))
+
+
+if __name__ == '__main__':
+    main()
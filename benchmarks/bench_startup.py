@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Measure how long ctserial takes to start for headless runs and the prompt
+
+Every case is started as a fresh interpreter, repeatedly, and the median
+wall time is reported next to the time of an empty interpreter.  The
+package is byte compiled first so PYTHONDONTWRITEBYTECODE or a read-only
+tree does not turn every start into a compile.  --top lists the slowest
+imports of a headless run, from python -X importtime.
+
+    PYTHONPATH=src python3 benchmarks/bench_startup.py --runs 20 --top 15
+
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import compileall
+import json
+import os
+import subprocess
+import sys
+import time
+
+CASES = [
+    ('interpreter', ['-c', 'pass']),
+    ('import commands', ['-c', 'import ctserial.commands']),
+    ('ctserial run', ['-m', 'ctserial.cli', 'run', '-e', 'response gap 20']),
+    ('ctserial --help', ['-m', 'ctserial.cli', '--help']),
+    ('import application', ['-c', 'import ctserial.application']),
+]
+
+
+def median_time(args, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def slowest_imports(args, count):
+    """The count imports with the largest cumulative time, as (microseconds, module)."""
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split('|')
+        imports.append((int(cumulative), module.rstrip()))
+    imports.sort(reverse=True)
+    return imports[:count]
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    p.add_argument('--runs', type=int, default=15, help='starts per case')
+    p.add_argument('--top', type=int, default=0, metavar='N', help='also list the N slowest imports of ctserial run')
+    p.add_argument('--json', metavar='FILE', help='write the results as JSON to FILE')
+    args = p.parse_args()
+
+    import ctserial
+    compileall.compile_dir(os.path.dirname(ctserial.__file__), quiet=1)
+
+    results = []
+    print('{:20s} {:>10s} {:>12s}'.format('case', 'median ms', 'over python'))
+    baseline = None
+    for name, case in CASES:
+        seconds = median_time(case, args.runs)
+        baseline = seconds if baseline is None else baseline
+        results.append({'case': name, 'median_ms': 1E3 * seconds, 'over_interpreter_ms': 1E3 * (seconds - baseline)})
+        print('{:20s} {:10.1f} {:12.1f}'.format(name, 1E3 * seconds, 1E3 * (seconds - baseline)))
+
+    if args.top:
+        print('\nslowest imports of ctserial run (cumulative ms)')
+        for microseconds, module in slowest_imports(CASES[2][1], args.top):
+            print('{:10.1f}  {}'.format(microseconds / 1E3, module))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'runs': args.runs, 'python': sys.version.split()[0], 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
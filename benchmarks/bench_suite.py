@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Run the end-to-end benchmarks against virtual devices and report JSON
+
+Every benchmark talks to a ctserial.virtual device on a pty, so the whole
+path is measured: the kernel pty, pyserial, and ctserial's own loops.
+
+  sniff_throughput   a burst streamer pushes Modbus frames through sniff -f
+                     modbus; MB/s and CPU seconds sniff spends per MB
+  sniff_latency      time from the last byte of a frame written until sniff
+                     prints it, after the timing delta or with a framer
+  command_rtt        TUI commands run through Commands.execute() against
+                     an echo device and a Modbus responder in another process
+
+The results are written as JSON, to stdout or --output, with enough about
+the machine to tell runs apart.  --compare prints the change of every
+metric against an earlier result file.
+
+    PYTHONPATH=src python3 benchmarks/bench_suite.py -o before.json
+    PYTHONPATH=src python3 benchmarks/bench_suite.py --compare before.json
+
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import json
+import os
+import platform
+import select
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+from ctserial.checksum import CRC16_MODBUS
+from ctserial.virtual import Behavior, BurstStreamer, VirtualDevice
+
+clock = time.perf_counter
+
+MODBUS_READ = CRC16_MODBUS.apply(bytes.fromhex('010300000002'))
+FORMAT_VERSION = 1
+
+
+def hex_line(data):
+    return ' '.join('{:02X}'.format(b) for b in data).encode()
+
+
+def process_cpu(pid):
+    """CPU seconds a running process used so far, None where /proc is missing."""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def start_sniff(path, *options):
+    cmd = [sys.executable, '-m', 'ctserial.sniff', '-t', path] + list(options)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    time.sleep(0.5)  # let it import and open the port
+    return proc
+
+
+def stop(proc):
+    proc.terminate()
+    proc.wait()
+    proc.stdout.close()
+
+
+def count_until(stream, needle, count, timeout=30.0):
+    """Read stream until needle was seen count times, return the time it happened."""
+    seen, tail = 0, b''
+    deadline = clock() + timeout
+    while seen < count:
+        remaining = deadline - clock()
+        if remaining <= 0 or not select.select([stream], [], [], remaining)[0]:
+            raise RuntimeError('sniff reported {} of {} frames'.format(seen, count))
+        data = tail + os.read(stream.fileno(), 1 << 20)
+        seen += data.count(needle)
+        # keep what could be the start of a needle split between reads
+        cut = max(len(data) - len(needle) + 1, data.rfind(needle) + len(needle), 0)
+        tail = data[cut:]
+    return clock()
+
+
+def percentiles(values):
+    values = sorted(values)
+    return OrderedDict([
+        ('median_ms', 1E3 * values[len(values) // 2]),
+        ('p90_ms', 1E3 * values[int(len(values) * 0.9)]),
+        ('max_ms', 1E3 * values[-1]),
+    ])
+
+
+def sniff_throughput(megabytes):
+    count = int(megabytes * 1E6) // len(MODBUS_READ)
+    device = VirtualDevice(BurstStreamer(MODBUS_READ, count))
+    proc = start_sniff(device.path, '-f', 'modbus')
+    try:
+        cpu = process_cpu(proc.pid)
+        start = clock()
+        device.start()
+        done = count_until(proc.stdout, hex_line(MODBUS_READ), count)
+        cpu = process_cpu(proc.pid) - cpu if cpu is not None else None
+    finally:
+        stop(proc)
+        device.close()
+    size = count * len(MODBUS_READ) / 1E6
+    return OrderedDict([
+        ('megabytes', size),
+        ('mb_per_s', size / (done - start)),
+        ('cpu_s_per_mb', cpu / size if cpu is not None else None),
+    ])
+
+
+def sniff_latency(frames, delta_us, framer):
+    device = VirtualDevice(Behavior()).start()
+    options = ['-e', str(delta_us)] + (['-f', framer] if framer else [])
+    proc = start_sniff(device.path, *options)
+    latencies = []
+    try:
+        for num in range(frames):
+            frame = CRC16_MODBUS.apply(bytes([1, 6, 0, num & 0xFF, num >> 8 & 0xFF, 0x5A]))
+            device.send(frame)
+            sent = clock()
+            closed = count_until(proc.stdout, hex_line(frame), 1, timeout=5.0)
+            # a gap closes the frame after the delta, a framer right away
+            latencies.append(closed - sent - (0 if framer else delta_us / 1E6))
+    finally:
+        stop(proc)
+        device.close()
+    return percentiles(latencies)
+
+
+class Event(object):
+    """Just enough of a prompt_toolkit event and MyApplication for Commands."""
+    def __init__(self):
+        from ctserial.response import GapCompletion
+        from ctserial.sessions import SessionManager
+        self.app = self
+        self.sessions = SessionManager()
+        self.completion = GapCompletion()
+        self.recorder = None
+        self.recording = False
+        self.output_format = 'hex'
+        self.history = []
+
+    def post_output(self, text):
+        pass
+
+
+def start_device(*args):
+    """Run ctserial.virtual in a child process, return it and the pty path."""
+    proc = subprocess.Popen([sys.executable, '-m', 'ctserial.virtual'] + list(args),
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    return proc, proc.stdout.readline().split()[-1]
+
+
+def command_rtt(iterations):
+    import ctserial.commands as commands
+    cases = [
+        ('echo', ['echo'], 'length 4', 'sendhex 01 02 03 04'),
+        ('modbus', ['modbus'], 'framer modbus', 'sendhex 01 03 00 00 00 02 +crc16modbus'),
+    ]
+    results = OrderedDict()
+    for name, device_args, response, command in cases:
+        proc, path = start_device(*device_args)
+        saved = commands.serial_devices
+        commands.serial_devices = lambda max_age=2.0: [path]
+        cmd, event = commands.Commands(), Event()
+        try:
+            cmd.execute('connect {} 115200'.format(path), '', event)
+            cmd.execute('response ' + response, '', event)
+            timings = []
+            for _ in range(iterations):
+                start = clock()
+                output = cmd.execute(command, '', event)
+                timings.append(clock() - start)
+            if 'No response' in output:
+                raise RuntimeError('{} device did not answer: {}'.format(name, output))
+            cmd.execute('close all', '', event)
+        finally:
+            commands.serial_devices = saved
+            proc.terminate()
+            proc.wait()
+            proc.stdout.close()
+        results[name] = percentiles(timings)
+    return results
+
+
+def flatten(results, prefix=''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            for item in flatten(value, prefix + key + '.'):
+                yield item
+        else:
+            yield prefix + key, value
+
+
+def compare(old, new):
+    """Lines showing how every metric changed from old to new results."""
+    previous = dict(flatten(old['results']))
+    lines = ['{:40s} {:>12s} {:>12s} {:>8s}'.format('metric', 'before', 'after', 'change')]
+    for key, value in flatten(new['results']):
+        before = previous.get(key)
+        if value is None or before is None:
+            continue
+        change = '{:+.1f}%'.format(100.0 * (value - before) / before) if before else ''
+        lines.append('{:40s} {:12.4f} {:12.4f} {:>8s}'.format(key, before, value, change))
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    p.add_argument('-o', '--output', metavar='FILE', help='write the JSON results to FILE instead of stdout')
+    p.add_argument('-c', '--compare', metavar='FILE', help='print the change against earlier results')
+    p.add_argument('--megabytes', type=float, default=2.0, help='data pushed through sniff for throughput')
+    p.add_argument('--frames', type=int, default=100, help='frames timed for sniff latency')
+    p.add_argument('--delta', type=int, default=5000, help='sniff timing delta in microseconds')
+    p.add_argument('--iterations', type=int, default=200, help='commands timed per command_rtt case')
+    args = p.parse_args()
+
+    results = OrderedDict()
+    results['sniff_throughput'] = sniff_throughput(args.megabytes)
+    results['sniff_latency'] = OrderedDict([
+        ('gap', sniff_latency(args.frames, args.delta, None)),
+        ('framer', sniff_latency(args.frames, args.delta, 'modbus')),
+    ])
+    results['command_rtt'] = command_rtt(args.iterations)
+    report = OrderedDict([
+        ('format', FORMAT_VERSION),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('cpus', os.cpu_count()),
+        ('options', vars(args)),
+        ('results', results),
+    ])
+
+    text = json.dumps(report, indent=2) + '\n'
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+    if args.compare:
+        with open(args.compare) as f:
+            sys.stderr.write(compare(json.load(f), report))
+
+
+if __name__ == '__main__':
+    main()
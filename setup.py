@@ -47,7 +47,6 @@ setup(
         'Operating System :: POSIX',
         'Operating System :: Microsoft :: Windows',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: Implementation :: CPython',
         'Programming Language :: Python :: Implementation :: PyPy',
@@ -57,7 +56,8 @@ setup(
         'serial', 'pentest', 'ControlThingsTools', 'ControlThingsPlatform',
     ],
     install_requires=[
-        'prompt_toolkit>=2.0.1',
+        'prompt_toolkit>=3.0',
+        'pony',
         'pyserial',
         'tabulate'
     ],
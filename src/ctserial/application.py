@@ -16,9 +16,14 @@ Control Things Serial, aka ctserial.py
 
 import sys
 import serial
+import threading
 import time
 from .commands import Commands
 from .base import TextArea
+from .output import Scrollback
+from .recorder import Recorder
+from .response import GapCompletion
+from .sessions import SessionManager
 from prompt_toolkit.application import Application
 from prompt_toolkit.application.current import get_app
 from prompt_toolkit.document import Document
@@ -32,30 +37,106 @@ from prompt_toolkit.layout.menus import CompletionsMenu
 from prompt_toolkit.shortcuts.dialogs import message_dialog
 from prompt_toolkit.styles import Style
 from prompt_toolkit.widgets import MenuContainer, MenuItem, ProgressBar #, TextArea
-from prompt_toolkit.completion import WordCompleter
 
 
 class MyApplication(Application):
-    session = ''
     output_format = 'mixed'
+    recorder = None
+    recording = True
+    output_field = None
+    # transactions run on the session pool and post their output
+    background = True
 
+    def __init__(self, *args, **kwargs):
+        super(MyApplication, self).__init__(*args, **kwargs)
+        self.completion = GapCompletion()
+        self.scrollback = Scrollback()
+        self.sessions = SessionManager()
+        self._posted = []
+        self._posted_lock = threading.Lock()
+        self._output_changed = False
+        self.before_render += self._show_output
 
-def get_statusbar_text():
+    @property
+    def session(self):
+        """Serial port of the current connection, '' when nothing is open."""
+        current = self.sessions.current
+        return current.serial if current else ''
+
+    def write_output(self, text):
+        """Append text to the output pane, it is shown and scrolled to on the next redraw."""
+        self.scrollback.append(text)
+        self._output_changed = True
+        self.invalidate()
+
+    def _show_output(self, app):
+        # the pane's document is built once per redraw, not once per write
+        if not self._output_changed or self.output_field is None:
+            return
+        self._output_changed = False
+        text = self.scrollback.text
+        self.output_field.buffer.document = Document(text=text, cursor_position=len(text))
+
+    def post_output(self, text):
+        """
+        Like write_output() but safe to call from other threads.  Text posted
+        before the event loop gets to it is written in one go, so a burst of
+        frames rebuilds the output pane once.
+        """
+        loop = getattr(self, 'loop', None)
+        if loop is None or not self.is_running:
+            return
+        with self._posted_lock:
+            self._posted.append(text)
+            if len(self._posted) > 1:
+                return
+        loop.call_soon_threadsafe(self._write_posted)
+
+    def _write_posted(self):
+        with self._posted_lock:
+            text = ''.join(self._posted)
+            del self._posted[:]
+        self.write_output(text)
+
+
+# seconds between status bar refreshes, also how often the idle screen is redrawn
+STATUS_INTERVAL = 1.0
+
+_statusbar_cache = {'time': 0.0, 'text': ''}
+
+
+def statusbar_text(app):
     sep = '  -  '
-    session = get_app().session
-    if type(session) == serial.Serial:
-        device = 'connected:' + session.port
+    sessions = app.sessions
+    if sessions.current:
+        device = 'connected:{}({})'.format(sessions.current.name, sessions.current.serial.port)
+        if len(sessions) > 1:
+            device += ' +{}'.format(len(sessions) - 1)
+        parts = [device, 'output:' + app.output_format, sessions.current.stats.summary()]
     else:
-        device = 'connected:None'
-    output_format = 'output:' + get_app().output_format
-    return sep.join([device, output_format])
+        parts = ['connected:None', 'output:' + app.output_format]
+    return sep.join(parts)
+
+
+def get_statusbar_text():
+    """The status bar, rebuilt at most every STATUS_INTERVAL instead of on every redraw."""
+    now = time.time()
+    if now - _statusbar_cache['time'] >= STATUS_INTERVAL:
+        _statusbar_cache['text'] = statusbar_text(get_app())
+        _statusbar_cache['time'] = now
+    return _statusbar_cache['text']
+
+
+def refresh_statusbar():
+    """Rebuild the status bar on the next redraw, e.g. after a command changed it."""
+    _statusbar_cache['time'] = 0.0
 
 
 # def start_app(session):
 def start_app(args):
     """Text-based GUI application"""
     cmd = Commands()
-    completer = WordCompleter(cmd.commands(), meta_dict=cmd.meta_dict(), ignore_case=True)
+    completer = cmd.registry.completer
     history = InMemoryHistory()
 
     # Individual windows
@@ -113,25 +194,15 @@ def start_app(args):
     # The key bindings.
     kb = KeyBindings()
 
-    @kb.add('space')
-    def _(event):
-        input_text = input_field.text
-        cursor=len(input_text)
-        input_updated = input_text[:cursor] + ' ' + input_text[cursor+1:]
-        cursor += 1
-        input_field.buffer.document = Document(
-            text=input_updated, cursor_position=cursor)
-        input_field.buffer.completer = WordCompleter([], ignore_case=True)
-
     @kb.add('enter', filter=has_focus(input_field))
     def _(event):
         # Process commands on prompt after hitting enter key
         # tx_bytes = parse_command(input_field.text, event=event)
-        input_field.buffer.completer = WordCompleter(cmd.commands(), meta_dict=cmd.meta_dict(), ignore_case=True)
         if len(input_field.text) == 0:
             return
-        output_text = cmd.execute(input_field.text, output_field.text, event)
+        output_text = cmd.execute(input_field.text, '', event)
         input_field.buffer.reset(append_to_history=True)
+        refresh_statusbar()
 
         # For commands that do not send data to serial device
         if output_text == None:
@@ -140,10 +211,9 @@ def start_app(args):
         # For invalid commands forcing users to correct them
         elif output_text == False:
             return
-        # For invalid commands forcing users to correct them
+        # Append only the new output, the scrollback keeps itself bounded
         else:
-            output_field.buffer.document = Document(
-                text=output_text, cursor_position=len(output_text))
+            event.app.write_output(output_text)
             input_field.text = ''
 
     @kb.add('c-c')
@@ -160,7 +230,7 @@ def start_app(args):
     @kb.add('c-q')
     def _(event):
         " Pressing Ctrl-Q will exit the user interface. "
-        cmd.do_exit(input_field.text, output_field.text, event)
+        cmd.do_exit(input_field.text, '', event)
 
     @kb.add('c-d')
     def _(event):
@@ -180,5 +250,13 @@ def start_app(args):
         key_bindings=kb,
         style=style,
         mouse_support=True,
-        full_screen=True  )
+        full_screen=True,
+        refresh_interval=STATUS_INTERVAL  )
+    application.output_field = output_field
+    try:
+        application.recorder = Recorder(on_error=application.post_output)
+        cmd.macros.attach(application.recorder.model)
+    except Exception as e:
+        # recording is optional, the prompt works without a database
+        application.write_output('Transactions and macros are not saved: {}\n'.format(e))
     application.run()
@@ -0,0 +1,291 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""
+Guess the baud rate and parity of a line from the traffic on it.
+
+The port listens for a moment at each candidate setting.  On POSIX systems
+the terminal is told to mark bytes with parity or framing errors (PARMRK),
+which is the strongest hint: at the wrong rate or parity most bytes arrive
+broken.  Bytes made only of a run of ones and zeros (0x00, 0x80, 0xF0,
+0xFF...) are what a receiver at the wrong rate typically makes of a
+start bit, so their share is the tie breaker; a framer that finds valid
+frames makes a candidate more likely still.
+
+One port can only listen at one setting at a time, so candidates are tried
+one after another: first every rate at 8N1, then even and odd parity at
+the best rates, or at every rate if no 8N1 rate looked right.  Several
+ports are probed concurrently.  Stop bits cannot be told apart on the
+receiving side and are always reported as 1.
+
+Results are cached per device path, so connecting again needs no probing.
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+
+try:
+    import termios
+    SETTING_ERRORS = (ValueError, OSError, termios.error)
+except ImportError:
+    termios = None
+    SETTING_ERRORS = (ValueError, OSError)
+
+BAUDRATES = (1200, 2400, 4800, 9600, 19200, 38400, 57600, 115200)
+SAMPLE_TIME = 0.5
+READ_TIMEOUT = 0.01
+MAX_SAMPLE = 4096
+MIN_BYTES = 16
+PARITY_PASS = 2
+CONFIDENT = 0.6
+DEFAULT_CACHE = os.path.join('~', '.ctserial', 'autobaud.json')
+
+# what a receiver running at the wrong rate usually makes of a start bit
+JUNK_BYTES = (0x00, 0x80, 0xC0, 0xE0, 0xF0, 0xF8, 0xFC, 0xFE, 0xFF)
+
+_cache_lock = threading.Lock()
+
+Setting = namedtuple('Setting', 'baudrate bytesize parity stopbits')
+Measurement = namedtuple('Measurement', 'setting bytes errors score')
+
+
+def setting_str(setting):
+    """Short form like 9600 8N1."""
+    return '{} {}{}{}'.format(setting.baudrate, setting.bytesize, setting.parity, setting.stopbits)
+
+
+def parse_marked(data):
+    """
+    Split bytes read with PARMRK into the good bytes and an error count.
+
+    A broken byte arrives as ff 00 X and a real ff byte as ff ff.
+    """
+    if b'\xff' not in data:
+        return data, 0
+    clean = bytearray()
+    errors, position, length = 0, 0, len(data)
+    while True:
+        marker = data.find(b'\xff', position)
+        if marker < 0 or marker + 1 >= length:
+            clean += data[position:]
+            return bytes(clean), errors
+        clean += data[position:marker]
+        if data[marker + 1] == 0xFF:
+            clean.append(0xFF)
+            position = marker + 2
+        else:
+            errors += 1
+            position = marker + 3
+
+
+def score(data, errors, framer=None):
+    """Rate how plausible a sample is between 0 and 1, 0 if it is too small to tell."""
+    total = len(data) + errors
+    if total < MIN_BYTES:
+        return 0.0
+    good = len(data) / total
+    junk = sum(data.count(byte) for byte in JUNK_BYTES) / len(data) if data else 1.0
+    result = good ** 4 * (1 - 0.5 * junk)
+    if framer is not None and data:
+        framer.reset()
+        framed = sum(len(frame) for frame in framer.feed(data))
+        result *= 0.5 + 0.5 * framed / len(data)
+    return result
+
+
+def _mark_errors(port):
+    """Ask the terminal to mark parity and framing errors in the data."""
+    if termios is None:
+        return
+    try:
+        fd = port.fileno()
+        attrs = termios.tcgetattr(fd)
+        attrs[0] |= termios.PARMRK | termios.INPCK
+        attrs[0] &= ~(termios.IGNPAR | termios.ISTRIP)
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    except (AttributeError, ValueError, OSError, termios.error):
+        pass
+
+
+class AutoBaud(object):
+    """Probe candidate settings on an open pyserial port."""
+    def __init__(self, port, baudrates=BAUDRATES, sample_time=SAMPLE_TIME, framer=None):
+        self.port = port
+        self.baudrates = baudrates
+        self.sample_time = sample_time
+        self.framer = framer
+
+    def sample(self, setting):
+        """Listen at one setting, return a Measurement."""
+        port = self.port
+        previous = port.get_settings()
+        try:
+            port.apply_settings({'baudrate': setting.baudrate, 'bytesize': setting.bytesize,
+                                 'parity': setting.parity, 'stopbits': setting.stopbits})
+            # every reconfiguration clears PARMRK, so set the timeout first
+            port.timeout = READ_TIMEOUT
+        except SETTING_ERRORS:
+            # the port cannot do this setting at all; pyserial keeps the
+            # value it failed on, so the parity has to go back first
+            port.apply_settings({'parity': previous['parity']})
+            port.apply_settings(previous)
+            return Measurement(setting, 0, 0, 0.0)
+        _mark_errors(port)
+        port.reset_input_buffer()
+        data = bytearray()
+        deadline = time.perf_counter() + self.sample_time
+        while len(data) < MAX_SAMPLE and time.perf_counter() < deadline:
+            data += port.read(max(1, min(port.in_waiting, MAX_SAMPLE - len(data))))
+        clean, errors = parse_marked(bytes(data))
+        return Measurement(setting, len(clean), errors, score(clean, errors, self.framer))
+
+    def run(self):
+        """Try the candidates, return Measurements best first; the port keeps the last setting."""
+        saved_timeout = self.port.timeout
+        try:
+            return self._run()
+        finally:
+            self.port.timeout = saved_timeout
+
+    def _run(self):
+        results = [self.sample(Setting(rate, 8, 'N', 1)) for rate in self.baudrates]
+        results.sort(key=lambda m: -m.score)
+        if results[0].score >= CONFIDENT:
+            # parity errors only show on some bytes, check the best rates
+            rates = [m.setting.baudrate for m in results[:PARITY_PASS]]
+        else:
+            # the line probably uses parity, which garbles every rate at 8N1
+            rates = self.baudrates
+        for rate in rates:
+            for parity in ('E', 'O'):
+                results.append(self.sample(Setting(rate, 8, parity, 1)))
+        results.sort(key=lambda m: -m.score)
+        return results
+
+
+def load_cache(path=DEFAULT_CACHE):
+    try:
+        with open(os.path.expanduser(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def cached_setting(device, path=DEFAULT_CACHE):
+    """The Setting found for device earlier, or None."""
+    entry = load_cache(path).get(device)
+    if entry is None:
+        return None
+    return Setting(entry['baudrate'], entry['bytesize'], entry['parity'], entry['stopbits'])
+
+
+def save_setting(device, measurement, path=DEFAULT_CACHE):
+    path = os.path.expanduser(path)
+    entry = measurement.setting._asdict()
+    entry.update(score=measurement.score, time=time.time())
+    with _cache_lock:
+        cache = load_cache(path)
+        cache[device] = entry
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+
+def detect(device, baudrates=BAUDRATES, sample_time=SAMPLE_TIME, framer=None, cache=DEFAULT_CACHE):
+    """
+    Probe a device that is not open yet, return Measurements best first.
+
+    framer is the text form of a framer, see parse_framer().  A usable
+    best result is stored in the cache unless cache is None.
+    """
+    import serial
+    from .framing import parse_framer
+    framer = parse_framer(framer) if framer else None
+    port = serial.Serial(device, timeout=0)
+    try:
+        results = AutoBaud(port, baudrates, sample_time, framer).run()
+    finally:
+        port.close()
+    if cache and results and results[0].score > 0:
+        save_setting(device, results[0], cache)
+    return results
+
+
+def detect_many(devices, **kwargs):
+    """Run detect() on several devices at once, return {device: results or exception}."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def probe(device):
+        try:
+            return detect(device, **kwargs)
+        except Exception as e:
+            return e
+    with ThreadPoolExecutor(max(1, len(devices))) as pool:
+        return dict(zip(devices, pool.map(probe, devices)))
+
+
+def format_results(results, limit=5):
+    lines = []
+    for m in results[:limit]:
+        lines.append('{:16s} score {:.3f}  {} bytes  {} errors'.format(
+            setting_str(m.setting), m.score, m.bytes, m.errors))
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    from .framing import FRAMER_USAGE, parse_framer
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('devices', nargs='+', help='serial devices to probe, concurrently')
+    parser.add_argument('-s', '--sample', type=float, default=SAMPLE_TIME, metavar='SECONDS', help='how long to listen at each setting')
+    parser.add_argument('-b', '--baudrates', default=','.join(str(b) for b in BAUDRATES), help='comma separated rates to try')
+    parser.add_argument('-f', '--framer', metavar='FRAMER', help='also score by frames a protocol framer finds: ' + FRAMER_USAGE)
+    parser.add_argument('-c', '--cached', action='store_true', help='print cached settings instead of probing when there are any')
+    parser.add_argument('--no-cache', action='store_true', help='do not store the results')
+    args = parser.parse_args()
+    try:
+        baudrates = [int(rate) for rate in args.baudrates.split(',')]
+        if args.framer:
+            parse_framer(args.framer)
+    except ValueError as e:
+        parser.error(str(e))
+
+    devices = args.devices
+    if args.cached:
+        for device in list(devices):
+            setting = cached_setting(device)
+            if setting:
+                print('{}: {} (cached)'.format(device, setting_str(setting)))
+                devices.remove(device)
+    if not devices:
+        return
+    results = detect_many(devices, baudrates=baudrates, sample_time=args.sample,
+                          framer=args.framer, cache=None if args.no_cache else DEFAULT_CACHE)
+    for device, result in results.items():
+        if isinstance(result, Exception):
+            print('{}: {}'.format(device, result))
+        elif not result or result[0].score == 0:
+            print('{}: not enough traffic to tell'.format(device))
+        else:
+            print('{}: {}'.format(device, setting_str(result[0].setting)))
+            sys.stdout.write(format_results(result))
+
+
+if __name__ == '__main__':
+    main()
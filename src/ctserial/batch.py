@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Control Things Serial batch sender, send a file of frames to a serial device
+
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import struct
+import sys
+import time
+from collections import deque, namedtuple
+
+from .checksum import CHECKSUMS, get_checksum
+from .formatting import parse_hex
+from .response import COMPLETION_USAGE, GapCompletion, PortTimeout, parse_completion, clock
+
+Result = namedtuple('Result', 'tx rx rtt')
+
+
+def load_frames(path, binary=None):
+    """
+    Read the frames to send from a file.
+
+    Text files hold one frame of hex per line, blank lines and lines starting
+    with # are skipped.  Binary files (the default for a .bin extension) are a
+    sequence of 2 byte big endian lengths each followed by that many bytes.
+    """
+    if binary is None:
+        binary = path.endswith('.bin')
+    frames = []
+    if binary:
+        with open(path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset < len(data):
+            if offset + 2 > len(data):
+                raise ValueError('{}: truncated length at byte {}'.format(path, offset))
+            length, = struct.unpack_from('>H', data, offset)
+            offset += 2
+            if offset + length > len(data):
+                raise ValueError('{}: truncated frame at byte {}'.format(path, offset))
+            frames.append(data[offset:offset + length])
+            offset += length
+        return frames
+    with open(path) as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            frame = parse_hex(line)
+            if frame is None:
+                raise ValueError('{}:{}: not a hex frame'.format(path, line_num))
+            frames.append(frame)
+    return frames
+
+
+class BatchSender(object):
+    """
+    Send frames on an open serial session and collect their responses.
+
+    Up to window frames are written before their responses arrive, which
+    requires a completion strategy that can tell back to back responses apart;
+    with the gap strategy the window is always 1.  interval is the minimum
+    time in seconds between two writes.
+    """
+    def __init__(self, session, completion, window=1, interval=0.0):
+        self.session = session
+        self.completion = completion
+        self.window = 1 if type(completion) is GapCompletion else max(1, window)
+        self.interval = interval
+
+    def run(self, frames, on_result=None):
+        """Send all frames, return a list of Result tuples in sending order."""
+        session, completion = self.session, self.completion
+        frames = iter(frames)
+        next_frame = next(frames, None)
+        pending = deque()
+        rx = bytearray()
+        last_rx = None
+        next_send = clock()
+        results = []
+
+        def finish(response, last):
+            tx, sent = pending.popleft()
+            result = Result(tx, response, last - sent if response else None)
+            results.append(result)
+            if on_result:
+                on_result(result)
+
+        completion.reset()
+        session.reset_input_buffer()
+        timeout = PortTimeout(session)
+        try:
+            while next_frame is not None or pending:
+                now = clock()
+                while next_frame is not None and len(pending) < self.window and now >= next_send:
+                    session.write(next_frame)
+                    pending.append((next_frame, now))
+                    next_send = now + self.interval
+                    next_frame = next(frames, None)
+                    now = clock()
+                while pending and rx:
+                    end = completion.end(rx)
+                    if end is None:
+                        break
+                    finish(bytes(rx[:end]), last_rx)
+                    del rx[:end]
+                if rx and not pending:
+                    # nothing was asked for these, don't hand them to the next frame
+                    rx.clear()
+                    completion.reset()
+                if pending:
+                    sent = pending[0][1]
+                    if rx and completion.gap is not None and now - last_rx >= completion.gap:
+                        finish(bytes(rx), last_rx)
+                        rx.clear()
+                        completion.reset()
+                    elif now - sent >= completion.timeout:
+                        # give up on the head frame, keep whatever it got
+                        finish(bytes(rx), last_rx or now)
+                        rx.clear()
+                        completion.reset()
+                if not pending and next_frame is None:
+                    break
+                deadlines = []
+                if next_frame is not None and len(pending) < self.window:
+                    deadlines.append(next_send)
+                if pending:
+                    deadlines.append(pending[0][1] + completion.timeout)
+                    if rx and completion.gap is not None:
+                        deadlines.append(last_rx + completion.gap)
+                wait = max(0, min(deadlines) - clock())
+                if pending:
+                    timeout.wait(wait)
+                    chunk = session.read(max(1, session.in_waiting))
+                    if chunk:
+                        rx += chunk
+                        last_rx = clock()
+                else:
+                    time.sleep(wait)
+        finally:
+            timeout.restore()
+        return results
+
+
+def summarize(results, elapsed):
+    """Return throughput and latency figures for a finished batch as a dict."""
+    rtts = sorted(r.rtt for r in results if r.rtt is not None)
+    summary = {
+        'frames': len(results),
+        'responses': len(rtts),
+        'timeouts': len(results) - len(rtts),
+        'tx_bytes': sum(len(r.tx) for r in results),
+        'rx_bytes': sum(len(r.rx) for r in results),
+        'elapsed': elapsed,
+        'frames_per_second': len(results) / elapsed if elapsed else 0.0,
+    }
+    if rtts:
+        summary.update({
+            'rtt_min_ms': rtts[0] * 1E3,
+            'rtt_median_ms': rtts[len(rtts) // 2] * 1E3,
+            'rtt_p95_ms': rtts[min(len(rtts) - 1, int(len(rtts) * 0.95))] * 1E3,
+            'rtt_max_ms': rtts[-1] * 1E3,
+        })
+    return summary
+
+
+def format_summary(summary):
+    lines = ['{frames} frames sent, {responses} responses, {timeouts} timeouts'.format(**summary),
+             '{elapsed:.3f} s, {frames_per_second:.1f} frames/s, {tx_bytes} bytes out, '
+             '{rx_bytes} bytes in'.format(**summary)]
+    if summary['responses']:
+        lines.append('round trip ms: min {rtt_min_ms:.2f}  median {rtt_median_ms:.2f}  '
+                     'p95 {rtt_p95_ms:.2f}  max {rtt_max_ms:.2f}'.format(**summary))
+    return '\n'.join(lines) + '\n'
+
+
+def write_results(path, results):
+    """Save one line per frame: tx hex, rx hex (or -) and round trip ms (or -)."""
+    with open(path, 'w') as f:
+        for r in results:
+            f.write('{} {} {}\n'.format(r.tx.hex(), r.rx.hex() or '-',
+                                        '{:.3f}'.format(r.rtt * 1E3) if r.rtt is not None else '-'))
+
+
+def main():
+    import serial
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('device', help='serial device to send to')
+    parser.add_argument('frames', help='file with one hex frame per line, or length prefixed binary frames')
+    parser.add_argument('-b', '--baudrate', type=int, default=9600, help='The baudrate to open the serial port at.')
+    parser.add_argument('--binary', action='store_true', default=None, help='Read the frames file as 2 byte big endian length prefixed records. Default for .bin files.')
+    parser.add_argument('-w', '--window', type=int, default=1, help='Frames sent ahead of their responses. Needs a response strategy other than gap.')
+    parser.add_argument('-i', '--interval', type=float, default=0.0, metavar='MS', help='Minimum time between two frames in milliseconds.')
+    parser.add_argument('-r', '--response', default='gap 20', metavar='STRATEGY', help='How the end of a response is detected: ' + COMPLETION_USAGE)
+    parser.add_argument('-t', '--timeout', type=float, default=1.0, metavar='SECONDS', help='Time to wait for each response.')
+    parser.add_argument('-o', '--output', metavar='FILE', help='Write tx, rx and round trip time of every frame to FILE.')
+    parser.add_argument('-c', '--checksum', action='append', default=[], metavar='NAME', help='Append a checksum to every frame before sending, one of: {}. May be given more than once.'.format(', '.join(CHECKSUMS)))
+    parser.add_argument('-k', '--check', metavar='NAME', help='Count the responses that end in a valid checksum NAME.')
+    args = parser.parse_args()
+
+    try:
+        completion = parse_completion(args.response, args.timeout)
+        frames = load_frames(args.frames, args.binary)
+        for name in args.checksum:
+            frames = get_checksum(name).apply_many(frames)
+        check = get_checksum(args.check) if args.check else None
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    try:
+        session = serial.Serial(args.device, baudrate=args.baudrate)
+    except serial.SerialException as e:
+        sys.exit(str(e))
+    sender = BatchSender(session, completion, args.window, args.interval / 1E3)
+    start = clock()
+    try:
+        results = sender.run(frames)
+    except KeyboardInterrupt:
+        sys.exit(1)
+    finally:
+        session.close()
+    if args.output:
+        write_results(args.output, results)
+    sys.stdout.write(format_summary(summarize(results, clock() - start)))
+    if check:
+        responses = [r.rx for r in results if r.rx]
+        sys.stdout.write('{} of {} responses pass {}\n'.format(
+            sum(check.verify_many(responses)), len(responses), check))
+
+
+if __name__ == '__main__':
+    main()
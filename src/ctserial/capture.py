@@ -0,0 +1,457 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""
+Binary capture files in pcapng format.
+
+Every serial port becomes a pcapng interface named after its alias, every
+frame an Enhanced Packet Block with a nanosecond timestamp and the direction
+stored in the epb_flags option, so Wireshark-style tools can open captures
+directly.
+
+Captures are read back through a memory map and a compact frame index that
+is kept next to the capture in a sidecar file, see CaptureReader.
+"""
+
+import argparse
+import bisect
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from collections import namedtuple
+from datetime import datetime as dt
+
+try:
+    monotonic_ns = time.monotonic_ns
+    time_ns = time.time_ns
+except AttributeError:
+    def monotonic_ns():
+        return int(time.monotonic() * 1E9)
+
+    def time_ns():
+        return int(time.time() * 1E9)
+
+# serial data has no registered link type, use the first user defined one
+LINKTYPE_USER0 = 147
+
+DIRECTION_IN = 1
+DIRECTION_OUT = 2
+
+BLOCK_SHB = 0x0A0D0D0A
+BLOCK_IDB = 0x00000001
+BLOCK_EPB = 0x00000006
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+OPT_ENDOFOPT = 0
+OPT_SHB_USERAPPL = 4
+OPT_IF_NAME = 2
+OPT_IF_DESCRIPTION = 3
+OPT_IF_TSRESOL = 9
+OPT_EPB_FLAGS = 2
+
+WRITE_BUFFER = 1 << 20
+
+
+def _pad(length):
+    return -length % 4
+
+
+def _option(code, value):
+    return struct.pack('<HH', code, len(value)) + value + b'\x00' * _pad(len(value))
+
+
+def _block(block_type, body):
+    length = 12 + len(body)
+    return struct.pack('<II', block_type, length) + body + struct.pack('<I', length)
+
+
+class CaptureWriter(object):
+    """
+    Stream frames into a pcapng file through a large write buffer.
+
+    Timestamps are taken from the monotonic clock and anchored to the wall
+    clock once when the writer is created, so they never jump backwards.
+    """
+    def __init__(self, path, buffering=WRITE_BUFFER):
+        self.file = open(path, 'wb', buffering=buffering)
+        self.interfaces = {}
+        self.wall_offset = time_ns() - monotonic_ns()
+        options = _option(OPT_SHB_USERAPPL, b'ctserial') + _option(OPT_ENDOFOPT, b'')
+        self.file.write(_block(BLOCK_SHB, struct.pack(
+            '<IHHq', BYTE_ORDER_MAGIC, 1, 0, -1) + options))
+
+    def add_interface(self, name, description=''):
+        """Declare a port and return the interface id used by write_frame()."""
+        if name in self.interfaces:
+            return self.interfaces[name]
+        options = _option(OPT_IF_NAME, name.encode('utf-8'))
+        if description:
+            options += _option(OPT_IF_DESCRIPTION, description.encode('utf-8'))
+        options += _option(OPT_IF_TSRESOL, b'\x09') + _option(OPT_ENDOFOPT, b'')
+        self.file.write(_block(BLOCK_IDB, struct.pack(
+            '<HHI', LINKTYPE_USER0, 0, 0) + options))
+        self.interfaces[name] = len(self.interfaces)
+        return self.interfaces[name]
+
+    def write_frame(self, interface_id, data, timestamp=None, direction=DIRECTION_IN):
+        """
+        Append one frame.
+
+        timestamp is a monotonic_ns() reading, defaulting to now.
+        """
+        if timestamp is None:
+            timestamp = monotonic_ns()
+        timestamp += self.wall_offset
+        length = len(data)
+        pad = _pad(length)
+        options = _option(OPT_EPB_FLAGS, struct.pack('<I', direction)) + _option(OPT_ENDOFOPT, b'')
+        block_length = 32 + length + pad + len(options)
+        self.file.write(struct.pack('<IIIIIII', BLOCK_EPB, block_length, interface_id,
+                                    timestamp >> 32, timestamp & 0xFFFFFFFF, length, length))
+        self.file.write(data)
+        self.file.write(b'\x00' * pad + options + struct.pack('<I', block_length))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+Frame = namedtuple('Frame', 'number port timestamp direction data')
+
+INDEX_MAGIC = b'CTIDX002'
+INDEX_SUFFIX = '.ctidx'
+
+
+class CaptureReader(object):
+    """
+    Random access to the frames of a pcapng capture.
+
+    The file is memory mapped and scanned once into parallel arrays of block
+    offsets, timestamps (ns since the epoch), interface ids and directions.
+    The arrays are saved to a sidecar file (capture path + INDEX_SUFFIX) and
+    reused on the next open if the capture's size and mtime are unchanged;
+    a capture that grew since is only scanned from where the index ended if
+    its section header and last indexed block are still the same, anything
+    else is indexed again.  Only the payloads of frames actually asked for
+    are copied out of the map.
+    """
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + INDEX_SUFFIX
+        self.file = open(path, 'rb')
+        stat = os.fstat(self.file.fileno())
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        self.interfaces = []
+        self.tsresol = []
+        self.offsets = array('Q')
+        self.timestamps = array('q')
+        self.ports = array('H')
+        self.directions = array('B')
+        self.indexed = 0
+        if not self._load_index():
+            self.interfaces, self.tsresol = [], []
+            self.offsets, self.timestamps = array('Q'), array('q')
+            self.ports, self.directions = array('H'), array('B')
+            self.indexed = 0
+        if self.indexed < self.size:
+            self._scan()
+            self._save_index()
+        self._by_port = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, number):
+        if number < 0:
+            number += len(self.offsets)
+        offset = self.offsets[number]
+        length, = struct.unpack_from('<I', self.map, offset + 20)
+        data = self.map[offset + 28:offset + 28 + length]
+        return Frame(number, self.interfaces[self.ports[number]],
+                     self.timestamps[number], self.directions[number], data)
+
+    def _scan(self):
+        """Index every complete block from self.indexed to the end of the file."""
+        buf, offset, size = self.map, self.indexed, self.size
+        unpack = struct.unpack_from
+        while offset + 12 <= size:
+            block_type, length = unpack('<II', buf, offset)
+            if length < 12 or offset + length > size:
+                break  # block still being written
+            if block_type == BLOCK_SHB:
+                magic, = unpack('<I', buf, offset + 8)
+                if magic != BYTE_ORDER_MAGIC:
+                    raise ValueError('{}: only little endian pcapng is supported'.format(self.path))
+            elif block_type == BLOCK_IDB:
+                name, tsresol = interface_block(buf, offset, length, len(self.interfaces))
+                self.interfaces.append(name)
+                self.tsresol.append(tsresol)
+            elif block_type == BLOCK_EPB:
+                port, timestamp, direction, _ = packet_block(buf, offset, length, self.tsresol)
+                self.offsets.append(offset)
+                self.timestamps.append(timestamp)
+                self.ports.append(port)
+                self.directions.append(direction)
+            offset += length
+        self.indexed = offset
+
+    def _fingerprint(self, indexed):
+        """CRC of the section header block and of the last block before indexed."""
+        if indexed < 12:
+            return 0
+        buf = self.map
+        first, = struct.unpack_from('<I', buf, 4)
+        last, = struct.unpack_from('<I', buf, indexed - 4)
+        if first > indexed or last > indexed:
+            return 0
+        return zlib.crc32(buf[indexed - last:indexed], zlib.crc32(buf[:first]))
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                    return False
+                indexed, size, mtime, fingerprint, count, names_len = struct.unpack('<QQqIQI', f.read(40))
+                if (size, mtime) != (self.size, self.mtime):
+                    if indexed > self.size or fingerprint != self._fingerprint(indexed):
+                        return False
+                names = f.read(names_len).decode('utf-8').split('\n') if names_len else []
+                self.interfaces = names[0::2]
+                self.tsresol = [int(x) for x in names[1::2]]
+                for arr in (self.offsets, self.timestamps, self.ports, self.directions):
+                    arr.fromfile(f, count)
+                self.indexed = indexed
+                return True
+        except (OSError, EOFError, ValueError, struct.error):
+            return False
+
+    def _save_index(self):
+        names = '\n'.join('{}\n{}'.format(name, res) for name, res in zip(self.interfaces, self.tsresol))
+        names = names.encode('utf-8')
+        try:
+            with open(self.index_path, 'wb') as f:
+                f.write(INDEX_MAGIC)
+                f.write(struct.pack('<QQqIQI', self.indexed, self.size, self.mtime,
+                                    self._fingerprint(self.indexed), len(self.offsets), len(names)))
+                f.write(names)
+                for arr in (self.offsets, self.timestamps, self.ports, self.directions):
+                    arr.tofile(f)
+        except OSError:
+            pass  # read only location, index again next time
+
+    def port_frames(self, port):
+        """Return an array with the numbers of all frames of one port alias."""
+        if self._by_port is None:
+            self._by_port = [array('Q') for _ in self.interfaces]
+            for number, port_id in enumerate(self.ports):
+                self._by_port[port_id].append(number)
+        return self._by_port[self.interfaces.index(port)]
+
+    def frames(self, start=0, stop=None, port=None, since=None, until=None):
+        """
+        Lazily yield frames in capture order.
+
+        start/stop select by frame number, port by alias and since/until by
+        timestamp in ns since the epoch (until is exclusive).  Frames of one
+        port are time ordered, so a port plus time range is found by bisection.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        if port is None:
+            numbers = range(start, stop)
+        else:
+            numbers = self.port_frames(port)
+            if since is not None or until is not None:
+                times = _Column(self.timestamps, numbers)
+                lo = bisect.bisect_left(times, since) if since is not None else 0
+                hi = bisect.bisect_left(times, until) if until is not None else len(numbers)
+                numbers = numbers[lo:hi]
+            numbers = numbers[bisect.bisect_left(numbers, start):bisect.bisect_left(numbers, stop)]
+        for number in numbers:
+            timestamp = self.timestamps[number]
+            if since is not None and timestamp < since:
+                continue
+            if until is not None and timestamp >= until:
+                continue
+            yield self[number]
+
+    def fingerprint(self, count):
+        """CRC of the section header block and of the block of frame count - 1, 0 without frames."""
+        if not count:
+            return 0
+        offset = self.offsets[count - 1]
+        length, = struct.unpack_from('<I', self.map, offset + 4)
+        return self._fingerprint(offset + length)
+
+    def changed(self):
+        """Whether the file's size or mtime differ from when it was opened, e.g. it grew."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return (stat.st_size, stat.st_mtime_ns) != (self.size, self.mtime)
+
+    def close(self):
+        if self.size:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _Column(object):
+    """Read only view of values[numbers[i]] for bisect."""
+    def __init__(self, values, numbers):
+        self.values = values
+        self.numbers = numbers
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __getitem__(self, i):
+        return self.values[self.numbers[i]]
+
+
+def _options(buf, offset, end):
+    while offset + 4 <= end:
+        code, length = struct.unpack_from('<HH', buf, offset)
+        if code == OPT_ENDOFOPT:
+            break
+        yield code, buf[offset + 4:offset + 4 + length]
+        offset += 4 + length + _pad(length)
+
+
+def interface_block(buf, offset, length, number):
+    """Name and timestamp resolution of the interface block at offset, the number-th one."""
+    name, tsresol = 'if{}'.format(number), 6
+    for code, value in _options(buf, offset + 16, offset + length - 4):
+        if code == OPT_IF_NAME:
+            name = value.decode('utf-8', 'replace')
+        elif code == OPT_IF_TSRESOL:
+            tsresol = value[0]
+    return name, tsresol
+
+
+def packet_block(buf, offset, length, tsresol):
+    """
+    Interface id, timestamp in ns since the epoch, direction and payload
+    length of the packet block at offset; the payload starts at offset + 28.
+    tsresol holds the resolution of every interface.
+    """
+    port, high, low, caplen = struct.unpack_from('<IIII', buf, offset + 8)
+    direction = 0
+    for code, value in _options(buf, offset + 28 + caplen + _pad(caplen), offset + length - 4):
+        if code == OPT_EPB_FLAGS:
+            direction = struct.unpack('<I', value)[0] & 3
+    return port, _to_ns((high << 32) | low, tsresol[port]), direction, caplen
+
+
+def _to_ns(ticks, tsresol):
+    if tsresol & 0x80:
+        return ticks * 10**9 >> (tsresol & 0x7F)
+    if tsresol <= 9:
+        return ticks * 10**(9 - tsresol)
+    return ticks // 10**(tsresol - 9)
+
+
+try:
+    _fromisoformat = dt.fromisoformat
+except AttributeError:
+    # python 3.6 has no datetime.fromisoformat
+    ISO_LAYOUTS = ('%Y-%m-%d{}%H:%M:%S.%f', '%Y-%m-%d{}%H:%M:%S', '%Y-%m-%d{}%H:%M')
+
+    def _fromisoformat(text):
+        layouts = [layout.format(sep) for layout in ISO_LAYOUTS for sep in ' T'] + ['%Y-%m-%d']
+        for layout in layouts:
+            try:
+                return dt.strptime(text, layout)
+            except ValueError:
+                continue
+        raise ValueError('Invalid isoformat string: {!r}'.format(text))
+
+
+def parse_time(text, reference_ns):
+    """
+    Turn an ISO date/time or a bare HH:MM[:SS] into ns since the epoch.
+
+    Bare times are taken on the local date of reference_ns.  Raises
+    ValueError for anything else.
+    """
+    try:
+        moment = _fromisoformat(text)
+    except ValueError:
+        day = dt.fromtimestamp(reference_ns / 1E9)
+        parts = text.split(':') + ['0', '0']
+        seconds = float(parts[2])
+        moment = day.replace(hour=int(parts[0]), minute=int(parts[1]), second=int(seconds),
+                             microsecond=int(seconds % 1 * 1E6))
+    return int(moment.timestamp() * 1E9)
+
+
+def main():
+    """Page through a capture file in the sniff hexdump layout."""
+    from .formatting import hexdump
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('capture', help='pcapng file written by sniff --write')
+    parser.add_argument('-s', '--start', type=int, default=0, help='First frame number to show.')
+    parser.add_argument('-n', '--count', type=int, help='Number of frames to show, all if omitted.')
+    parser.add_argument('-p', '--port', metavar='ALIAS', help='Only show frames of this port alias.')
+    parser.add_argument('--since', metavar='TIME', help='Only show frames from TIME on, ISO format or HH:MM[:SS].')
+    parser.add_argument('--until', metavar='TIME', help='Only show frames before TIME, ISO format or HH:MM[:SS].')
+    parser.add_argument('-a', '--ascii', action='store_true', help='Also display an ASCII column.')
+    parser.add_argument('-i', '--width', type=int, default=16, help='The number of bytes to display on one line. The default is 16.')
+    parser.add_argument('--info', action='store_true', help='Only print the number of frames per port.')
+    args = parser.parse_args()
+
+    with CaptureReader(args.capture) as reader:
+        if args.port is not None and args.port not in reader.interfaces:
+            parser.error('no port {} in {}, only {}'.format(args.port, args.capture, ', '.join(reader.interfaces)))
+        if args.info:
+            for port in reader.interfaces:
+                print('{}: {} frames'.format(port, len(reader.port_frames(port))))
+            return
+        reference = reader.timestamps[0] if len(reader) else 0
+        try:
+            since = parse_time(args.since, reference) if args.since else None
+            until = parse_time(args.until, reference) if args.until else None
+        except ValueError:
+            parser.error('--since and --until take an ISO date and time or HH:MM[:SS]')
+        stop = args.start + args.count if args.count is not None else None
+        out = sys.stdout
+        try:
+            for frame in reader.frames(args.start, stop, args.port, since, until):
+                out.write('#{0} {1}: {2}{3}\n'.format(
+                    frame.number, dt.fromtimestamp(frame.timestamp / 1E9).isoformat(' '),
+                    frame.port, ' (tx)' if frame.direction == DIRECTION_OUT else ''))
+                out.write(hexdump(frame.data, args.width, args.ascii))
+        except BrokenPipeError:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""
+Checksums and CRCs used by serial protocols.
+
+Every algorithm is a Checksum with a name used on the command line, e.g.
+"sendhex 01 03 00 00 00 0a +crc16modbus".  CRCs are table driven; the
+reflected 16 bit ones also keep a 65536 entry table so they consume two
+bytes per step, and CRC-16/CCITT and CRC-32 use the C implementations in
+binascii and zlib.  The *_many methods work through lists of frames
+with the per-frame lookups hoisted out of the loop, for fuzzing and
+batch replay.
+"""
+
+import binascii
+import operator
+import sys
+import zlib
+from array import array
+from collections import OrderedDict
+from functools import reduce
+
+
+class Checksum(object):
+    """A checksum of size bytes appended to a frame in byteorder."""
+    name = ''
+    size = 1
+    byteorder = 'big'
+
+    def compute(self, data):
+        """Return the checksum of data as an int."""
+        raise NotImplementedError
+
+    def digest(self, data):
+        """Return the checksum of data as the bytes sent on the wire."""
+        return self.compute(data).to_bytes(self.size, self.byteorder)
+
+    def apply(self, data):
+        """Return data with its checksum added."""
+        return bytes(data) + self.digest(data)
+
+    def verify(self, frame):
+        """True if frame ends with a valid checksum over the rest of it."""
+        if len(frame) < self.size:
+            return False
+        return self.digest(frame[:-self.size]) == bytes(frame[-self.size:])
+
+    def compute_many(self, frames):
+        compute = self.compute
+        return [compute(frame) for frame in frames]
+
+    def apply_many(self, frames):
+        digest = self.digest
+        return [bytes(frame) + digest(frame) for frame in frames]
+
+    def verify_many(self, frames):
+        """Return a list of booleans, one per frame."""
+        digest, size = self.digest, self.size
+        return [len(frame) >= size and digest(frame[:-size]) == bytes(frame[-size:])
+                for frame in frames]
+
+    def __str__(self):
+        return self.name
+
+
+def _reflect(value, width):
+    return int('{:0{}b}'.format(value, width)[::-1], 2)
+
+
+class Crc(Checksum):
+    """
+    Table driven CRC of 8 or 16 bits, described by the usual Rocksoft
+    parameters: width, polynomial, initial value, reflection and final xor.
+    """
+    def __init__(self, name, width, poly, init=0, reflect=False, xorout=0, byteorder='big'):
+        self.name = name
+        self.width = width
+        self.size = width // 8
+        self.poly = poly
+        self.init = init
+        self.reflect = reflect
+        self.xorout = xorout
+        self.byteorder = byteorder
+        self.mask = (1 << width) - 1
+        self._lookup = None
+        self._pairs = None
+
+    @property
+    def table(self):
+        """The 256 entry lookup table, built on first use to keep imports fast."""
+        if self._lookup is None:
+            self._lookup = self._table()
+        return self._lookup
+
+    def _table(self):
+        table = array('H' if self.width > 8 else 'B')
+        if self.reflect:
+            poly = _reflect(self.poly, self.width)
+            for byte in range(256):
+                crc = byte
+                for _ in range(8):
+                    crc = (crc >> 1) ^ poly if crc & 1 else crc >> 1
+                table.append(crc)
+        else:
+            top = 1 << (self.width - 1)
+            for byte in range(256):
+                crc = byte << (self.width - 8)
+                for _ in range(8):
+                    crc = ((crc << 1) ^ self.poly if crc & top else crc << 1) & self.mask
+                table.append(crc)
+        return table
+
+    def update(self, crc, data):
+        """Run more data through a CRC register, without the final xor."""
+        table = self.table
+        if self.reflect:
+            for byte in data:
+                crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+        else:
+            shift, mask = self.width - 8, self.mask
+            for byte in data:
+                crc = ((crc << 8) & mask) ^ table[((crc >> shift) ^ byte) & 0xFF]
+        return crc
+
+    def compute(self, data):
+        return self.update(self.init, data) ^ self.xorout
+
+
+class PairedCrc16(Crc):
+    """
+    Reflected 16 bit CRC that consumes two bytes per table lookup.
+
+    After two bytes a 16 bit register has been shifted out completely, so
+    the new register only depends on the register xor the little-endian
+    word and can be looked up in one 65536 entry table, built on first use.
+    """
+    def __init__(self, name, poly, init=0, xorout=0):
+        Crc.__init__(self, name, 16, poly, init, True, xorout, 'little')
+
+    def pairs(self):
+        if self._pairs is None:
+            table = self.table
+            step = [(value >> 8) ^ table[value & 0xFF] for value in range(65536)]
+            self._pairs = array('H', [step[value] for value in step])
+        return self._pairs
+
+    def update(self, crc, data):
+        even = len(data) & ~1
+        if even < 16 or sys.byteorder != 'little':
+            return Crc.update(self, crc, data)
+        pairs = self.pairs()
+        for word in memoryview(data)[:even].cast('B').cast('H'):
+            crc = pairs[crc ^ word]
+        return Crc.update(self, crc, data[even:])
+
+
+class HqxCrc16(Checksum):
+    """CRC-16 with polynomial 0x1021, not reflected, computed by binascii."""
+    size = 2
+
+    def __init__(self, name, init):
+        self.name = name
+        self.init = init
+
+    def compute(self, data):
+        return binascii.crc_hqx(data, self.init)
+
+
+class Crc32(Checksum):
+    """The CRC-32 of Ethernet and zip, computed by zlib."""
+    name = 'crc32'
+    size = 4
+    byteorder = 'little'
+
+    def compute(self, data):
+        return zlib.crc32(data)
+
+
+class Lrc(Checksum):
+    """Modbus ASCII longitudinal redundancy check: two's complement of the byte sum."""
+    name = 'lrc'
+
+    def compute(self, data):
+        return -sum(data) & 0xFF
+
+
+class Sum8(Checksum):
+    """Sum of all bytes modulo 256."""
+    name = 'sum8'
+
+    def compute(self, data):
+        return sum(data) & 0xFF
+
+
+class Xor8(Checksum):
+    """Xor of all bytes."""
+    name = 'xor'
+
+    def compute(self, data):
+        return reduce(operator.xor, bytes(data), 0)
+
+
+CRC16_MODBUS = PairedCrc16('crc16modbus', 0x8005, init=0xFFFF)
+CRC16_DNP = PairedCrc16('crc16dnp', 0x3D65, xorout=0xFFFF)
+
+
+class Dnp3Link(Checksum):
+    """
+    DNP3 link layer CRCs: one CRC-16/DNP after the 8 byte header and after
+    every block of up to 16 user data bytes.
+    """
+    name = 'dnp3'
+    size = 2
+    byteorder = 'little'
+
+    def compute(self, data):
+        return CRC16_DNP.compute(data)
+
+    def apply(self, data):
+        data = bytes(data)
+        digest = CRC16_DNP.digest
+        out = bytearray(data[:8])
+        out += digest(data[:8])
+        for start in range(8, len(data), 16):
+            block = data[start:start + 16]
+            out += block
+            out += digest(block)
+        return bytes(out)
+
+    def apply_many(self, frames):
+        return [self.apply(frame) for frame in frames]
+
+    def verify(self, frame):
+        frame = bytes(frame)
+        digest = CRC16_DNP.digest
+        if len(frame) < 10 or digest(frame[:8]) != frame[8:10]:
+            return False
+        for start in range(10, len(frame), 18):
+            block = frame[start:start + 18]
+            if len(block) < 3 or digest(block[:-2]) != block[-2:]:
+                return False
+        return True
+
+    def verify_many(self, frames):
+        verify = self.verify
+        return [verify(frame) for frame in frames]
+
+
+CHECKSUMS = OrderedDict((checksum.name, checksum) for checksum in (
+    Crc('crc8', 8, 0x07),
+    Crc('crc8maxim', 8, 0x31, reflect=True),
+    CRC16_MODBUS,
+    HqxCrc16('crc16ccitt', 0xFFFF),
+    HqxCrc16('crc16xmodem', 0),
+    PairedCrc16('crc16kermit', 0x1021),
+    CRC16_DNP,
+    Crc32(),
+    Lrc(),
+    Sum8(),
+    Xor8(),
+    Dnp3Link(),
+))
+
+
+def get_checksum(name):
+    """Return the checksum called name, raise ValueError listing the known ones."""
+    try:
+        return CHECKSUMS[name.lower()]
+    except KeyError:
+        raise ValueError('unknown checksum {}, expected one of {}'.format(name, ', '.join(CHECKSUMS)))
+
+
+def split_suffixes(text):
+    """
+    Split "+name" checksum suffixes off a line of hex.
+
+    Returns the text without them and the list of checksums, in order.
+    Raises ValueError for unknown names.
+    """
+    words = text.split()
+    suffixes = [get_checksum(word[1:]) for word in words if word.startswith('+')]
+    return ' '.join(word for word in words if not word.startswith('+')), suffixes
+
+
+def apply_all(data, checksums):
+    """Add each checksum in turn, each one covering the previous ones."""
+    for checksum in checksums:
+        data = checksum.apply(data)
+    return data
@@ -9,37 +9,41 @@
 # FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
 # details at <http://www.gnu.org/licenses/>.
 
+import sys
 from argparse import ArgumentParser as Argp
-from .commands import Commands
-from .application import start_app
+from collections import OrderedDict
+from importlib import import_module
 try:
     import better_exceptions
 except ImportError as err:
     pass
 
+# subcommand: (module with add_arguments() and run(), help); only the module
+# of the subcommand given is imported, the user interface only without one
+SUBCOMMANDS = OrderedDict([
+    ('run', ('runner', 'run prompt commands from a script without the user interface')),
+    ('proxy', ('proxy', 'bridge two serial devices or ptys and log or rewrite their traffic')),
+    ('fuzz', ('fuzz', 'send mutations of a frame and group the responses, headless')),
+    ('decode', ('decode', 'turn a capture file into hexdump or CSV text on every CPU')),
+    ('emulate', ('emulate', 'answer like a recorded device on a pty, from captures or the database')),
+])
+
 
 def main():
     """Start application but allow passing of commands that create sessions"""
-    # cmd = Commands()
-    # p = Argp(description='ctserial is a security professional\'s swiss army knife for interacting with raw serial devices')
-    # subp = p.add_subparsers(dest='session')
-    #
-    # # Connect
-    # p_conn = subp.add_parser('connect', help=cmd.do_connect.__doc__)
-    # p_conn.add_argument('device', type=str,
-    #                     help='open a /dev/... serial file or COM port')
-    # p_conn.add_argument('baudrate', nargs='?', type=int, default=9600, help='baudrate ')
-
-    # # Sniff
-    # p_sniff = subp.add_parser('sniff', help='')
-    # p_sniff.add_argument('', help='')
-
-    # # Proxy
-    # p_proxy = subp.add_parser('proxy', help=cmd.do_proxy.__doc__)
-    # p_proxy.add_argument('', help='')
-
-    # args = p.parse_args()
-    # start_app(args)
+    p = Argp(description='ctserial is a security professional\'s swiss army knife for interacting with raw serial devices')
+    subp = p.add_subparsers(dest='subcommand')
+    argv = sys.argv[1:]
+    for name, (module, help) in SUBCOMMANDS.items():
+        p_sub = subp.add_parser(name, help=help)
+        if argv[:1] == [name]:
+            import_module('.' + module, __package__).add_arguments(p_sub)
+
+    args = p.parse_args(argv)
+    if args.subcommand:
+        import_module('.' + SUBCOMMANDS[args.subcommand][0], __package__).run(args)
+        return
+    from .application import start_app
     start_app([])
 
 
@@ -9,15 +9,114 @@
 # FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
 # details at <http://www.gnu.org/licenses/>.
 
-import shlex
-import re
+import os
 import serial
-import serial.tools.list_ports
 import time
-from prompt_toolkit.application.current import get_app
-from prompt_toolkit.document import Document
-from tabulate import tabulate
-from os.path import expanduser
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from . import autobaud
+from .batch import BatchSender, load_frames, summarize, format_summary, write_results
+from .capture import CaptureReader
+from .checksum import CHECKSUMS, apply_all, split_suffixes
+from .formatting import table_format, parse_hex
+from .fuzz import fuzz_options, run_fuzz
+from .macros import MacroLibrary, parse_rows
+from .reader import SessionReader
+from .sessions import Connection
+from .response import COMPLETION_USAGE, parse_completion, read_response, clock
+from .search import DEFAULT_INDEX, SearchIndex, format_hit, parse_pattern
+from .stats import driver_counters
+from os.path import basename, expanduser
+
+
+BAUDRATES = ['300', '1200', '2400', '4800', '9600', '19200', '38400', '57600', '115200']
+OUTPUT_FORMATS = ['mixed', 'hex', 'ascii', 'utf-8']
+SEARCH_LIMIT = 100
+
+_device_cache = {'time': 0.0, 'devices': []}
+
+
+def serial_devices(max_age=2.0):
+    """Return the names of available serial devices, rescanned at most every max_age seconds."""
+    if time.time() - _device_cache['time'] > max_age:
+        import serial.tools.list_ports
+        _device_cache['devices'] = [x.device for x in serial.tools.list_ports.comports()]
+        _device_cache['time'] = time.time()
+    return _device_cache['devices']
+
+
+def session_names(cmd):
+    """Names of the running application's sessions, for completion."""
+    from prompt_toolkit.application.current import get_app
+    return list(get_app().sessions.connections)
+
+
+Argument = namedtuple('Argument', 'name complete optional')
+
+# complete file names; prompt_toolkit is only imported once the prompt completes
+PATH = 'path'
+
+
+def arg(name, complete=None, optional=False):
+    """
+    Describe one argument of a command.
+
+    complete is a list of words, a function taking the Commands instance and
+    returning words, a prompt_toolkit Completer, PATH for file names or None
+    for free text.
+    A name ending in '...' takes any number of words.
+    """
+    return Argument(name, complete, optional)
+
+
+def arguments(*args):
+    """Decorator attaching an argument schema to a do_ command."""
+    def decorate(func):
+        func.arguments = args
+        return func
+    return decorate
+
+
+CommandInfo = namedtuple('CommandInfo', 'name func doc arguments usage')
+
+
+class CommandRegistry(object):
+    """
+    Every do_ command of a Commands class, collected once.
+
+    Holds name, docstring and argument schema of each command and a single
+    completer for the prompt that completes command names and, after a
+    space, the current argument.  The completer is built on first use, so
+    running commands without a prompt does not import prompt_toolkit.
+    """
+    def __init__(self, commands):
+        self.commands = commands
+        self.info = OrderedDict()
+        for attr in sorted(dir(type(commands))):
+            if not attr.startswith('do_'):
+                continue
+            func = getattr(type(commands), attr)
+            args = getattr(func, 'arguments', ())
+            usage = ' '.join([attr[3:]] + ['[{}]'.format(a.name) if a.optional else '<{}>'.format(a.name)
+                                           for a in args])
+            self.info[attr[3:]] = CommandInfo(attr[3:], func, func.__doc__ or '', args, usage)
+        self._completer = None
+
+    @property
+    def completer(self):
+        if self._completer is None:
+            from .completer import CommandCompleter
+            self._completer = CommandCompleter(self)
+        return self._completer
+
+    def get(self, name):
+        return self.info.get(name.lower())
+
+    def names(self):
+        return list(self.info)
+
+    def meta_dict(self):
+        return OrderedDict((name, info.doc) for name, info in self.info.items())
 
 
 class Commands(object):
@@ -25,80 +124,215 @@ class Commands(object):
     # Each function that users can call must:
     #     - start with a do_
     #     - accept self, input_text, output_text, and event as params
-    #     - return a string to print, None, or False
+    #     - return output_text with new lines added, None, or False
+    # The prompt passes an empty output_text and appends what comes back
+    # to the scrollback of the output pane
     # Returning a False does nothing, forcing users to correct mistakes
+    # Decorate them with @arguments(...) to get argument completion
 
-    macro_hex = {}
+    macros = MacroLibrary()
+    captures = {}
+    command_line = ''
+    search_index = None
+    targets = None
+
+    def __init__(self):
+        self.registry = CommandRegistry(self)
 
     def execute(self, input_text, output_text, event):
         """Extract command and call appropriate function."""
+        # "@name command", "@a,b command" or "@all command" picks the sessions
+        self.targets = None
+        if input_text.startswith('@'):
+            target, _, input_text = input_text[1:].partition(' ')
+            self.targets = [t for t in target.split(',') if t]
+            if not input_text.strip():
+                return False
         parts = input_text.strip().split(maxsplit=1)
         command = parts[0].lower()
         if len(parts) == 2:
             arg = parts[1]
         else:
             arg = ''
-        try:
-            func = getattr(self, 'do_' + command)
-        except AttributeError:
+        info = self.registry.get(command)
+        if info is None:
             return False
-        return func(arg, output_text, event)
+        self.command_line = input_text.strip()
+        return info.func(self, arg, output_text, event)
 
 
     def commands(self):
-        commands = [a[3:] for a in dir(self.__class__) if a.startswith('do_')]
-        return commands
+        return self.registry.names()
 
 
     def meta_dict(self):
-        meta_dict = {}
-        for command in self.commands():
-            # TODO: find a better way to do this than eval
-            meta_dict[command] = eval('self.do_' + command + '.__doc__')
-        return meta_dict
+        return self.registry.meta_dict()
 
 
     def do_clear(self, input_text, output_text, event):
         """Clear the screen."""
+        event.app.scrollback.clear()
         return ''
 
 
+    @arguments(arg('device', lambda cmd: serial_devices()), arg('baudrate', BAUDRATES + ['auto'], optional=True),
+               arg('name', optional=True))
     def do_connect(self, input_text, output_text, event):
-        """Generate a session with a single serial device to interact with it."""
+        """Open a session with a serial device, several may be open at once; baudrate auto probes for it."""
         parts = input_text.split()
-        devices = [x.device for x in serial.tools.list_ports.comports()]
+        devices = serial_devices(max_age=0)
         if len(parts) > 0:
             device = parts[0]
-            if len(parts) > 1:
-                baudrate = parts[1]
-            else:
-                baudrate = 9600
-            if device in devices:
-                event.app.session = serial.Serial(
-                    port=device,
-                    baudrate=baudrate,
-                    parity=serial.PARITY_NONE,
-                    stopbits=serial.STOPBITS_ONE,
-                    bytesize=serial.EIGHTBITS)
-                # initiate a serial session and return success message
-                event.app.session.isOpen()
-                output_text += 'Connect session opened with {}\n'.format(device)
-                return output_text
+            # ptys and /dev/serial/by-id links are not enumerated but work fine
+            if device in devices or os.path.exists(device):
+                name = parts[2] if len(parts) > 2 else None
+                command = self.command_line
+                if len(parts) > 1 and parts[1] == 'auto':
+                    def probe():
+                        results = autobaud.detect(device)
+                        if results and results[0].score > 0:
+                            return self._open_session(event, device, results[0].setting, name, command)
+                        return 'Not enough traffic to detect a baudrate, using 9600\n' + \
+                            self._open_session(event, device, None, name, command)
+
+                    output_text += 'Probing {} for its baudrate\n'.format(device)
+                    return self._run_later(event, probe, output_text)
+                setting = None
+                if len(parts) > 1:
+                    setting = autobaud.Setting(int(parts[1]), 8, 'N', 1)
+                else:
+                    setting = autobaud.cached_setting(device)
+                    if setting:
+                        output_text += 'Using {} found by autobaud earlier\n'.format(autobaud.setting_str(setting))
+                return output_text + self._open_session(event, device, setting, name, command)
         # return list of devices if command incomplete or incorrect
         output_text += 'Valid devices: ' + ', '.join(devices) + '\n'
         return output_text
 
 
+    def _open_session(self, event, device, setting, name, command):
+        """Open device at setting (9600 8N1 if None) as session name, return the message."""
+        setting = setting or autobaud.Setting(9600, 8, 'N', 1)
+        session = serial.Serial(
+            port=device,
+            baudrate=setting.baudrate,
+            parity=setting.parity,
+            stopbits=setting.stopbits,
+            bytesize=setting.bytesize)
+        # initiate a serial session and return success message
+        session.isOpen()
+        sessions = event.app.sessions
+        name = name or sessions.unique_name(basename(device))
+        if sessions.get(name):
+            self._close_connection(event, sessions.get(name))
+        connection = Connection(name, session)
+        self._start_reader(event, connection)
+        if event.app.recorder:
+            connection.record_key = event.app.recorder.open_session(device, command)
+        sessions.add(connection)
+        return 'Connect session {} opened with {} at {}\n'.format(
+            name, device, autobaud.setting_str(setting))
+
+
+    @arguments(arg('device', lambda cmd: serial_devices(), optional=True), arg('apply', ['apply'], optional=True))
+    def do_autobaud(self, input_text, output_text, event):
+        """Detect baudrate and parity from traffic on a device or the current session, apply switches to it."""
+        parts = input_text.split()
+        apply = parts[-1:] == ['apply']
+        if apply:
+            parts = parts[:-1]
+        if len(parts) > 1:
+            return False
+        connection = None if parts else event.app.sessions.current
+        if not parts and connection is None:
+            output_text += 'Connect to a device first or name one\n'
+            return output_text
+
+        def probe():
+            text = ''
+            if parts:
+                results = autobaud.detect(parts[0])
+            else:
+                with connection.lock, connection.claim() as port:
+                    original = port.get_settings()
+                    try:
+                        results = autobaud.AutoBaud(port).run()
+                    finally:
+                        port.apply_settings(original)
+                    if apply and results and results[0].score > 0:
+                        setting = results[0].setting
+                        port.apply_settings(setting._asdict())
+                        autobaud.save_setting(connection.serial.port, results[0])
+                        text += 'Session {} switched to {}\n'.format(
+                            connection.name, autobaud.setting_str(setting))
+            if not results or results[0].score == 0:
+                return text + 'Not enough traffic to tell\n'
+            return text + autobaud.format_results(results)
+
+        return self._run_later(event, probe, output_text)
+
+
+    @arguments(arg('name', lambda cmd: ['all'] + session_names(cmd), optional=True))
     def do_close(self, input_text, output_text, event):
-        """Close a session."""
-        if type(event.app.session) != serial.Serial:
+        """Close the current session, a named one or all of them."""
+        names = input_text.split() or self.targets
+        try:
+            connections = event.app.sessions.resolve(names)
+        except KeyError as e:
+            output_text += 'Unknown session {}\n'.format(e)
+            return output_text
+        if not connections:
             output_text += 'Connect to a device first\n'
             return output_text
-        else:
-            device = event.app.session.port
-            event.app.session.close()
-            output_text += 'Session with {} closed.'.format(device) + '\n'
-            event.app.session = ''
+        for connection in connections:
+            self._close_connection(event, connection)
+            output_text += 'Session with {} closed.'.format(connection.serial.port) + '\n'
+        return output_text
+
+
+    @arguments(arg('name', session_names))
+    def do_use(self, input_text, output_text, event):
+        """Make a named session the one commands talk to."""
+        connection = event.app.sessions.get(input_text.strip())
+        if connection is None:
+            return False
+        event.app.sessions.current = connection
+        output_text += 'Using session {} on {}\n'.format(connection.name, connection.serial.port)
+        return output_text
+
+
+    def do_sessions(self, input_text, output_text, event):
+        """List open sessions, prefix any command with @name,... or @all to target them."""
+        sessions = event.app.sessions
+        if not len(sessions):
+            output_text += 'No open sessions\n'
+        for connection in sessions.connections.values():
+            mark = '* ' if connection is sessions.current else '  '
+            output_text += mark + str(connection) + '\n'
+        return output_text
+
+
+    @arguments(arg('reset', ['reset'], optional=True))
+    def do_stats(self, input_text, output_text, event):
+        """Show counters, rates and round trip percentiles of every session, or @name; reset zeroes them."""
+        if input_text.strip() not in ('', 'reset'):
+            return False
+        try:
+            connections = event.app.sessions.resolve(self.targets or ['all'])
+        except KeyError as e:
+            output_text += 'Unknown session {}\n'.format(e)
+            return output_text
+        if not connections:
+            output_text += 'No open sessions\n'
+        for connection in connections:
+            if input_text.strip() == 'reset':
+                connection.stats.reset()
+                output_text += 'Statistics of {} reset\n'.format(connection.name)
+                continue
+            output_text += connection.stats.format('{} ({})'.format(connection.name, connection.serial.port))
+            counters = driver_counters(connection.serial)
+            if counters:
+                output_text += '  driver ' + '  '.join('{} {}'.format(k, v) for k, v in counters.items()) + '\n'
         return output_text
 
 
@@ -111,8 +345,9 @@ class Commands(object):
         output_text += 'the prompt above, the output of which will appear in '
         output_text += 'this space.\n\n'
         table = []
-        for key, value in self.meta_dict().items():
-            table.append([key, value])
+        for info in self.registry.info.values():
+            table.append([info.usage, info.doc])
+        from tabulate import tabulate
         output_text += tabulate(table, tablefmt="plain") + '\n'
         output_text += '==============================================\n'
         return output_text
@@ -126,93 +361,477 @@ class Commands(object):
 
     def do_exit(self, input_text, output_text, event):
         """Exit the application."""
-        if type(event.app.session) == serial.Serial:
-            event.app.session.close()
+        for connection in list(event.app.sessions.connections.values()):
+            self._close_connection(event, connection)
+        event.app.sessions.close()
+        if event.app.recorder:
+            event.app.recorder.close()
+        if self.search_index is not None:
+            self.search_index.save()
+        event.app.scrollback.close()
         event.app.exit()
         output_text += 'Closing application and all sessions.\n'
         return output_text
 
 
-    def _send_instruction(self, session, tx_bytes):
-        """Send data to serial device"""
+    def _record(self, event, connection, tx_bytes, rx_bytes, rtt, command):
+        """Queue a transaction of command for the database, this never blocks."""
+        app = event.app
+        if app.recorder and app.recording and connection.record_key:
+            app.recorder.record(connection.record_key, tx_bytes, rx_bytes, rtt, command)
+
+
+    def _close_connection(self, event, connection):
+        event.app.sessions.remove(connection.name)
+        if event.app.recorder and connection.record_key:
+            event.app.recorder.close_session(connection.record_key)
+
+
+    def _targets(self, event):
+        """
+        Return the connections the current command should talk to.
+
+        Raises KeyError naming an unknown session.
+        """
+        return event.app.sessions.resolve(self.targets)
+
+
+    def _start_reader(self, event, connection):
+        app = event.app
+        prefix = connection.name + ' <<< '
+
+        def on_frame(timestamp, frame):
+            connection.stats.unsolicited += 1
+            connection.stats.frame(len(frame))
+            app.post_output(self._format_output(frame, app.output_format, prefix=prefix) + '\n')
+
+        gap = app.completion.gap if app.completion.gap is not None else 0.02
+        connection.reader = SessionReader(connection.serial, on_frame, gap, connection.stats)
+
+
+    def _send_instruction(self, session, tx_bytes, completion):
+        """Send data to serial device, return the response and round trip time"""
         # clear out any leftover data
+        if session.in_waiting > 0:
+            session.reset_input_buffer()
+        start = clock()
+        session.write(tx_bytes)
+        rx_raw, last = read_response(session, completion)
+        return rx_raw, last - start
+
+
+    def _exchange(self, event, connection, tx_bytes, command):
+        """Run one transaction on a connection, return rx bytes, round trip and error text."""
         try:
-            if session.inWaiting() > 0:
-                session.flushInput()
-            session.write(tx_bytes)
-            time.sleep(0.1)
-            rx_raw = bytes()
-            while session.inWaiting() > 0:
-                rx_raw += session.read()
-        except BaseException as e:
-            output = '\n\n{}'.format(e)
-        time.sleep(0.1)
-        return rx_raw
+            with connection.lock, connection.claim() as port:
+                timestamp = datetime.now()
+                rx_bytes, rtt = self._send_instruction(port, tx_bytes, event.app.completion)
+        except serial.SerialException as e:
+            connection.stats.errors += 1
+            return b'', None, str(e)
+        rtt = rtt if rx_bytes else None
+        connection.note(timestamp, tx_bytes, rx_bytes, rtt)
+        self._record(event, connection, tx_bytes, rx_bytes, rtt, command)
+        return rx_bytes, rtt, None
+
+
+    def _run_later(self, event, func, output_text):
+        """
+        Append the text func() returns.  An application that sets background
+        gets func run on the session pool instead, so the interface keeps
+        responding, and its text (or error) posted once it is done.
+        """
+        app = event.app
+        if not getattr(app, 'background', False):
+            return output_text + func()
+
+        def done(future):
+            error = future.exception()
+            app.post_output(future.result() if error is None else '{}\n'.format(error))
+
+        app.sessions.submit(func).add_done_callback(done)
+        return output_text
+
+
+    def _run_sessions(self, event, connections, func, report, output_text):
+        """
+        Call func(connection) for every connection and append the text of
+        report(connection, result), see _run_later() for background
+        applications.
+        """
+        def text(connection, result):
+            label = '[{}]\n'.format(connection.name) if len(connections) > 1 else ''
+            return label + report(connection, result)
+
+        app = event.app
+        if getattr(app, 'background', False):
+            for connection in connections:
+                self._run_later(event, lambda connection=connection: text(connection, func(connection)), '')
+            return output_text
+        for connection, result in zip(connections, app.sessions.map(func, connections)):
+            output_text += text(connection, result)
+        return output_text
+
+
+    def _transact(self, tx_bytes, output_text, event):
+        """Send tx_bytes to the targeted sessions and append both sides to the output."""
+        try:
+            connections = self._targets(event)
+        except KeyError as e:
+            output_text += 'Unknown session {}\n'.format(e)
+            return output_text
+        if not connections:
+            output_text += 'Connect to a device first\n'
+            return output_text
+        command = self.command_line
+
+        def report(connection, result):
+            rx_bytes, rtt, error = result
+            if error:
+                return error + '\n'
+            text = self._format_output(tx_bytes, event.app.output_format, prefix='--> ') + '\n'
+            text += self._format_output(rx_bytes, event.app.output_format, prefix='<-- ') + '\n'
+            if rx_bytes:
+                return text + 'Round trip {:.1f} ms\n'.format(rtt * 1E3)
+            return text + 'No response within {:g} s\n'.format(event.app.completion.timeout)
+
+        return self._run_sessions(event, connections,
+                                  lambda connection: self._exchange(event, connection, tx_bytes, command),
+                                  report, output_text)
 
 
     def _format_output(self, raw_bytes, output_format, prefix=''):
         """ Return hex and utf-8 decodes aligned on two lines """
-        if len(raw_bytes) == 0:
-            return prefix + 'None'
-        table = []
-        if output_format == 'hex' or output_format == 'mixed':
-            hex_out = [prefix] + list(bytes([x]).hex() for x in raw_bytes)
-            table.append(hex_out)
-        if output_format == 'ascii' or output_format == 'mixed':
-            ascii_out = [' ' * len(prefix)] + list(raw_bytes.decode('ascii', 'replace'))
-            table.append(ascii_out)
-        if output_format == 'utf-8':
-            # TODO: track \xefbfdb and replace with actual sent character
-            utf8 = raw_bytes.decode('utf-8', 'replace')
-            utf8_hex_out = [prefix] + list(x.encode('utf-8').hex() for x in utf8)
-            utf8_str_out = [' ' * len(prefix)] + list(utf8)
-            table = [utf8_hex_out, utf8_str_out]
-        return tabulate(table, tablefmt="plain", stralign='right')
+        return table_format(raw_bytes, output_format, prefix)
+
+
+    @arguments(arg('file', PATH), arg('first', optional=True), arg('count', optional=True))
+    def do_capture(self, input_text, output_text, event):
+        """Page through the frames of a sniff capture."""
+        parts = input_text.split()
+        if len(parts) == 0 or len(parts) > 3:
+            return False
+        path = expanduser(parts[0])
+        try:
+            start = int(parts[1]) if len(parts) > 1 else 0
+            count = int(parts[2]) if len(parts) > 2 else 20
+        except ValueError:
+            return False
+        try:
+            reader = self._open_capture(path)
+        except (OSError, ValueError) as e:
+            output_text += '{}\n'.format(e)
+            return output_text
+        output_text += 'Frames {} to {} of {} in {}\n'.format(
+            start, min(start + count, len(reader)) - 1, len(reader), path)
+        for frame in reader.frames(start, start + count):
+            output_text += '#{} {} {}\n'.format(
+                frame.number, datetime.fromtimestamp(frame.timestamp / 1E9).isoformat(' '), frame.port)
+            output_text += self._format_output(frame.data, event.app.output_format) + '\n'
+        return output_text
 
 
+    def _open_capture(self, path):
+        """
+        The CaptureReader of path, opened again if the file changed since,
+        so frames written after the first open show up.  Raises OSError or
+        ValueError and then forgets the capture.
+        """
+        reader = self.captures.get(path)
+        if reader is not None and not reader.changed():
+            return reader
+        if reader is not None:
+            del self.captures[path]
+            reader.close()
+        self.captures[path] = CaptureReader(path)
+        return self.captures[path]
+
+
+    @arguments(arg('pattern'))
+    def do_search(self, input_text, output_text, event):
+        """Find hex (?? any byte, * any run) in recorded transactions and opened captures."""
+        try:
+            parse_pattern(input_text)
+        except ValueError as e:
+            output_text += '{}\n'.format(e)
+            return output_text
+        # the headless runner's recorder may have no database behind it
+        model = getattr(event.app.recorder, 'model', None)
+        if self.search_index is None:
+            self.search_index = SearchIndex(DEFAULT_INDEX if model else None)
+        index = self.search_index
+        if model:
+            index.update_from_database(model)
+        for path in list(self.captures):
+            try:
+                index.update_from_capture(self._open_capture(path))
+            except (OSError, ValueError) as e:
+                output_text += '{}\n'.format(e)
+        hits = list(index.search(input_text, limit=SEARCH_LIMIT + 1))
+        for hit in hits[:SEARCH_LIMIT]:
+            output_text += format_hit(hit) + '\n'
+        if len(hits) > SEARCH_LIMIT:
+            output_text += 'Showing the first {} hits\n'.format(SEARCH_LIMIT)
+        output_text += '{} payloads searched\n'.format(len(index))
+        return output_text
+
+
+    @arguments(arg('hex...', lambda cmd: ['+' + name for name in CHECKSUMS]))
     def do_sendhex(self, input_text, output_text, event):
-        """Send raw hex to serial device."""
-        if type(event.app.session) != serial.Serial:
+        """Send raw hex to serial device, +NAME suffixes append checksums (e.g. +crc16modbus)."""
+        try:
+            text, checksums = split_suffixes(input_text)
+        except ValueError as e:
+            output_text += '{}\n'.format(e)
+            return output_text
+        tx_bytes = parse_hex(text)
+        if tx_bytes is None:
+            return False
+        return self._transact(apply_all(tx_bytes, checksums), output_text, event)
+
+    @arguments(arg('file', PATH), arg('window', optional=True),
+               arg('interval', optional=True), arg('results', PATH, optional=True))
+    def do_sendfile(self, input_text, output_text, event):
+        """Send every frame in a file, optionally pipelined and paced (ms)."""
+        try:
+            connections = self._targets(event)
+        except KeyError as e:
+            output_text += 'Unknown session {}\n'.format(e)
+            return output_text
+        if not connections:
             output_text += 'Connect to a device first\n'
             return output_text
-        data = input_text.lower().replace("0x", "")
-        if re.match('^[0123456789abcdef\\\\x ]+$', data):
-            raw_hex = re.sub('[\\\\x ]', '', data)
-            if len(raw_hex) % 2 == 0:
-                tx_bytes = bytes.fromhex(raw_hex)
-                session = event.app.session
-                rx_bytes = self._send_instruction(session, tx_bytes)
-                output_text += self._format_output(tx_bytes, event.app.output_format, prefix='--> ') + '\n'
-                output_text += self._format_output(rx_bytes, event.app.output_format, prefix='<-- ') + '\n'
+        parts = input_text.split()
+        if len(parts) == 0 or len(parts) > 4:
+            return False
+        try:
+            window = int(parts[1]) if len(parts) > 1 else 1
+            interval = float(parts[2]) / 1E3 if len(parts) > 2 else 0.0
+            frames = load_frames(expanduser(parts[0]))
+        except (OSError, ValueError) as e:
+            output_text += '{}\n'.format(e)
+            return output_text
+        results_path = expanduser(parts[3]) if len(parts) > 3 else None
+        return self._send_batch(frames, window, interval, results_path, connections, output_text, event)
+
+
+    def _send_batch(self, frames, window, interval, results_path, connections, output_text, event):
+        """Send frames to each connection with a BatchSender and append the summaries."""
+        command = self.command_line
+
+        def run(connection):
+            start = clock()
+            try:
+                with connection.lock, connection.claim() as port:
+                    sender = BatchSender(port, event.app.completion, window, interval)
+                    results = sender.run(frames, lambda r: (
+                        connection.note(datetime.now(), r.tx, r.rx, r.rtt),
+                        self._record(event, connection, r.tx, r.rx, r.rtt, command)))
+            except serial.SerialException as e:
+                connection.stats.errors += 1
+                return None, str(e)
+            return results, format_summary(summarize(results, clock() - start))
+
+        def report(connection, outcome):
+            results, text = outcome
+            if results is None:
+                return text + '\n'
+            if results_path:
+                path = results_path
+                if len(connections) > 1:
+                    path += '.' + connection.name
+                write_results(path, results)
+                text += 'Results written to {}\n'.format(path)
+            return text
+
+        return self._run_sessions(event, connections, run, report, output_text)
+
+
+    @arguments(arg('count'), arg('hex...', lambda cmd: cmd.macros.names() + ['+' + name for name in CHECKSUMS]))
+    def do_fuzz(self, input_text, output_text, event):
+        """Send COUNT mutations of hex or a macro, +NAME keeps that checksum valid."""
+        try:
+            connections = self._targets(event)
+        except KeyError as e:
+            output_text += 'Unknown session {}\n'.format(e)
+            return output_text
+        if not connections:
+            output_text += 'Connect to a device first\n'
+            return output_text
+        parts = input_text.split(maxsplit=1)
+        if len(parts) != 2 or not parts[0].isdigit():
+            return False
+        count, seed_text = int(parts[0]), parts[1]
+        try:
+            seed_text, checksums = split_suffixes(seed_text)
+        except ValueError as e:
+            output_text += '{}\n'.format(e)
+            return output_text
+        if seed_text in self.macros:
+            try:
+                seed = self.macros.get(seed_text).expand()
+            except ValueError as e:
+                output_text += '{}\n'.format(e)
                 return output_text
-        return False
+        else:
+            seed = parse_hex(seed_text)
+        if seed is None or len(checksums) > 1:
+            return False
+        options = fuzz_options(checksum=checksums[0].name if checksums else None)
+        seed = apply_all(seed, checksums)
+        command = self.command_line
+
+        def run(connection):
+            def on_result(number, result):
+                connection.note(datetime.now(), result.tx, result.rx, result.rtt)
+                self._record(event, connection, result.tx, result.rx, result.rtt, command)
+            try:
+                with connection.lock, connection.claim() as port:
+                    # mutations are made inline, forking a process pool from a process
+                    # with reader and recorder threads running is not safe
+                    return run_fuzz(port, seed, count, options, event.app.completion,
+                                    workers=0, on_result=on_result)
+            except serial.SerialException as e:
+                connection.stats.errors += 1
+                return str(e)
+
+        def report(connection, outcome):
+            if isinstance(outcome, str):
+                return outcome + '\n'
+            groups, summary = outcome
+            return format_summary(summary) + groups.format()
+
+        return self._run_sessions(event, connections, run, report, output_text)
+
 
-    def do_setmacro(self, input_text, output_text, evnt):
-        v1 = input_text[: input_text.find(' ')]
-        v2 = input_text[input_text.find(' '): ]
-        self.macro_hex[v1] = v2
-        output_text += "key " + v1 + " set to value " + v2 + "\n"
+    @arguments(arg('strategy', ['gap', 'terminator', 'length', 'field', 'framer', 'timeout'], optional=True))
+    def do_response(self, input_text, output_text, event):
+        """Set how the end of a response is detected: gap, terminator, length, field or framer."""
+        completion = event.app.completion
+        try:
+            if input_text.startswith('timeout'):
+                completion.timeout = float(input_text.split(maxsplit=1)[1])
+            elif input_text.strip():
+                completion = parse_completion(input_text, completion.timeout)
+        except (ValueError, IndexError):
+            output_text += 'Usage: response [{} | timeout SECONDS]\n'.format(COMPLETION_USAGE)
+            return output_text
+        event.app.completion = completion
+        output_text += 'Response ends on {}\n'.format(completion)
+        return output_text
+
+    @arguments(arg('name', lambda cmd: cmd.macros.names()), arg('template...'))
+    def do_setmacro(self, input_text, output_text, event):
+        """Store a frame template for sendmacro: hex, {name:u8|u16|u32[le][=default|=+]} slots, +checksums."""
+        parts = input_text.split(maxsplit=1)
+        if len(parts) != 2:
+            return False
+        try:
+            macro = self.macros.define(parts[0], parts[1])
+        except ValueError as e:
+            output_text += '{}\n'.format(e)
+            return output_text
+        output_text += 'Macro {} set, {} bytes {}\n'.format(macro.name, macro.size, macro.signature())
         return output_text
 
+    @arguments(arg('name', lambda cmd: cmd.macros.names()), arg('values...', optional=True))
     def do_sendmacro(self, input_text, output_text, event):
-        macro = self.macro_hex[input_text]
-        if macro:
-            return self.do_sendhex(macro, output_text, event)
-        output_text += 'Unknown macro\n'
+        """Send a macro; values go in order or as NAME=VALUE, a range A-B sends one frame per value."""
+        parts = input_text.split()
+        if not parts:
+            return False
+        if parts[0] not in self.macros:
+            output_text += 'Unknown macro {}\n'.format(parts[0])
+            return output_text
+        macro = self.macros.get(parts[0])
+        try:
+            frames = macro.expand_many(parse_rows(macro, parts[1:]))
+        except ValueError as e:
+            output_text += '{}\n'.format(e)
+            return output_text
+        if len(frames) == 1:
+            return self._transact(frames[0], output_text, event)
+        try:
+            connections = self._targets(event)
+        except KeyError as e:
+            output_text += 'Unknown session {}\n'.format(e)
+            return output_text
+        if not connections:
+            output_text += 'Connect to a device first\n'
+            return output_text
+        return self._send_batch(frames, 1, 0.0, None, connections, output_text, event)
+
+    @arguments(arg('name', lambda cmd: cmd.macros.names()))
+    def do_delmacro(self, input_text, output_text, event):
+        """Forget a macro."""
+        try:
+            self.macros.remove(input_text.strip())
+        except KeyError:
+            output_text += 'Unknown macro {}\n'.format(input_text.strip())
+            return output_text
+        output_text += 'Macro {} removed\n'.format(input_text.strip())
+        return output_text
+
+    def do_macros(self, input_text, output_text, event):
+        """List the stored macros and their parameters."""
+        table = [[macro.name, macro.size, macro.signature(), macro.source] for macro in self.macros]
+        if not table:
+            output_text += 'No macros, define one with setmacro\n'
+            return output_text
+        from tabulate import tabulate
+        output_text += tabulate(table, headers=['name', 'bytes', 'parameters', 'template']) + '\n'
         return output_text
 
+    @arguments(arg('state', ['on', 'off'], optional=True))
+    def do_record(self, input_text, output_text, event):
+        """Turn recording of transactions into the database on or off."""
+        state = input_text.strip().lower()
+        if state not in ('', 'on', 'off'):
+            return False
+        if getattr(event.app.recorder, 'filename', None) is None:
+            output_text += 'Recording is not available\n'
+            return output_text
+        if state:
+            event.app.recording = state == 'on'
+        output_text += 'Recording to {} is {}\n'.format(
+            event.app.recorder.filename, 'on' if event.app.recording else 'off')
+        return output_text
+
+    @arguments(arg('option', ['lines', 'chars', 'spill'], optional=True))
+    def do_scrollback(self, input_text, output_text, event):
+        """Limit the output pane by lines N, chars N or spill FILE|off."""
+        parts = input_text.split()
+        if len(parts) % 2:
+            return False
+        scrollback = event.app.scrollback
+        for option, value in zip(parts[::2], parts[1::2]):
+            if option == 'lines' and value.isdigit():
+                scrollback.set_limits(max_lines=int(value))
+            elif option == 'chars' and value.isdigit():
+                scrollback.set_limits(max_chars=int(value))
+            elif option == 'spill':
+                scrollback.spill_to(None if value == 'off' else expanduser(value))
+            else:
+                return False
+        output_text += 'Scrollback holds {}\n'.format(scrollback)
+        return output_text
+
+    @arguments(arg('format', OUTPUT_FORMATS))
+    def do_format(self, input_text, output_text, event):
+        """Set the output format: mixed, hex, ascii or utf-8."""
+        if input_text.strip() not in OUTPUT_FORMATS:
+            return False
+        event.app.output_format = input_text.strip()
+        output_text += 'Output format set to {}\n'.format(event.app.output_format)
+        return output_text
+
+    @arguments(arg('text'))
     def do_send(self, input_text, output_text, event):
         """Send string to serial device."""
-        if type(event.app.session) != serial.Serial:
-            output_text += 'Connect to a device first\n'
-            return output_text
         if len(input_text) > 0:
             # remove spaces not in quotes and format
+            import shlex
             string = ''.join(shlex.split(input_text))
             tx_bytes = bytes(string, encoding='utf-8')
-            session = event.app.session
-            rx_bytes = self._send_instruction(session, tx_bytes)
-            output_text += self._format_output(tx_bytes, event.app.output_format, prefix='--> ') + '\n'
-            output_text += self._format_output(rx_bytes, event.app.output_format, prefix='<-- ') + '\n'
-            return output_text
+            return self._transact(tx_bytes, output_text, event)
         return False
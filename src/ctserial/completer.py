@@ -0,0 +1,60 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""Prompt completion for the commands, kept apart so headless runs never import prompt_toolkit."""
+
+from prompt_toolkit.completion import Completer, Completion, PathCompleter
+from prompt_toolkit.document import Document
+
+from .commands import PATH
+
+PATH_COMPLETER = PathCompleter(expanduser=True)
+
+
+class CommandCompleter(Completer):
+    """Complete command names first, then arguments from the registry's schemas."""
+    def __init__(self, registry):
+        self.registry = registry
+
+    def get_completions(self, document, complete_event):
+        text = document.text_before_cursor.lstrip()
+        words = text.split()
+        if not words or (len(words) == 1 and not text.endswith(' ')):
+            word = words[0].lower() if words else ''
+            for name, info in self.registry.info.items():
+                if name.startswith(word):
+                    yield Completion(name, -len(word), display_meta=info.doc)
+            return
+        info = self.registry.get(words[0])
+        if info is None:
+            return
+        if text.endswith(' '):
+            position, word = len(words) - 1, ''
+        else:
+            position, word = len(words) - 2, words[-1]
+        if info.arguments and info.arguments[-1].name.endswith('...'):
+            position = min(position, len(info.arguments) - 1)
+        if position >= len(info.arguments):
+            return
+        complete = info.arguments[position].complete
+        if complete is None:
+            return
+        if complete is PATH:
+            complete = PATH_COMPLETER
+        if isinstance(complete, Completer):
+            for completion in complete.get_completions(Document(word, len(word)), complete_event):
+                yield completion
+            return
+        if callable(complete):
+            complete = complete(self.registry.commands)
+        for candidate in complete:
+            if candidate.lower().startswith(word.lower()):
+                yield Completion(candidate, -len(word))
@@ -0,0 +1,252 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""
+Decode a capture file into text, using every CPU.
+
+The main process only walks the block headers of the pcapng file and cuts
+it into byte ranges of about CHUNK_SIZE that start and end on block
+boundaries, so every chunk holds whole frames.  Worker processes map the
+file, split, check and format the frames of a chunk, and the chunks are
+written out in capture order as they come back.  At most two chunks per
+worker are in flight, so memory use does not depend on the capture size.
+
+Output is the sniff hexdump layout or CSV; with a protocol framer every
+captured frame is split again on protocol boundaries, and with a checksum
+every frame is marked ok or BAD.
+"""
+
+import argparse
+import csv
+import io
+import mmap
+import os
+import struct
+import sys
+from collections import deque
+from datetime import datetime as dt
+
+from .capture import (BLOCK_EPB, BLOCK_IDB, BLOCK_SHB, BYTE_ORDER_MAGIC, DIRECTION_OUT,
+                      interface_block, packet_block)
+from .checksum import CHECKSUMS, get_checksum
+from .formatting import hexdump
+from .framing import FRAMER_USAGE, parse_framer
+
+CHUNK_SIZE = 1 << 20
+FORMATS = ('hexdump', 'csv')
+CSV_HEADER = ('frame', 'time', 'port', 'direction', 'length', 'data', 'checksum')
+
+
+class DecodeOptions(object):
+    """What to do with every frame, passed to the workers."""
+    def __init__(self, output_format='hexdump', width=16, show_ascii=False,
+                 port=None, framer=None, checksum=None):
+        self.output_format = output_format
+        self.width = width
+        self.show_ascii = show_ascii
+        self.port = port
+        self.framer = framer
+        self.checksum = checksum
+
+
+def chunks(buf, size, chunk_size=CHUNK_SIZE):
+    """
+    Yield (start, end, first frame number, interfaces) for consecutive
+    ranges of whole blocks of a mapped capture; interfaces are the
+    (name, tsresol) pairs declared before start.  A block that is cut off
+    at the end of the file, e.g. one still being written, ends the walk.
+    Pages already walked are handed back so the map does not stay resident.
+    """
+    unpack = struct.unpack_from
+    release = getattr(buf, 'madvise', None)
+    interfaces = []
+    start = offset = number = first = walked = 0
+    while offset + 12 <= size:
+        block_type, length = unpack('<II', buf, offset)
+        if length < 12 or offset + length > size:
+            break
+        if block_type == BLOCK_EPB:
+            number += 1
+        elif block_type == BLOCK_IDB:
+            interfaces.append(interface_block(buf, offset, length, len(interfaces)))
+        elif block_type == BLOCK_SHB and unpack('<I', buf, offset + 8)[0] != BYTE_ORDER_MAGIC:
+            raise ValueError('only little endian pcapng is supported')
+        offset += length
+        if offset - start >= chunk_size:
+            yield start, offset, first, tuple(interfaces)
+            if release is not None:
+                released, walked = walked, offset - offset % mmap.PAGESIZE
+                release(mmap.MADV_DONTNEED, released, walked - released)
+            start, first = offset, number
+    if offset > start:
+        yield start, offset, first, tuple(interfaces)
+
+
+def capture_ports(path):
+    """The port aliases a capture declares, walking only its block headers."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if size < 12 or struct.unpack_from('<I', buf, 0)[0] != BLOCK_SHB:
+                raise ValueError('{}: not a pcapng capture'.format(path))
+            interfaces = ()
+            for _, _, _, interfaces in chunks(buf, size, size):
+                pass
+    return [name for name, _ in interfaces]
+
+
+def _hexdump_records(out, records, options):
+    for number, timestamp, port, direction, frame, valid in records:
+        header = '#{0} {1}: {2}{3}'.format(number, dt.fromtimestamp(timestamp / 1E9).isoformat(' '),
+                                           port, ' (tx)' if direction == DIRECTION_OUT else '')
+        if valid is not None:
+            header += ' {0} {1}'.format(options.checksum, 'ok' if valid else 'BAD')
+        out.write(header + '\n')
+        out.write(hexdump(frame, options.width, options.show_ascii))
+
+
+def _csv_records(out, records, options):
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerows((number, dt.fromtimestamp(timestamp / 1E9).isoformat(' '), port,
+                      'tx' if direction == DIRECTION_OUT else 'rx', len(frame), frame.hex(),
+                      '' if valid is None else 'ok' if valid else 'BAD')
+                     for number, timestamp, port, direction, frame, valid in records)
+
+
+WRITERS = {'hexdump': _hexdump_records, 'csv': _csv_records}
+
+
+def decode_chunk(path, start, end, number, interfaces, options):
+    """Return the formatted frames of one chunk as utf-8, run in worker processes."""
+    names = [name for name, _ in interfaces]
+    tsresol = [resolution for _, resolution in interfaces]
+    framer = parse_framer(options.framer) if options.framer else None
+    checksum = get_checksum(options.checksum) if options.checksum else None
+    unpack = struct.unpack_from
+    records = []
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        offset = start
+        while offset < end:
+            block_type, length = unpack('<II', buf, offset)
+            if block_type == BLOCK_EPB:
+                port, timestamp, direction, caplen = packet_block(buf, offset, length, tsresol)
+                if options.port is None or names[port] == options.port:
+                    data = buf[offset + 28:offset + 28 + caplen]
+                    if framer is None:
+                        frames = [data]
+                    else:
+                        frames = framer.feed(data)
+                        if framer.pending:
+                            frames.append(framer.flush())
+                    for frame in frames:
+                        valid = checksum.verify(frame) if checksum else None
+                        records.append((number, timestamp, names[port], direction, frame, valid))
+                number += 1
+            elif block_type == BLOCK_IDB:
+                name, resolution = interface_block(buf, offset, length, len(names))
+                names.append(name)
+                tsresol.append(resolution)
+            offset += length
+    out = io.StringIO()
+    WRITERS[options.output_format](out, records, options)
+    return out.getvalue().encode('utf-8')
+
+
+def decode(path, options, workers=None, chunk_size=CHUNK_SIZE):
+    """
+    Yield the output of a capture chunk by chunk, in capture order.
+
+    With workers other than 0 chunks are decoded by a process pool that is
+    kept two chunks per worker ahead of the consumer.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if size < 12 or struct.unpack_from('<I', buf, 0)[0] != BLOCK_SHB:
+                raise ValueError('{}: not a pcapng capture'.format(path))
+            tasks = chunks(buf, size, chunk_size)
+            if workers == 0:
+                for task in tasks:
+                    yield decode_chunk(path, *task, options=options)
+                return
+            # multiprocessing is slow to import, only pay for it when decoding
+            from concurrent.futures import ProcessPoolExecutor
+            workers = workers or os.cpu_count() or 1
+            with ProcessPoolExecutor(workers) as pool:
+                futures = deque()
+                for task in tasks:
+                    futures.append(pool.submit(decode_chunk, path, *task, options=options))
+                    if len(futures) >= 2 * workers:
+                        break
+                while futures:
+                    text = futures.popleft().result()
+                    task = next(tasks, None)
+                    if task is not None:
+                        futures.append(pool.submit(decode_chunk, path, *task, options=options))
+                    yield text
+
+
+def add_arguments(parser):
+    parser.add_argument('capture', help='pcapng file written by sniff --write or proxy')
+    parser.add_argument('-o', '--output', metavar='FILE', help='write to FILE instead of stdout')
+    parser.add_argument('--format', choices=FORMATS, default='hexdump', help='sniff hexdump blocks, or CSV rows with the data as hex')
+    parser.add_argument('-p', '--port', metavar='ALIAS', help='Only decode frames of this port alias.')
+    parser.add_argument('-f', '--framer', metavar='FRAMER', help='Split every captured frame with a protocol framer, one of: {}.'.format(FRAMER_USAGE))
+    parser.add_argument('-c', '--checksum', metavar='NAME', help='Mark every frame ok or BAD by its trailing checksum, one of: {}.'.format(', '.join(CHECKSUMS)))
+    parser.add_argument('-a', '--ascii', action='store_true', help='Also display an ASCII column.')
+    parser.add_argument('-i', '--width', type=int, default=16, help='The number of bytes to display on one line. The default is 16.')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='decoding processes, 0 decodes inline, default one per CPU')
+    parser.add_argument('--chunk', type=int, default=CHUNK_SIZE >> 10, metavar='KB', help='capture bytes per unit of work')
+
+
+def run(args):
+    """Decode a capture from parsed command line arguments."""
+    try:
+        if args.framer:
+            parse_framer(args.framer)
+        if args.checksum:
+            get_checksum(args.checksum)
+        ports = capture_ports(args.capture) if args.port is not None else None
+    except (OSError, ValueError) as e:
+        sys.exit(str(e))
+    if ports is not None and args.port not in ports:
+        sys.exit('{}: no port {}, only {}'.format(args.capture, args.port, ', '.join(ports)))
+    options = DecodeOptions(args.format, args.width, args.ascii, args.port, args.framer, args.checksum)
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        if args.format == 'csv':
+            out.write((','.join(CSV_HEADER) + '\n').encode('utf-8'))
+        for text in decode(args.capture, options, args.workers, args.chunk << 10):
+            out.write(text)
+        out.flush()
+    except BrokenPipeError:
+        pass
+    except (OSError, ValueError) as e:
+        sys.exit(str(e))
+    except KeyboardInterrupt:
+        sys.exit(1)
+    finally:
+        if args.output:
+            out.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    add_arguments(parser)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
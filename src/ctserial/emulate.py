@@ -0,0 +1,311 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""
+Emulate a device on a pty from its recorded traffic.
+
+Requests of recorded transactions or of a capture are kept in a dict by
+their bytes, so answering a request is a hash lookup no matter how much
+was recorded.  Masked byte offsets, e.g. a sequence number, are zeroed
+before hashing; where a recorded response repeated the masked bytes of
+its request, the live request's bytes are copied into it.  A request
+recorded with several responses gets them in turn, in recorded order.
+With a checksum given, masked requests are matched without their
+trailing checksum and it is recomputed for responses that were changed.
+Responses go out after the recorded response time, multiplied by a scale
+factor.
+
+    python -m ctserial.emulate -c site.pcapng -p hmi --mask 0-1
+"""
+
+import argparse
+import os
+import signal
+import sys
+
+from .capture import CaptureReader, DIRECTION_OUT
+from .checksum import CHECKSUMS, get_checksum
+from .framing import FRAMER_USAGE, parse_framer
+from .virtual import Behavior, VirtualDevice, clock
+
+# a buffered request that saw no byte for this long and matched nothing is dropped
+DEFAULT_GAP = 0.05
+
+
+def parse_offsets(text):
+    """Byte offsets from a list like 0-1,6 as a sorted tuple."""
+    offsets = set()
+    for part in text.split(','):
+        first, dash, last = part.partition('-')
+        first = int(first, 0)
+        last = int(last, 0) if dash else first
+        if first < 0 or last < first:
+            raise ValueError('bad offset range {}'.format(part))
+        offsets.update(range(first, last + 1))
+    return tuple(sorted(offsets))
+
+
+class ResponseIndex(object):
+    """
+    Recorded responses by request.
+
+    Every entry is [next response, [(response, delay, echoed offsets)]]
+    with the responses in recorded order; lengths holds the distinct
+    request lengths, longest first, for finding requests at the start of
+    a buffer of several pipelined ones.
+    """
+    def __init__(self, mask=(), checksum=None):
+        self.mask = tuple(mask)
+        self.checksum = checksum
+        self.entries = {}
+        self.lengths = []
+        self.responses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, request):
+        """
+        The request with its masked bytes zeroed and, as they cover the
+        masked bytes, without a trailing checksum if there is one.
+        """
+        if not self.mask:
+            return bytes(request)
+        if self.checksum is not None:
+            request = request[:-self.checksum.size]
+        key = bytearray(request)
+        for offset in self.mask:
+            if offset >= len(key):
+                break
+            key[offset] = 0
+        return bytes(key)
+
+    def add(self, request, response, delay=None):
+        """Index one recorded transaction; delay is its response time in seconds."""
+        request, response = bytes(request), bytes(response)
+        echo = tuple(offset for offset in self.mask
+                     if offset < len(request) and offset < len(response) and response[offset] == request[offset])
+        key = self.key(request)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = [0, []]
+            if len(request) not in self.lengths:
+                self.lengths.append(len(request))
+                self.lengths.sort(reverse=True)
+        entry[1].append((response, delay or 0.0, echo))
+        self.responses += 1
+
+    def lookup(self, request):
+        """Return (response, delay) for a live request, None if it was never recorded."""
+        entry = self.entries.get(self.key(request))
+        if entry is None:
+            return None
+        responses = entry[1]
+        response, delay, echo = responses[entry[0] % len(responses)]
+        entry[0] += 1
+        if echo:
+            response = bytearray(response)
+            for offset in echo:
+                response[offset] = request[offset]
+            if self.checksum is not None:
+                response = self.checksum.apply(bytes(response[:-self.checksum.size]))
+            response = bytes(response)
+        return response, delay
+
+    def match(self, buffer):
+        """Return (request length, response, delay) for the request buffer starts with, or None."""
+        for length in self.lengths:
+            if length <= len(buffer):
+                answer = self.lookup(buffer[:length])
+                if answer is not None:
+                    return (length,) + answer
+        return None
+
+    def load_capture(self, reader, request_port=None):
+        """
+        Index a CaptureReader: a request is a frame on request_port (the
+        first port by default), its response everything the other ports
+        received until the next request.  Returns the transactions added.
+        """
+        request_port = request_port or reader.interfaces[0]
+        if request_port not in reader.interfaces:
+            raise ValueError('no port {}, only {}'.format(request_port, ', '.join(reader.interfaces)))
+        added, request, response = 0, None, []
+        for frame in reader.frames():
+            if frame.direction == DIRECTION_OUT:
+                # written by a proxy, the frame it received is captured too
+                continue
+            if frame.port == request_port:
+                if request is not None and response:
+                    self.add(request.data, b''.join(response), delay)
+                    added += 1
+                request, response = frame, []
+            elif request is not None:
+                if not response:
+                    delay = (frame.timestamp - request.timestamp) / 1E9
+                response.append(frame.data)
+        if request is not None and response:
+            self.add(request.data, b''.join(response), delay)
+            added += 1
+        return added
+
+    def load_database(self, model, session=None):
+        """
+        Index recorded transactions with a response, of all sessions or of
+        the one with this id or name.  Returns the transactions added.
+        """
+        with model.db_session:
+            if session is None:
+                query = model.select((t.id, t.tx, t.rx, t.rtt) for t in model.Transaction)
+            elif session.isdigit():
+                number = int(session)
+                query = model.select((t.id, t.tx, t.rx, t.rtt) for t in model.Transaction
+                                     if t.session.id == number)
+            else:
+                query = model.select((t.id, t.tx, t.rx, t.rtt) for t in model.Transaction
+                                     if t.session.session == session)
+            rows = [(tx, rx, rtt) for _, tx, rx, rtt in query.order_by(1) if rx]
+        for tx, rx, rtt in rows:
+            self.add(tx, rx, rtt)
+        return len(rows)
+
+
+class Emulator(Behavior):
+    """
+    Answer requests from a ResponseIndex.
+
+    With a framer every frame it splits off is a request; otherwise the
+    received bytes are matched against the recorded request lengths, so
+    requests sent back to back are answered one by one.  Bytes that are no
+    request yet are dropped as a miss after a gap of silence, or without a
+    framer once they are longer than any request.
+    Answers keep the order of their requests.
+    """
+    def __init__(self, index, scale=1.0, framer=None, gap=DEFAULT_GAP, log=None):
+        self.index = index
+        self.scale = scale
+        self.framer = framer
+        self.gap = gap
+        self.log = log
+        self.buffer = bytearray()
+        self.last_byte = 0.0
+        self.ready = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def received(self, device, data):
+        now = clock()
+        stale = now - self.last_byte > self.gap
+        self.last_byte = now
+        if self.framer is not None:
+            if stale and self.framer.pending:
+                self._miss(self.framer.flush())
+            for frame in self.framer.feed(data):
+                answer = self.index.lookup(frame)
+                if answer is None:
+                    self._miss(frame)
+                else:
+                    self._answer(device, now, frame, *answer)
+            return
+        if stale and self.buffer:
+            self._miss(self.buffer)
+            self.buffer = bytearray()
+        self.buffer += data
+        while self.buffer:
+            found = self.index.match(self.buffer)
+            if found is None:
+                break
+            length, response, delay = found
+            self._answer(device, now, self.buffer[:length], response, delay)
+            del self.buffer[:length]
+        if self.buffer and len(self.buffer) >= self.index.lengths[0]:
+            self._miss(self.buffer)
+            self.buffer = bytearray()
+
+    def _answer(self, device, now, request, response, delay):
+        self.hits += 1
+        self.ready = max(self.ready, now + delay * self.scale)
+        device.send(response, self.ready - now)
+        if self.log:
+            self.log.write('{} -> {}\n'.format(bytes(request).hex(), response.hex()))
+            self.log.flush()
+
+    def _miss(self, request):
+        self.misses += 1
+        if self.log:
+            self.log.write('{} -> no recorded response\n'.format(bytes(request).hex()))
+            self.log.flush()
+
+
+def add_arguments(parser):
+    parser.add_argument('-c', '--capture', metavar='FILE', action='append', default=[], help='Learn from a pcapng capture of sniff or proxy. Use multiple times for more captures.')
+    parser.add_argument('-p', '--request-port', metavar='ALIAS', help='Port alias of the requests in captures, the first port by default.')
+    parser.add_argument('-d', '--database', metavar='FILE', help='Learn from the transactions recorded in this database, the default ~/.ctserial/ctserial.sqlite when no capture is given.')
+    parser.add_argument('-s', '--session', metavar='ID|NAME', help='Only use the transactions of this recorded session.')
+    parser.add_argument('-m', '--mask', metavar='OFFSETS', help='Request byte offsets to ignore, e.g. 0-1 for a Modbus TCP transaction id; copied into responses that repeated them.')
+    parser.add_argument('-k', '--checksum', metavar='NAME', help='Frames end in this checksum: requests are matched without it and it is recomputed for responses changed by --mask. One of: {}.'.format(', '.join(CHECKSUMS)))
+    parser.add_argument('-f', '--framer', metavar='FRAMER', help='Split requests with a protocol framer instead of the recorded request lengths, one of: {}.'.format(FRAMER_USAGE))
+    parser.add_argument('-x', '--scale', type=float, default=1.0, metavar='FACTOR', help='Multiply recorded response times, 0 answers at once. The default is 1.')
+    parser.add_argument('-g', '--gap', type=float, default=DEFAULT_GAP * 1E3, metavar='MS', help='Drop unmatched bytes after this much silence.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print every request and its answer to stderr.')
+
+
+def run(args):
+    """Serve a recorded device on a pty from parsed command line arguments."""
+    try:
+        mask = parse_offsets(args.mask) if args.mask else ()
+        checksum = get_checksum(args.checksum) if args.checksum else None
+        framer = parse_framer(args.framer) if args.framer else None
+    except ValueError as e:
+        sys.exit(str(e))
+    index = ResponseIndex(mask, checksum)
+    for path in args.capture:
+        try:
+            with CaptureReader(path) as reader:
+                added = index.load_capture(reader, args.request_port)
+        except (OSError, ValueError) as e:
+            sys.exit('{}: {}'.format(path, e))
+        sys.stderr.write('{}: {} transactions\n'.format(path, added))
+    if args.database or args.session or not args.capture:
+        from . import model
+        from .recorder import DEFAULT_DATABASE
+        database = os.path.expanduser(args.database or DEFAULT_DATABASE)
+        if not os.path.exists(database):
+            sys.exit('{}: no such database'.format(database))
+        model.bind(database)
+        added = index.load_database(model, args.session)
+        sys.stderr.write('{}: {} transactions\n'.format(database, added))
+    if not len(index):
+        sys.exit('nothing recorded to answer with')
+    sys.stderr.write('{} requests with {} responses\n'.format(len(index), index.responses))
+
+    emulator = Emulator(index, args.scale, framer, args.gap / 1E3, sys.stderr if args.verbose else None)
+    device = VirtualDevice(emulator)
+    print('pty ready at {}'.format(device.path))
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        device.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        device.close()
+        sys.stderr.write('answered {}, unknown {}\n'.format(emulator.hits, emulator.misses))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    add_arguments(parser)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""Hex and ASCII conversions shared by sniff, batch and the interactive prompt."""
+
+import re
+import unicodedata
+
+PRINTABLE = b'0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~'
+
+# byte value -> two digit hex string
+HEX_TABLE = tuple('{:02X}'.format(i) for i in range(256))
+
+# sniff ascii column: anything not in PRINTABLE becomes a dot
+ASCII_TABLE = bytes(i if i in PRINTABLE else ord('.') for i in range(256))
+
+# prompt ascii row: spaces stay, control characters become a dot and bytes
+# above 0x7f are left alone so decoding them as ascii yields U+FFFD
+TEXT_TABLE = bytes(i if i in PRINTABLE or i == 0x20 or i > 0x7f else ord('.') for i in range(256))
+
+try:
+    b''.hex(' ')
+except TypeError:
+    # python < 3.8 has no separator argument for bytes.hex()
+    def hex_format(chunk):
+        """Return upper case hex bytes separated by single spaces."""
+        return ' '.join([HEX_TABLE[byte] for byte in chunk])
+
+    def _spaced_hex(chunk, sep):
+        return sep.join([HEX_TABLE[byte].lower() for byte in chunk])
+else:
+    def hex_format(chunk):
+        """Return upper case hex bytes separated by single spaces."""
+        return chunk.hex(' ').upper()
+
+    def _spaced_hex(chunk, sep):
+        return chunk.hex(' ').replace(' ', sep)
+
+
+def parse_hex(text):
+    """
+    Turn user supplied hex into bytes, None if it is not valid hex.
+
+    Spaces, 0x and \\x separators are ignored, so "de ad", "0xdead" and
+    "\\xde\\xad" are all the same two bytes.
+    """
+    data = text.lower().replace("0x", "")
+    if re.match('^[0123456789abcdef\\\\x ]+$', data):
+        raw_hex = re.sub('[\\\\x ]', '', data)
+        if len(raw_hex) % 2 == 0:
+            return bytes.fromhex(raw_hex)
+    return None
+
+
+def ascii_format(chunk):
+    """Return the printable characters of chunk with a dot for anything else."""
+    return bytes(chunk).translate(ASCII_TABLE).decode('ascii')
+
+
+def hexdump(frame, width=16, show_ascii=False):
+    """Return frame as sniff output lines of width bytes each."""
+    hex_text = hex_format(frame)
+    if show_ascii:
+        ascii_text = ascii_format(frame)
+    step = width * 3
+    lines = []
+    for line_num, start in enumerate(range(0, len(frame), width)):
+        line = hex_text[line_num*step:line_num*step + step - 1]
+        if show_ascii:
+            line = line.ljust(step) + ' ' + ascii_text[start:start+width]
+        lines.append(line)
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def _cwidth(char):
+    return 2 if unicodedata.east_asian_width(char) in 'WF' else 1
+
+
+def table_format(raw_bytes, output_format, prefix=''):
+    """
+    Return bytes in the prompt's aligned column layout.
+
+    output_format is one of mixed, hex, ascii or utf-8.  Each byte (or
+    character for utf-8) gets its own right aligned column, two spaces apart,
+    with prefix in front of the first row.
+    """
+    if len(raw_bytes) == 0:
+        return prefix + 'None'
+    raw_bytes = bytes(raw_bytes)
+    prefix = prefix.strip()
+    if output_format == 'utf-8':
+        # TODO: track \xefbfdb and replace with actual sent character
+        hex_cells, str_cells = [prefix], [' ' * len(prefix)]
+        for char in raw_bytes.decode('utf-8', 'replace'):
+            cell = char.encode('utf-8').hex()
+            size = max(len(cell), _cwidth(char))
+            hex_cells.append(cell.rjust(size))
+            str_cells.append(' ' * (size - _cwidth(char)) + char)
+        return '  '.join(hex_cells) + '\n' + '  '.join(str_cells)
+    rows = []
+    if output_format == 'hex' or output_format == 'mixed':
+        rows.append(prefix + '  ' + _spaced_hex(raw_bytes, '  '))
+    if output_format == 'ascii' or output_format == 'mixed':
+        text = raw_bytes.translate(TEXT_TABLE).decode('ascii', 'replace')
+        if rows:
+            rows.append(' ' * len(prefix) + '   ' + '   '.join(text))
+        else:
+            rows.append('  ' + '  '.join(text))
+    return '\n'.join(rows)
@@ -0,0 +1,407 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""
+Incremental protocol framers.
+
+A framer is fed the bytes of a stream in whatever chunks they arrive and
+returns the complete frames found so far.  Each framer remembers how far it
+already looked, so every byte is examined once no matter how the stream is
+chunked; the buffer is only compacted once per feed.
+
+Framers are used by sniff to split traffic on protocol boundaries instead
+of timing gaps, and by FramerCompletion in the TUI to tell when a response
+is complete.
+"""
+
+from array import array
+
+from .checksum import CRC16_MODBUS
+
+SLIP_END = 0xC0
+SLIP_ESC = 0xDB
+SLIP_ESC_END = 0xDC
+SLIP_ESC_ESC = 0xDD
+
+MODBUS_MAX_FRAME = 256
+
+
+class Framer(object):
+    """
+    Base class: subclasses implement _split(), which yields (end, frame) for
+    every complete frame in self.buffer from self.start on and advances
+    self.start past it.  self.scan is free for subclasses to remember how
+    far they searched.
+    """
+    name = ''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Drop buffered bytes and start over at a frame boundary."""
+        self.buffer = bytearray()
+        self.start = 0
+        self.scan = 0
+        self.consumed = 0
+        self.errors = 0
+
+    @property
+    def pending(self):
+        """Number of buffered bytes that are not part of a complete frame yet."""
+        return len(self.buffer) - self.start
+
+    def feed(self, chunk):
+        """Add received bytes, return the list of frames they completed."""
+        return [frame for _, frame in self.feed_spans(chunk)]
+
+    def feed_spans(self, chunk):
+        """
+        Like feed() but return (end, frame) pairs, end being the stream
+        offset just past the frame's last raw byte.
+        """
+        self.buffer += chunk
+        spans = [(self.consumed + end, frame) for end, frame in self._split()]
+        if self.start:
+            del self.buffer[:self.start]
+            self.consumed += self.start
+            self.scan -= self.start
+            self.start = 0
+        return spans
+
+    def flush(self):
+        """Return the incomplete frame, if any, and forget it."""
+        leftover = bytes(self.buffer[self.start:])
+        self.consumed += len(self.buffer)
+        self.buffer = bytearray()
+        self.start = self.scan = 0
+        return leftover
+
+    def missing(self):
+        """Bytes still needed to complete the current frame, None if unknown."""
+        return None
+
+    def _split(self):
+        raise NotImplementedError
+
+    def __str__(self):
+        return self.name
+
+
+class DelimiterFramer(Framer):
+    """Frames end with a delimiter, e.g. b'\\r\\n'; strip drops it from frames."""
+    name = 'delimiter'
+
+    def __init__(self, delimiter, strip=False):
+        self.delimiter = bytes(delimiter)
+        self.strip = strip
+        Framer.__init__(self)
+
+    def _split(self):
+        buf, delimiter = self.buffer, self.delimiter
+        while True:
+            found = buf.find(delimiter, max(self.start, self.scan - len(delimiter) + 1))
+            if found < 0:
+                self.scan = len(buf)
+                return
+            end = found + len(delimiter)
+            frame = bytes(buf[self.start:found if self.strip else end])
+            self.start = self.scan = end
+            yield end, frame
+
+    def __str__(self):
+        return '{} {}'.format(self.name, self.delimiter.hex())
+
+
+class LengthPrefixFramer(Framer):
+    """
+    Frames carry their length in a header field of size bytes at offset.
+
+    A frame is the field value plus adjust bytes long, but never shorter
+    than its header; this matches LengthFieldCompletion.
+    """
+    name = 'prefix'
+
+    def __init__(self, offset=0, size=1, byteorder='big', adjust=0):
+        self.offset = offset
+        self.size = size
+        self.byteorder = byteorder
+        self.adjust = adjust
+        Framer.__init__(self)
+
+    def _length(self):
+        header = self.offset + self.size
+        if self.pending < header:
+            return None
+        field = self.buffer[self.start + self.offset:self.start + header]
+        return max(int.from_bytes(field, self.byteorder) + self.adjust, header)
+
+    def _split(self):
+        while True:
+            length = self._length()
+            if length is None or self.pending < length:
+                return
+            end = self.start + length
+            frame = bytes(self.buffer[self.start:end])
+            self.start = end
+            yield end, frame
+
+    def missing(self):
+        length = self._length()
+        if length is None:
+            return self.offset + self.size - self.pending
+        return max(0, length - self.pending)
+
+    def __str__(self):
+        return '{} {} {} {} {}'.format(self.name, self.offset, self.size, self.byteorder, self.adjust)
+
+
+def slip_encode(data):
+    """Escape data and wrap it in SLIP END bytes."""
+    data = bytes(data).replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc')
+    return b'\xc0' + data + b'\xc0'
+
+
+def slip_decode(data):
+    """Undo SLIP escaping of a frame without its END bytes."""
+    return bytes(data).replace(b'\xdb\xdc', b'\xc0').replace(b'\xdb\xdd', b'\xdb')
+
+
+class SlipFramer(Framer):
+    """SLIP (RFC 1055) frames, returned unescaped unless decode is False."""
+    name = 'slip'
+
+    def __init__(self, decode=True):
+        self.decode = decode
+        Framer.__init__(self)
+
+    def _split(self):
+        buf = self.buffer
+        while True:
+            found = buf.find(SLIP_END, max(self.start, self.scan))
+            if found < 0:
+                self.scan = len(buf)
+                return
+            end = found + 1
+            payload = buf[self.start:found]
+            frame_start, self.start, self.scan = self.start, end, end
+            if payload:
+                yield end, slip_decode(payload) if self.decode else bytes(buf[frame_start:end])
+
+
+def cobs_encode(data):
+    """Encode data with Consistent Overhead Byte Stuffing, without the trailing zero."""
+    out = bytearray()
+    for block in bytes(data).split(b'\x00'):
+        while len(block) >= 254:
+            out.append(0xFF)
+            out += block[:254]
+            block = block[254:]
+        out.append(len(block) + 1)
+        out += block
+    return bytes(out)
+
+
+def cobs_decode(data):
+    """Decode one COBS frame without its zero delimiter, raise ValueError if invalid."""
+    out = bytearray()
+    position, length = 0, len(data)
+    while position < length:
+        code = data[position]
+        if code == 0 or position + code > length:
+            raise ValueError('invalid COBS frame')
+        out += data[position + 1:position + code]
+        position += code
+        if code < 0xFF and position < length:
+            out.append(0)
+    return bytes(out)
+
+
+class CobsFramer(Framer):
+    """
+    COBS frames delimited by zero bytes, returned decoded unless decode is
+    False.  Frames that do not decode are returned raw and counted in errors.
+    """
+    name = 'cobs'
+
+    def __init__(self, decode=True):
+        self.decode = decode
+        Framer.__init__(self)
+
+    def _split(self):
+        buf = self.buffer
+        while True:
+            found = buf.find(0, max(self.start, self.scan))
+            if found < 0:
+                self.scan = len(buf)
+                return
+            end = found + 1
+            payload = bytes(buf[self.start:found])
+            frame_start, self.start, self.scan = self.start, end, end
+            if not payload:
+                continue
+            if not self.decode:
+                yield end, bytes(buf[frame_start:end])
+                continue
+            try:
+                yield end, cobs_decode(payload)
+            except ValueError:
+                self.errors += 1
+                yield end, payload
+
+
+# Modbus RTU frame lengths by function code: an int is a fixed length, a
+# tuple (index, size, extra) a byte count field of size bytes at index that
+# gives a length of count + extra.  Requests and responses are both listed,
+# whichever validates its CRC first wins.
+MODBUS_LENGTHS = {
+    1: (8, (2, 1, 5)),
+    2: (8, (2, 1, 5)),
+    3: (8, (2, 1, 5)),
+    4: (8, (2, 1, 5)),
+    5: (8,),
+    6: (8,),
+    7: (4, 5),
+    8: (8,),
+    11: (4, 8),
+    12: (4, (2, 1, 5)),
+    15: (8, (6, 1, 9)),
+    16: (8, (6, 1, 9)),
+    17: (4, (2, 1, 5)),
+    20: ((2, 1, 5),),
+    21: ((2, 1, 5),),
+    22: (10,),
+    23: ((10, 1, 13), (2, 1, 5)),
+    24: (6, (2, 2, 6)),
+}
+
+
+class ModbusRtuFramer(Framer):
+    """
+    Modbus RTU frames, found by function code length rules and a valid CRC.
+
+    The CRC is kept running over the current frame as bytes arrive, so a
+    candidate length is checked in constant time.  Function codes without
+    a length rule end at the first point the CRC matches.  When no
+    candidate can match any more the first byte is skipped and counted in
+    errors, which is the only time bytes are looked at again.
+    """
+    name = 'modbus'
+
+    def reset(self):
+        Framer.reset(self)
+        self.crcs = array('H', [0xFFFF])
+        self.checked = 4
+
+    def flush(self):
+        self.crcs = array('H', [0xFFFF])
+        self.checked = 4
+        return Framer.flush(self)
+
+    def _update_crcs(self, length):
+        """Extend the running CRC to cover the first length bytes of the frame."""
+        crcs, table = self.crcs, CRC16_MODBUS.table
+        crc = crcs[-1]
+        for byte in self.buffer[self.start + len(crcs) - 1:self.start + length]:
+            crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+            crcs.append(crc)
+
+    def _candidates(self):
+        """Return (known lengths, whether every candidate length is known)."""
+        buf, start = self.buffer, self.start
+        function = buf[start + 1]
+        if function & 0x80:
+            return [5], True
+        rules = MODBUS_LENGTHS.get(function)
+        if rules is None:
+            return None, False
+        lengths, complete = [], True
+        for rule in rules:
+            if isinstance(rule, int):
+                lengths.append(rule)
+                continue
+            index, size, extra = rule
+            if self.pending < index + size:
+                complete = False
+                continue
+            lengths.append(int.from_bytes(buf[start + index:start + index + size], 'big') + extra)
+        return sorted(length for length in lengths if length <= MODBUS_MAX_FRAME), complete
+
+    def _match(self):
+        """Length of a complete frame at self.start, 0 to wait, -1 to resync."""
+        if self.pending < 4:
+            return 0
+        available = min(self.pending, MODBUS_MAX_FRAME)
+        lengths, complete = self._candidates()
+        self._update_crcs(available if lengths is None else max([0] + lengths))
+        crcs = self.crcs
+        if lengths is None:
+            for length in range(self.checked, available + 1):
+                if crcs[length] == 0:
+                    return length
+            self.checked = available + 1
+            return -1 if available >= MODBUS_MAX_FRAME else 0
+        for length in lengths:
+            if length <= available and crcs[length] == 0:
+                return length
+        if complete and all(length <= available for length in lengths):
+            return -1
+        return 0
+
+    def _split(self):
+        while True:
+            length = self._match()
+            if length == 0:
+                return
+            if length < 0:
+                self.errors += 1
+                self.start += 1
+            else:
+                end = self.start + length
+                frame = bytes(self.buffer[self.start:end])
+                self.start = end
+            self.crcs = array('H', [0xFFFF])
+            self.checked = 4
+            if length > 0:
+                yield end, frame
+
+    def missing(self):
+        return max(0, 4 - self.pending) or None
+
+
+FRAMER_USAGE = 'modbus | slip | cobs | delimiter HEX | prefix OFFSET [SIZE] [big|little] [ADJUST]'
+
+
+def parse_framer(text):
+    """
+    Build a framer from its text form, e.g. "modbus" or "delimiter 0d0a".
+
+    Raises ValueError with a usage hint if text is not understood.
+    """
+    parts = text.split()
+    try:
+        if parts == ['modbus']:
+            return ModbusRtuFramer()
+        if parts == ['slip']:
+            return SlipFramer()
+        if parts == ['cobs']:
+            return CobsFramer()
+        if len(parts) == 2 and parts[0] == 'delimiter':
+            return DelimiterFramer(bytes.fromhex(parts[1]))
+        if 2 <= len(parts) <= 5 and parts[0] == 'prefix' and parts[3:4] in ([], ['big'], ['little']):
+            return LengthPrefixFramer(
+                int(parts[1]),
+                int(parts[2]) if len(parts) > 2 else 1,
+                parts[3] if len(parts) > 3 else 'big',
+                int(parts[4]) if len(parts) > 4 else 0)
+    except ValueError:
+        pass
+    raise ValueError('expected ' + FRAMER_USAGE)
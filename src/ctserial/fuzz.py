@@ -0,0 +1,343 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""
+Mutation fuzzer for serial protocols.
+
+Mutations of a seed frame are generated ahead of time in chunks by a pool
+of worker processes and sent through BatchSender, so the link and the
+response strategy set the pace.  Mutation number n is always the same for
+a given seed and random seed, whichever process made it, so a run can be
+replayed.  Responses are grouped by signature and rare signatures and
+timeouts are flagged as anomalies.
+"""
+
+import argparse
+import os
+import random
+import sys
+from collections import OrderedDict, deque, namedtuple
+
+from .batch import BatchSender, format_summary, summarize
+from .checksum import CHECKSUMS, get_checksum
+from .formatting import parse_hex
+from .response import COMPLETION_USAGE, parse_completion, clock
+
+CHUNK_SIZE = 512
+SIGNATURE_PREFIX = 2
+ANOMALY_RATIO = 0.01
+SHOW_GROUPS = 20
+
+BOUNDARIES = {
+    1: (0x00, 0x01, 0x7F, 0x80, 0xFE, 0xFF),
+    2: (0x0000, 0x0001, 0x7FFF, 0x8000, 0xFFFE, 0xFFFF),
+    4: (0x00000000, 0x7FFFFFFF, 0x80000000, 0xFFFFFFFF),
+}
+
+
+def bitflip(frame, rng, options):
+    """Flip one to four random bits."""
+    for _ in range(rng.randint(1, 4)):
+        bit = rng.randrange(len(frame) * 8)
+        frame[bit >> 3] ^= 1 << (bit & 7)
+
+
+def random_byte(frame, rng, options):
+    """Overwrite a byte with a random value."""
+    frame[rng.randrange(len(frame))] = rng.randrange(256)
+
+
+def boundary(frame, rng, options):
+    """Overwrite a 1, 2 or 4 byte field with a boundary value."""
+    size = rng.choice((1, 2, 4))
+    position = rng.randrange(max(1, len(frame) - size + 1))
+    value = rng.choice(BOUNDARIES[size]).to_bytes(size, rng.choice(('big', 'little')))
+    frame[position:position + size] = value
+
+
+def length_lie(frame, rng, options):
+    """Make the length field disagree with the frame, or the frame with its length."""
+    if options.length_field:
+        offset, size = options.length_field
+        if len(frame) >= offset + size:
+            actual = len(frame)
+            value = rng.choice((0, actual - 1, actual + 1, 2 * actual, (1 << 8 * size) - 1))
+            frame[offset:offset + size] = (value % (1 << 8 * size)).to_bytes(size, 'big')
+            return
+    if len(frame) > 1 and rng.random() < 0.5:
+        del frame[rng.randrange(1, len(frame)):]
+    else:
+        frame += bytes(rng.randrange(256) for _ in range(rng.randint(1, 32)))
+
+
+def insert(frame, rng, options):
+    """Insert one to eight random bytes."""
+    position = rng.randrange(len(frame) + 1)
+    frame[position:position] = bytes(rng.randrange(256) for _ in range(rng.randint(1, 8)))
+
+
+def delete(frame, rng, options):
+    """Delete up to eight bytes, never the whole frame."""
+    if len(frame) > 1:
+        position = rng.randrange(len(frame))
+        del frame[position:position + rng.randint(1, min(8, len(frame) - 1))]
+
+
+MUTATORS = OrderedDict([
+    ('bitflip', bitflip),
+    ('byte', random_byte),
+    ('boundary', boundary),
+    ('length', length_lie),
+    ('insert', insert),
+    ('delete', delete),
+])
+
+FuzzOptions = namedtuple('FuzzOptions', 'mutators checksum length_field seed stack')
+
+
+def fuzz_options(mutators=None, checksum=None, length_field=None, seed=0, stack=2):
+    """
+    Bundle fuzzing settings, checking names; raises ValueError.
+
+    checksum names a checksum the seed ends in, it is stripped before and
+    recomputed after mutating.  length_field is (offset, size) of a big
+    endian length field for the length mutator.  Up to stack mutators are
+    applied to each frame.
+    """
+    mutators = tuple(mutators or MUTATORS)
+    for name in mutators:
+        if name not in MUTATORS:
+            raise ValueError('unknown mutator {}, expected some of {}'.format(name, ', '.join(MUTATORS)))
+    if checksum:
+        get_checksum(checksum)
+    return FuzzOptions(mutators, checksum, length_field, seed, max(1, stack))
+
+
+def mutate(seed, number, options):
+    """Return mutation number of seed, the same every time."""
+    rng = random.Random(options.seed * 1000003 + number)
+    checksum = get_checksum(options.checksum) if options.checksum else None
+    body = seed[:-checksum.size] if checksum else seed
+    frame = bytearray(body or b'\x00')
+    for _ in range(rng.randint(1, options.stack)):
+        if not frame:
+            frame.append(rng.randrange(256))
+        MUTATORS[rng.choice(options.mutators)](frame, rng, options)
+    return checksum.apply(frame) if checksum else bytes(frame)
+
+
+def generate_chunk(seed, start, stop, options):
+    """Return mutations start to stop-1, run in worker processes."""
+    return [mutate(seed, number, options) for number in range(start, stop)]
+
+
+def mutations(seed, count, options, workers=None, chunk=CHUNK_SIZE):
+    """
+    Yield count mutations of seed in order.
+
+    With workers other than 0 chunks are generated by a process pool that
+    is kept two chunks per worker ahead of the consumer.
+    """
+    if workers == 0:
+        for start in range(0, count, chunk):
+            for frame in generate_chunk(seed, start, min(count, start + chunk), options):
+                yield frame
+        return
+    # multiprocessing is slow to import, only pay for it when fuzzing
+    from concurrent.futures import ProcessPoolExecutor
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        ahead = 2 * workers
+        starts = iter(range(0, count, chunk))
+        futures = deque()
+        for start in starts:
+            futures.append(pool.submit(generate_chunk, seed, start, min(count, start + chunk), options))
+            if len(futures) >= ahead:
+                break
+        while futures:
+            frames = futures.popleft().result()
+            start = next(starts, None)
+            if start is not None:
+                futures.append(pool.submit(generate_chunk, seed, start, min(count, start + chunk), options))
+            for frame in frames:
+                yield frame
+
+
+class ResponseGroups(object):
+    """
+    Group responses by signature: length, first prefix bytes and, with a
+    checksum, whether it is valid.  No response at all is 'timeout'.
+    """
+    def __init__(self, prefix=SIGNATURE_PREFIX, checksum=None):
+        self.prefix = prefix
+        self.checksum = get_checksum(checksum) if checksum else None
+        self.groups = OrderedDict()
+        self.total = 0
+
+    def signature(self, rx):
+        if not rx:
+            return 'timeout'
+        signature = '{} bytes {}'.format(len(rx), rx[:self.prefix].hex())
+        if self.checksum:
+            signature += ' {} {}'.format(self.checksum, 'ok' if self.checksum.verify(rx) else 'bad')
+        return signature
+
+    def add(self, number, result):
+        """Count a Result, return its signature."""
+        signature = self.signature(result.rx)
+        group = self.groups.get(signature)
+        if group is None:
+            self.groups[signature] = group = [0, number, result]
+        group[0] += 1
+        self.total += 1
+        return signature
+
+    def anomalies(self, ratio=ANOMALY_RATIO):
+        """Signatures that are timeouts or make up at most ratio of responses."""
+        limit = max(1, ratio * self.total)
+        return [signature for signature, (count, _, _) in self.groups.items()
+                if signature == 'timeout' or count <= limit]
+
+    def format(self, ratio=ANOMALY_RATIO, limit=SHOW_GROUPS):
+        """One line per signature, most common first, anomalies marked with '!'."""
+        anomalies = set(self.anomalies(ratio))
+        groups = sorted(self.groups.items(), key=lambda g: -g[1][0])
+        lines = ['{} signatures, {} anomalous'.format(len(groups), len(anomalies))]
+        for signature, (count, number, result) in groups[:limit]:
+            lines.append('{} {:8d}  {:32s} first #{} tx {}'.format(
+                '!' if signature in anomalies else ' ', count, signature, number, result.tx.hex()))
+        if len(groups) > limit:
+            lines.append('  ... {} more'.format(len(groups) - limit))
+        return '\n'.join(lines) + '\n'
+
+
+def run_fuzz(session, seed, count, options, completion, window=1, interval=0.0,
+             workers=None, on_result=None, groups=None):
+    """
+    Fuzz an open session, return the ResponseGroups and a batch summary.
+
+    on_result(number, result) is called for every frame, e.g. to record it.
+    """
+    if groups is None:
+        groups = ResponseGroups(checksum=options.checksum)
+    numbers = iter(range(count))
+
+    def finish(result):
+        number = next(numbers)
+        groups.add(number, result)
+        if on_result:
+            on_result(number, result)
+
+    sender = BatchSender(session, completion, window, interval)
+    start = clock()
+    results = sender.run(mutations(seed, count, options, workers), finish)
+    return groups, summarize(results, clock() - start)
+
+
+def add_arguments(parser):
+    parser.add_argument('device', help='serial device to fuzz')
+    parser.add_argument('seed', help='hex of the frame to mutate, quoted if it has spaces, or the name of a stored macro')
+    parser.add_argument('-n', '--count', type=int, default=1000, help='number of mutations to send')
+    parser.add_argument('-b', '--baudrate', type=int, default=9600, help='The baudrate to open the serial port at.')
+    parser.add_argument('-m', '--mutators', default=','.join(MUTATORS), help='comma separated mutators to use, default all of them')
+    parser.add_argument('-c', '--checksum', metavar='NAME', help='the seed ends in this checksum, recompute it after mutating: {}'.format(', '.join(CHECKSUMS)))
+    parser.add_argument('-l', '--length-field', metavar='OFFSET[:SIZE]', help='big endian length field for the length mutator to lie in')
+    parser.add_argument('-s', '--stack', type=int, default=2, help='apply up to this many mutators to each frame')
+    parser.add_argument('--random-seed', type=int, default=0, help='seed of the mutation generator, reuse it to replay a run')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='mutation generating processes, 0 generates inline, default one per CPU')
+    parser.add_argument('-w', '--window', type=int, default=1, help='Frames sent ahead of their responses. Needs a response strategy other than gap.')
+    parser.add_argument('-i', '--interval', type=float, default=0.0, metavar='MS', help='Minimum time between two frames in milliseconds.')
+    parser.add_argument('-r', '--response', default='gap 20', metavar='STRATEGY', help='How the end of a response is detected: ' + COMPLETION_USAGE)
+    parser.add_argument('-t', '--timeout', type=float, default=0.2, metavar='SECONDS', help='Time to wait for each response.')
+    parser.add_argument('-d', '--database', metavar='FILE', help='transaction store to record into, default ~/.ctserial/ctserial.sqlite')
+    parser.add_argument('--no-record', action='store_true', help='do not record transactions')
+
+
+def parse_length_field(text):
+    offset, _, size = text.partition(':')
+    return int(offset), int(size or 1)
+
+
+def load_macro(model, name):
+    """Expand the macro stored in model as name with its defaults, None if there is none."""
+    from .macros import MacroLibrary
+    library = MacroLibrary()
+    library.attach(model)
+    if name not in library:
+        return None
+    return library.get(name).expand()
+
+
+def run(args):
+    """Run a headless fuzzing session from parsed command line arguments."""
+    import serial
+    from .recorder import DEFAULT_DATABASE, Recorder
+    seed = parse_hex(args.seed)
+    database = os.path.expanduser(args.database or DEFAULT_DATABASE)
+    if seed is None and args.no_record and not os.path.exists(database):
+        sys.exit('seed is neither hex nor a macro stored in {}'.format(database))
+    try:
+        options = fuzz_options(args.mutators.split(','), args.checksum,
+                               parse_length_field(args.length_field) if args.length_field else None,
+                               args.random_seed, args.stack)
+        completion = parse_completion(args.response, args.timeout)
+    except ValueError as e:
+        sys.exit(str(e))
+    try:
+        session = serial.Serial(args.device, baudrate=args.baudrate)
+    except serial.SerialException as e:
+        sys.exit(str(e))
+    recorder = key = None
+
+    def on_result(number, result):
+        if recorder:
+            recorder.record(key, result.tx, result.rx, result.rtt, 'fuzz #{}'.format(number))
+
+    try:
+        try:
+            if not args.no_record:
+                recorder = Recorder(database, on_error=sys.stderr.write)
+                model = recorder.model
+            elif seed is None:
+                from . import model
+                model.bind(database)
+            if seed is None:
+                seed = load_macro(model, args.seed)
+                if seed is None:
+                    sys.exit('seed is neither hex nor a macro stored in {}'.format(database))
+        except Exception as e:
+            sys.exit('{}: {}'.format(database, e))
+        if recorder:
+            key = recorder.open_session('fuzz ' + args.device, ' '.join(sys.argv))
+        groups, summary = run_fuzz(session, seed, args.count, options, completion, args.window,
+                                   args.interval / 1E3, args.workers, on_result)
+    except KeyboardInterrupt:
+        sys.exit(1)
+    finally:
+        session.close()
+        if recorder:
+            if key is not None:
+                recorder.close_session(key)
+            recorder.close()
+    sys.stdout.write(format_summary(summary))
+    sys.stdout.write(groups.format())
+    if recorder:
+        sys.stdout.write('Transactions recorded to {}\n'.format(recorder.filename))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    add_arguments(parser)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""
+Macros: named frame templates with parameter slots.
+
+A macro is hex with slots in braces and optional checksum suffixes:
+
+    01 03 {addr:u16} {count:u16=1} +crc16modbus
+    00 {tid:u16=+} 00 00 00 06 01 03 {addr:u16} 00 01
+
+A slot is {NAME[:TYPE][=DEFAULT]} with TYPE one of u8 (the default), u16
+or u32, big endian unless followed by le.  A default of + makes the slot a
+counter numbering the instances of a bulk expansion.
+
+Templates are parsed once into a struct.Struct whose constant pieces are
+prebuilt bytes, so an instance is one pack() call plus the checksums,
+and expand_many() turns thousands of parameter rows into frames without
+touching text.  A MacroLibrary keeps the compiled macros by name and
+stores their source in the model's Message table.
+"""
+
+import itertools
+import re
+import struct
+from collections import OrderedDict, namedtuple
+
+from .checksum import split_suffixes
+from .formatting import parse_hex
+
+SLOT_PATTERN = re.compile(r'^\{(\w+)(?::(u8|u16|u32)(le)?)?(?:=(\+|\d+|0x[0-9a-fA-F]+))?\}$')
+SLOT_SIZES = {'u8': 1, 'u16': 2, 'u32': 4}
+SLOT_CODES = {'u8': 'B', 'u16': 'H', 'u32': 'I'}
+
+Slot = namedtuple('Slot', 'name type size little default counter')
+
+
+def _little(size):
+    def convert(value):
+        return value.to_bytes(size, 'little')
+    return convert
+
+
+class Macro(object):
+    """A compiled frame template, see the module docstring for the syntax."""
+    def __init__(self, name, source, description=''):
+        self.name = name
+        self.source = source
+        self.description = description
+        text, self.checksums = split_suffixes(source)
+        self.slots = []
+        codes, args = ['>'], []
+        constant = bytearray()
+        for word in text.split():
+            match = SLOT_PATTERN.match(word)
+            if match is None:
+                data = parse_hex(word)
+                if data is None:
+                    raise ValueError('{}: neither hex nor a slot like {{addr:u16}}'.format(word))
+                constant += data
+                continue
+            if constant:
+                codes.append('{}s'.format(len(constant)))
+                args.append(bytes(constant))
+                constant = bytearray()
+            slot_name, slot_type, little, default = match.groups()
+            slot_type = slot_type or 'u8'
+            if slot_name in [slot.name for slot in self.slots]:
+                raise ValueError('slot {} is used twice'.format(slot_name))
+            size = SLOT_SIZES[slot_type]
+            counter = default == '+'
+            if default is not None and not counter:
+                default = int(default, 0)
+                if default >= 1 << (8 * size):
+                    raise ValueError('default of {} does not fit {}'.format(slot_name, slot_type))
+            self.slots.append(Slot(slot_name, slot_type, size, bool(little),
+                                   None if counter else default, counter))
+            codes.append('{}s'.format(size) if little else SLOT_CODES[slot_type])
+            args.append(None)
+        if constant:
+            codes.append('{}s'.format(len(constant)))
+            args.append(bytes(constant))
+        if len(codes) == 1:
+            raise ValueError('a macro needs some hex or a slot')
+        self.struct = struct.Struct(''.join(codes))
+        self.args = args
+        self.parameters = [slot for slot in self.slots if not slot.counter]
+        # (argument position, row index or None for a counter, counter mask, converter)
+        self.plan = []
+        positions = [i for i, a in enumerate(args) if a is None]
+        parameter = 0
+        for position, slot in zip(positions, self.slots):
+            index = None if slot.counter else parameter
+            parameter += not slot.counter
+            self.plan.append((position, index, (1 << 8 * slot.size) - 1,
+                              _little(slot.size) if slot.little else None))
+
+    @property
+    def size(self):
+        return self.struct.size + sum(checksum.size for checksum in self.checksums)
+
+    def parameter_index(self, name):
+        for index, slot in enumerate(self.parameters):
+            if slot.name == name:
+                return index
+        raise ValueError('{} has no parameter {}'.format(self.name, name))
+
+    def defaults(self):
+        """A row of the default values, raise ValueError if a parameter has none."""
+        missing = [slot.name for slot in self.parameters if slot.default is None]
+        if missing:
+            raise ValueError('{} needs a value for {}'.format(self.name, ', '.join(missing)))
+        return tuple(slot.default for slot in self.parameters)
+
+    def expand(self, row=None, number=0):
+        """One frame from a row of parameter values, number feeding the counters."""
+        return self.expand_many([self.defaults() if row is None else row], number)[0]
+
+    def expand_many(self, rows, start=0):
+        """
+        Frames for every row of parameter values, in order; counters count
+        from start.  Raises ValueError if a value does not fit its slot.
+        """
+        pack, base, plan = self.struct.pack, self.args, self.plan
+        frames, row = [], None
+        try:
+            for number, row in enumerate(rows, start):
+                args = base[:]
+                for position, index, mask, convert in plan:
+                    value = number & mask if index is None else row[index]
+                    args[position] = value if convert is None else convert(value)
+                frames.append(pack(*args))
+        except (struct.error, OverflowError, IndexError, TypeError) as e:
+            raise ValueError('{}: bad values {}: {}'.format(self.name, row, e))
+        for checksum in self.checksums:
+            frames = checksum.apply_many(frames)
+        return frames
+
+    def signature(self):
+        """The template's parameters for help and listings, e.g. addr:u16 count:u16=1."""
+        words = []
+        for slot in self.slots:
+            word = '{}:{}{}'.format(slot.name, slot.type, 'le' if slot.little else '')
+            if slot.counter:
+                word += '=+'
+            elif slot.default is not None:
+                word += '={}'.format(slot.default)
+            words.append(word)
+        words += ['+' + checksum.name for checksum in self.checksums]
+        return ' '.join(words)
+
+    def __str__(self):
+        return self.name
+
+
+def parse_value(text):
+    """A number, or an inclusive range A-B; returns a list of ints."""
+    first, dash, last = text.partition('-')
+    first = int(first, 0)
+    if not dash:
+        return [first]
+    last = int(last, 0)
+    if last < first:
+        raise ValueError('empty range {}'.format(text))
+    return list(range(first, last + 1))
+
+
+def parse_rows(macro, words):
+    """
+    Turn parameter words into rows for expand_many().
+
+    Words are values in parameter order or NAME=VALUE, a value being a
+    number or a range A-B; several ranges expand to every combination.
+    """
+    choices = [None] * len(macro.parameters)
+    for position, word in enumerate(words):
+        if '=' in word:
+            name, _, word = word.partition('=')
+            index = macro.parameter_index(name)
+        elif position < len(choices):
+            index = position
+        else:
+            raise ValueError('{} takes {} parameters'.format(macro.name, len(choices)))
+        choices[index] = parse_value(word)
+    for index, slot in enumerate(macro.parameters):
+        if choices[index] is None:
+            if slot.default is None:
+                raise ValueError('{} needs a value for {}'.format(macro.name, slot.name))
+            choices[index] = [slot.default]
+    return list(itertools.product(*choices))
+
+
+class MacroLibrary(object):
+    """
+    Compiled macros by name.
+
+    Without a model the library only lives in memory; attach() loads every
+    macro stored in the model's Message table and keeps it up to date.
+    """
+    def __init__(self):
+        self.macros = OrderedDict()
+        self.model = None
+
+    def __contains__(self, name):
+        return name in self.macros
+
+    def __iter__(self):
+        return iter(self.macros.values())
+
+    def names(self):
+        return sorted(self.macros)
+
+    def get(self, name):
+        """Return the macro called name, raise KeyError if there is none."""
+        return self.macros[name]
+
+    def attach(self, model):
+        """Store macros in model from now on and load the ones already there."""
+        self.model = model
+        with model.db_session:
+            stored = [(m.name, m.tx, m.description) for m in model.Message.select() if m.tx]
+        for name, source, description in stored:
+            try:
+                self.macros[name] = Macro(name, source, description)
+            except ValueError:
+                # written by a newer or older version, leave it in the table
+                continue
+
+    def define(self, name, source, description=''):
+        """Compile and store a macro, replacing one of the same name; raises ValueError."""
+        macro = Macro(name, source, description)
+        if self.model is not None:
+            m = self.model
+            with m.db_session:
+                m.Message.select(name=name).delete(bulk=True)
+                m.Message(name=name, tx=source, description=description)
+        self.macros[name] = macro
+        return macro
+
+    def remove(self, name):
+        """Forget a macro, raise KeyError if there is none."""
+        macro = self.macros.pop(name)
+        if self.model is not None:
+            m = self.model
+            with m.db_session:
+                m.Message.select(name=name).delete(bulk=True)
+        return macro
@@ -9,10 +9,13 @@
 # FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
 # details at <http://www.gnu.org/licenses/>.
 
+import os
 from datetime import datetime
 from pony.orm import *
 
 db = Database()
+# the sqlite file db is bound to
+filename = None
 
 class Command(db.Entity):
     id = PrimaryKey(int, auto=True)
@@ -23,18 +26,20 @@ class Command(db.Entity):
 class Session(db.Entity):
     id = PrimaryKey(int, auto=True)
     session = Required(str)
-    start = Required(datetime)
+    start = Required(datetime, index=True)
     end = Optional(datetime)
     command = Required(Command)
     transactions = Set('Transaction')
 
 class Transaction(db.Entity):
     id = PrimaryKey(int, auto=True)
-    tx = Required(str)
-    rx = Required(str)
-    timestamp = Required(datetime)
+    tx = Required(bytes)
+    rx = Required(bytes)
+    timestamp = Required(datetime, index=True)
+    rtt = Optional(float)
     session = Required(Session)
     command = Optional(Command)
+    composite_index(session, timestamp)
 
 class Setting(db.Entity):
     id = PrimaryKey(int, auto=True)
@@ -49,4 +54,11 @@ class Message(db.Entity):
     tx = Optional(str)
     decode = Optional(str)
 
-db.generate_mapping()
+def bind(path):
+    """Open (and create if needed) the sqlite database holding the entities."""
+    global filename
+    if db.provider is not None:
+        raise ValueError('the database is already bound to ' + db.provider_name)
+    db.bind(provider='sqlite', filename=path, create_db=True)
+    db.generate_mapping(create_tables=True)
+    filename = os.path.abspath(path)
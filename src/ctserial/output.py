@@ -0,0 +1,95 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""Bounded scrollback behind the output pane."""
+
+from collections import deque
+
+
+class Scrollback(object):
+    """
+    Ring buffer of output lines capped by line count and character count.
+
+    New text is appended line by line and the oldest lines are dropped once
+    either limit is exceeded, so the pane never holds more than the limits no
+    matter how long the session runs.  Dropped lines can be spilled to a file
+    instead of being lost.  The lines are the only copy of the text, text
+    joins them when it is asked for after a change, so appending and
+    trimming cost as much as the lines added or dropped.
+    """
+    def __init__(self, max_lines=10000, max_chars=2000000, spill_path=None):
+        self.max_lines = max_lines
+        self.max_chars = max_chars
+        self.lines = deque()
+        self.chars = 0
+        self.spill_path = spill_path
+        self.spill_file = None
+        self._text = None
+
+    def append(self, text):
+        """Add text to the end of the scrollback."""
+        if not text:
+            return
+        new_lines = text.splitlines(True)
+        if self.lines and not self.lines[-1].endswith('\n'):
+            # continue an unfinished last line, its characters are already counted
+            new_lines[0] = self.lines.pop() + new_lines[0]
+        self.lines.extend(new_lines)
+        self.chars += len(text)
+        self._text = None
+        self._trim()
+
+    def _trim(self):
+        dropped = []
+        while self.lines and (len(self.lines) > self.max_lines or self.chars > self.max_chars):
+            line = self.lines.popleft()
+            self.chars -= len(line)
+            dropped.append(line)
+        if dropped:
+            self._text = None
+            if self.spill_path:
+                if self.spill_file is None:
+                    self.spill_file = open(self.spill_path, 'a')
+                self.spill_file.writelines(dropped)
+
+    def set_limits(self, max_lines=None, max_chars=None):
+        if max_lines is not None:
+            self.max_lines = max_lines
+        if max_chars is not None:
+            self.max_chars = max_chars
+        self._trim()
+
+    def spill_to(self, path):
+        """Write lines that fall off the scrollback to path, None to drop them."""
+        self.close()
+        self.spill_path = path
+
+    def clear(self):
+        self.lines.clear()
+        self.chars = 0
+        self._text = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = ''.join(self.lines)
+        return self._text
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+    def __str__(self):
+        spill = self.spill_path or 'dropped'
+        return '{} of {} lines, {} of {} characters, older lines {}'.format(
+            len(self.lines), self.max_lines, self.chars, self.max_chars,
+            'spill to ' + spill if self.spill_path else spill)
@@ -0,0 +1,336 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""
+Serial man-in-the-middle proxy.
+
+Two endpoints, each a serial device or a freshly created pty, are bridged in
+both directions.  Bytes are read straight from the file descriptors into a
+preallocated buffer per direction and written out from a memoryview of it
+as soon as they arrive, so the proxy adds only a system call or two of
+latency.  What a sink cannot take at once is queued, up to MAX_PENDING
+bytes, and written when the selector reports it writable, so one slow or
+unattended endpoint never stalls the other direction.  Traffic can be logged to a pcapng capture, one interface per
+endpoint.
+
+A hook turns the proxy from a byte pipe into a frame pipe: each direction
+is then split into frames on an idle gap and the hook decides, per frame,
+whether to forward it unchanged, rewrite it or drop it.
+"""
+
+import argparse
+import errno
+import os
+import runpy
+import selectors
+import signal
+import sys
+import termios
+import time
+import tty as termios_tty
+
+from .capture import CaptureWriter, DIRECTION_IN, DIRECTION_OUT, monotonic_ns
+from .sniff import FrameBuffer
+
+clock = time.perf_counter
+
+READ_SIZE = 1 << 16
+HOOK_GAP = 0.005
+# bytes queued for a sink that is not taking them, more are discarded
+MAX_PENDING = 1 << 20
+# a pty nobody reads from for this long has its queues discarded
+STALE_AFTER = 1.0
+
+
+class Endpoint(object):
+    """One side of the proxy: a file descriptor plus what is needed to close it."""
+    def __init__(self, name, fd, closer=None, description='', discard=None):
+        self.name = name
+        self.fd = fd
+        self.description = description
+        self.closer = closer
+        self.discard = discard
+        self.interface = None
+
+    @classmethod
+    def open(cls, spec, baudrate=9600):
+        """
+        Open 'pty' or DEVICE[@BAUDRATE].
+
+        A pty endpoint's slave side is what the other program connects to,
+        its path is the endpoint's description.  Its discard() drops what
+        was written to it but not read, e.g. while no program has it open.
+        """
+        if spec == 'pty':
+            master, slave = os.openpty()
+            termios_tty.setraw(master)
+            termios_tty.setraw(slave)
+            path = os.ttyname(slave)
+            # holding the slave open keeps the master from reporting a hangup
+            # every time the program on the other side closes it
+            return cls(path, master, lambda: (os.close(master), os.close(slave)), path,
+                       lambda: termios.tcflush(slave, termios.TCIFLUSH))
+        import serial
+        device, _, baud = spec.partition('@')
+        port = serial.Serial(device, baudrate=int(baud or baudrate), timeout=0)
+        try:
+            fd = port.fileno()
+        except (AttributeError, NotImplementedError, ValueError):
+            port.close()
+            raise ValueError('{} has no file descriptor, proxying needs a POSIX serial port'.format(device))
+        return cls(device, fd, port.close, '{}@{}'.format(device, port.baudrate))
+
+    def close(self):
+        if self.closer:
+            self.closer()
+            self.closer = None
+
+
+class _Direction(object):
+    """State of one forwarding direction."""
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+        self.buffer = bytearray(READ_SIZE)
+        self.view = memoryview(self.buffer)
+        self.frame = FrameBuffer()
+        self.frame_start = 0
+        self.last_byte = 0.0
+        self.pending = bytearray()
+        self.blocked_since = None
+        self.bytes = 0
+        self.dropped = 0
+        self.discarded = 0
+
+
+class Proxy(object):
+    """
+    Forward everything read on one endpoint to the other.
+
+    hook(source, frame) is called with the name of the endpoint a frame came
+    from and the frame as bytes; it returns the bytes to forward, which may
+    be the frame itself, or None to drop it.  Without a hook data is
+    forwarded chunk by chunk without being framed.  Bytes a sink had no
+    room for, and the queue of a pty that was not read for STALE_AFTER,
+    are counted in discarded.
+    """
+    def __init__(self, left, right, writer=None, hook=None, gap=HOOK_GAP):
+        self.endpoints = (left, right)
+        self.directions = (_Direction(left, right), _Direction(right, left))
+        self.writer = writer
+        self.hook = hook
+        self.gap = gap
+        self.running = False
+        self.selector = selectors.DefaultSelector()
+        self.readers = {}
+        self.writers = {}
+        for direction in self.directions:
+            os.set_blocking(direction.source.fd, False)
+            self.readers[direction.source.fd] = direction
+            self.writers[direction.sink.fd] = direction
+            self.selector.register(direction.source.fd, selectors.EVENT_READ)
+        if writer:
+            for endpoint in self.endpoints:
+                endpoint.interface = writer.add_interface(endpoint.name, endpoint.description)
+
+    def _timeout(self):
+        """Seconds until an open frame ends or a pty queue goes stale, None if neither can."""
+        deadlines = [d.blocked_since + STALE_AFTER for d in self.directions
+                     if d.blocked_since is not None and d.sink.discard]
+        if self.hook is not None:
+            deadlines += [d.last_byte + self.gap for d in self.directions if d.frame]
+        return max(0, min(deadlines) - clock()) if deadlines else None
+
+    def poll(self):
+        """Wait for data, a writable sink or an expired frame once and handle it."""
+        for key, events in self.selector.select(self._timeout()):
+            if events & selectors.EVENT_WRITE:
+                self._flush(self.writers[key.fd])
+            if events & selectors.EVENT_READ:
+                self._read(self.readers[key.fd])
+        now = clock()
+        for direction in self.directions:
+            if self.hook is not None and direction.frame and now - direction.last_byte >= self.gap:
+                self._close_frame(direction)
+            if (direction.blocked_since is not None and direction.sink.discard
+                    and now - direction.blocked_since >= STALE_AFTER):
+                # nobody reads the pty, don't hand stale bytes to whoever opens it next
+                direction.sink.discard()
+                direction.discarded += len(direction.pending)
+                direction.pending.clear()
+                direction.blocked_since = None
+                self._watch(direction.sink.fd)
+
+    def _watch(self, fd):
+        """Select fd for reading while it is a live source and for writing while bytes wait for it."""
+        events = 0
+        if self.readers.get(fd) is not None:
+            events |= selectors.EVENT_READ
+        if self.writers[fd].pending:
+            events |= selectors.EVENT_WRITE
+        registered = fd in self.selector.get_map()
+        if not events:
+            if registered:
+                self.selector.unregister(fd)
+        elif registered:
+            self.selector.modify(fd, events)
+        else:
+            self.selector.register(fd, events)
+
+    def _read(self, direction):
+        try:
+            length = os.readv(direction.source.fd, [direction.view])
+        except BlockingIOError:
+            return
+        except OSError as e:
+            if e.errno != errno.EIO:
+                raise
+            length = 0
+        if not length:
+            # the device went away, stop watching it instead of spinning
+            self.readers[direction.source.fd] = None
+            self._watch(direction.source.fd)
+            return
+        timestamp = monotonic_ns()
+        chunk = direction.view[:length]
+        if self.hook is None:
+            self._write(direction, chunk)
+            direction.bytes += length
+            if self.writer:
+                self.writer.write_frame(direction.source.interface, chunk, timestamp, DIRECTION_IN)
+            return
+        if not direction.frame:
+            direction.frame_start = timestamp
+        direction.frame.extend(chunk)
+        direction.last_byte = clock()
+
+    def _close_frame(self, direction):
+        frame = bytes(direction.frame.view())
+        direction.frame.clear()
+        forward = self.hook(direction.source.name, frame)
+        if forward is None:
+            direction.dropped += 1
+        else:
+            self._write(direction, memoryview(forward))
+            direction.bytes += len(forward)
+        if self.writer:
+            self.writer.write_frame(direction.source.interface, frame, direction.frame_start, DIRECTION_IN)
+            if forward is not None and forward != frame:
+                self.writer.write_frame(direction.sink.interface, forward, None, DIRECTION_OUT)
+
+    def _write(self, direction, data):
+        """Write data to the sink, queueing what it has no room for right now."""
+        if not direction.pending:
+            try:
+                written = os.write(direction.sink.fd, data)
+            except BlockingIOError:
+                written = 0
+            except OSError:
+                # the sink went away, there is nobody to write to
+                direction.discarded += len(data)
+                return
+            data = data[written:]
+            if not data:
+                return
+            direction.blocked_since = clock()
+        room = MAX_PENDING - len(direction.pending)
+        if len(data) > room:
+            direction.discarded += len(data) - room
+            data = data[:room]
+        direction.pending += data
+        self._watch(direction.sink.fd)
+
+    def _flush(self, direction):
+        try:
+            written = os.write(direction.sink.fd, direction.pending)
+        except BlockingIOError:
+            return
+        except OSError:
+            written = len(direction.pending)
+            direction.discarded += written
+        del direction.pending[:written]
+        direction.blocked_since = clock() if direction.pending else None
+        self._watch(direction.sink.fd)
+
+    def run(self):
+        self.running = True
+        while self.running and self.selector.get_map():
+            self.poll()
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        if self.hook is not None:
+            for direction in self.directions:
+                if direction.frame:
+                    self._close_frame(direction)
+        self.selector.close()
+        for endpoint in self.endpoints:
+            endpoint.close()
+        if self.writer:
+            self.writer.close()
+
+
+def load_hook(path):
+    """Return the hook(source, frame) function defined in a Python file."""
+    namespace = runpy.run_path(path)
+    if not callable(namespace.get('hook')):
+        raise ValueError('{} does not define hook(source, frame)'.format(path))
+    return namespace['hook']
+
+
+def add_arguments(parser):
+    parser.add_argument('left', help="serial device as DEVICE[@BAUDRATE], or 'pty' to create a pty")
+    parser.add_argument('right', help="serial device as DEVICE[@BAUDRATE], or 'pty' to create a pty")
+    parser.add_argument('-u', '--baudrate', type=int, default=9600, help='baudrate for devices given without one')
+    parser.add_argument('-w', '--write', metavar='FILE', help='log both directions to FILE in pcapng format')
+    parser.add_argument('-k', '--hook', metavar='FILE', help='python file defining hook(source, frame) that returns the frame to forward, rewritten bytes or None to drop it')
+    parser.add_argument('-e', '--gap', type=int, metavar='MICROSECONDS', default=int(HOOK_GAP * 1E6), help='idle time that ends a frame when a hook is used')
+
+
+def run(args):
+    """Run a proxy from parsed command line arguments until interrupted."""
+    hook = load_hook(args.hook) if args.hook else None
+    try:
+        left = Endpoint.open(args.left, args.baudrate)
+        right = Endpoint.open(args.right, args.baudrate)
+    except (OSError, ValueError) as e:
+        # serial.SerialException is an OSError
+        sys.exit(str(e))
+    writer = CaptureWriter(args.write) if args.write else None
+    proxy = Proxy(left, right, writer, hook, args.gap / 1E6)
+    for spec, endpoint in ((args.left, left), (args.right, right)):
+        if spec == 'pty':
+            print('pty ready at {}'.format(endpoint.name))
+    print('Proxying {} <-> {}'.format(left.name, right.name))
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        proxy.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.close()
+        for direction in proxy.directions:
+            print('{} -> {}: {} bytes forwarded, {} frames dropped, {} bytes discarded'.format(
+                direction.source.name, direction.sink.name, direction.bytes, direction.dropped,
+                direction.discarded))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    add_arguments(parser)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
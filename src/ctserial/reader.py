@@ -0,0 +1,152 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""Background reader that keeps draining an interactive serial session."""
+
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from .response import clock
+
+# how long the reader thread blocks in one serial read
+POLL_TIMEOUT = 0.05
+
+
+class SessionReader(object):
+    """
+    Drain a serial session from a thread into a timestamped receive queue.
+
+    While a command has claimed the reader, received chunks are queued for
+    it; the reader then looks like the serial port itself (write, read,
+    in_waiting, timeout, reset_input_buffer) so read_response() and
+    BatchSender work on it unchanged.  Anything arriving while nobody holds
+    a claim is unsolicited: it is split into frames on gap seconds of
+    silence and handed to on_frame(timestamp, frame) from the reader thread.
+    Reads that find the port's buffer full are counted in stats.overruns.
+    """
+    def __init__(self, session, on_frame=None, gap=0.02, stats=None):
+        self.session = session
+        self.stats = stats
+        self.on_frame = on_frame
+        self.gap = gap
+        self.timeout = None
+        self.chunks = deque()
+        self.queued = 0
+        self.claims = 0
+        self.unsolicited = bytearray()
+        self.unsolicited_start = None
+        self.unsolicited_last = None
+        self.condition = threading.Condition()
+        self.running = True
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='ctserial-reader')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        session = self.session
+        session.timeout = POLL_TIMEOUT
+        while self.running:
+            try:
+                data = session.read(session.in_waiting or 1)
+            except Exception as e:
+                # port closed or unplugged, wake up anyone waiting for data
+                with self.condition:
+                    self.error = e
+                    self.running = False
+                    self.condition.notify_all()
+                break
+            now = clock()
+            frame = None
+            if data and self.stats:
+                self.stats.read(len(data))
+            with self.condition:
+                if data:
+                    if self.claims:
+                        self.chunks.append((now, data))
+                        self.queued += len(data)
+                        self.condition.notify_all()
+                    else:
+                        if not self.unsolicited:
+                            self.unsolicited_start = now
+                        self.unsolicited += data
+                        self.unsolicited_last = now
+                if self.unsolicited and (self.claims or now - self.unsolicited_last >= self.gap):
+                    frame = (self.unsolicited_start, bytes(self.unsolicited))
+                    self.unsolicited.clear()
+            if frame and self.on_frame:
+                self.on_frame(*frame)
+
+    @contextmanager
+    def claim(self):
+        """Route received data to read() instead of on_frame for a transaction."""
+        with self.condition:
+            self.claims += 1
+        try:
+            yield self
+        finally:
+            with self.condition:
+                self.claims -= 1
+
+    # the subset of the serial.Serial interface used by commands
+
+    @property
+    def port(self):
+        return self.session.port
+
+    @property
+    def in_waiting(self):
+        return self.queued
+
+    def write(self, data):
+        return self.session.write(data)
+
+    def fileno(self):
+        return self.session.fileno()
+
+    def get_settings(self):
+        return self.session.get_settings()
+
+    def apply_settings(self, settings):
+        self.session.apply_settings(settings)
+
+    def reset_input_buffer(self):
+        with self.condition:
+            self.chunks.clear()
+            self.queued = 0
+
+    def read(self, size=1):
+        """Return up to size queued bytes, waiting up to timeout for them to arrive."""
+        deadline = None if self.timeout is None else clock() + self.timeout
+        with self.condition:
+            while self.queued < size and self.running:
+                wait = None if deadline is None else deadline - clock()
+                if wait is not None and wait <= 0:
+                    break
+                self.condition.wait(wait)
+            if self.error and not self.queued:
+                raise self.error
+            data = bytearray()
+            while self.chunks and len(data) < size:
+                timestamp, chunk = self.chunks.popleft()
+                take = size - len(data)
+                if len(chunk) > take:
+                    self.chunks.appendleft((timestamp, chunk[take:]))
+                    chunk = chunk[:take]
+                data += chunk
+            self.queued -= len(data)
+            return bytes(data)
+
+    def stop(self):
+        """Stop the reader thread, the serial session itself is left open."""
+        self.running = False
+        self.thread.join()
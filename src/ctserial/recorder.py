@@ -0,0 +1,131 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""Background persistence of sessions and transactions into the model database."""
+
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+DEFAULT_DATABASE = os.path.join('~', '.ctserial', 'ctserial.sqlite')
+
+_OPEN, _RECORD, _CLOSE, _STOP = range(4)
+
+
+class RecorderError(Exception):
+    """Writing to the database failed and a batch of transactions was lost."""
+
+
+class Recorder(object):
+    """
+    Queue transactions and write them to sqlite from a writer thread.
+
+    The I/O path only puts a tuple on an unbounded queue, so recording never
+    blocks a send and nothing is dropped.  The writer takes everything that
+    queued up since its last pass and inserts it in a single db_session, at
+    most every flush_interval seconds.
+
+    A batch that cannot be written is reported to on_error(message) from
+    the writer thread, or without one raised as RecorderError by close().
+    """
+    def __init__(self, filename=DEFAULT_DATABASE, flush_interval=0.25, on_error=None):
+        from . import model
+        filename = os.path.expanduser(filename)
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        model.bind(filename)
+        self.model = model
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.next_key = 0
+        self.error = None
+        self.on_error = on_error
+        self.thread = threading.Thread(target=self._writer, name='ctserial-recorder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open_session(self, name, command):
+        """Start a session, return the key to pass to record() and close_session()."""
+        self.next_key += 1
+        self.queue.put((_OPEN, self.next_key, name, command, datetime.now()))
+        return self.next_key
+
+    def record(self, session_key, tx, rx, rtt=None, command=None, timestamp=None):
+        """Queue one transaction; tx and rx are bytes, rtt seconds or None."""
+        self.queue.put((_RECORD, session_key, bytes(tx), bytes(rx), rtt, command,
+                        timestamp or datetime.now()))
+
+    def close_session(self, session_key):
+        self.queue.put((_CLOSE, session_key, datetime.now()))
+
+    def close(self):
+        """Write everything still queued and stop the writer."""
+        self.queue.put((_STOP,))
+        self.thread.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RecorderError(error)
+
+    def _writer(self):
+        sessions = {}
+        stop = False
+        while not stop:
+            items = [self.queue.get()]
+            stop = self._drain(items)
+            if not stop:
+                # let a burst build up into one larger batch
+                time.sleep(self.flush_interval)
+                stop = self._drain(items)
+            try:
+                self._write(items, sessions)
+            except Exception as e:
+                lost = sum(1 for item in items if item[0] == _RECORD)
+                message = 'Recording to {} failed, {} transactions lost: {}\n'.format(self.filename, lost, e)
+                if self.on_error is not None:
+                    self.on_error(message)
+                elif self.error is None:
+                    self.error = message.strip()
+
+    def _drain(self, items):
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return items[-1][0] == _STOP
+            items.append(item)
+
+    def _write(self, items, sessions):
+        m = self.model
+        commands = {}
+        with m.db_session:
+            for item in items:
+                kind = item[0]
+                if kind == _RECORD:
+                    _, key, tx, rx, rtt, command, timestamp = item
+                    if command is not None and command not in commands:
+                        # Command.session is the command that opened a session, not set here
+                        commands[command] = m.Command(command=command)
+                    m.Transaction(tx=tx, rx=rx, rtt=rtt, timestamp=timestamp,
+                                  session=m.Session[sessions[key]],
+                                  command=commands.get(command))
+                elif kind == _OPEN:
+                    _, key, name, command, start = item
+                    session = m.Session(session=name, start=start,
+                                        command=m.Command(command=command))
+                    m.flush()
+                    sessions[key] = session.id
+                elif kind == _CLOSE:
+                    _, key, end = item
+                    m.Session[sessions.pop(key)].end = end
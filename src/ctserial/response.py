@@ -0,0 +1,265 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""
+Strategies that decide when a device has finished answering.
+
+Every strategy has an overall timeout for the whole response and an optional
+inter-byte gap after which a started response is considered done.  On top of
+that remaining(rx) tells read_response() how many bytes are still missing,
+so it can block on one bulk read instead of polling byte by byte, and end(rx)
+tells where a response stops so back to back responses can be split apart.
+"""
+
+import math
+import time
+from collections import deque
+
+from .framing import FRAMER_USAGE, parse_framer
+
+clock = time.perf_counter
+
+
+class GapCompletion(object):
+    """A response is complete once the line has been quiet for gap seconds."""
+    name = 'gap'
+
+    def __init__(self, gap=0.02, timeout=1.0):
+        self.gap = gap
+        self.timeout = timeout
+
+    def reset(self):
+        """Forget state kept from the previous response."""
+        pass
+
+    def remaining(self, rx):
+        """Bytes still missing from rx, 0 if complete or None if unknown."""
+        return None
+
+    def end(self, rx):
+        """Length of the first complete response in rx, None if there is none yet."""
+        return None
+
+    def __str__(self):
+        return '{} {:g} ms, timeout {:g} s'.format(self.name, self.gap * 1E3, self.timeout)
+
+
+class TerminatorCompletion(GapCompletion):
+    """A response is complete once the terminator bytes were received."""
+    name = 'terminator'
+
+    def __init__(self, terminator, gap=None, timeout=1.0):
+        GapCompletion.__init__(self, gap, timeout)
+        self.terminator = bytes(terminator)
+        self.reset()
+
+    def reset(self):
+        self.searched = 0
+
+    def remaining(self, rx):
+        return 0 if self.end(rx) is not None else None
+
+    def end(self, rx):
+        # only search what arrived since the last call
+        found = rx.find(self.terminator, max(0, self.searched - len(self.terminator) + 1))
+        if found < 0:
+            self.searched = len(rx)
+            return None
+        self.searched = 0
+        return found + len(self.terminator)
+
+    def __str__(self):
+        return '{} {}, timeout {:g} s'.format(self.name, self.terminator.hex(), self.timeout)
+
+
+class LengthCompletion(GapCompletion):
+    """A response is complete once a fixed number of bytes was received."""
+    name = 'length'
+
+    def __init__(self, length, gap=None, timeout=1.0):
+        GapCompletion.__init__(self, gap, timeout)
+        self.length = length
+
+    def remaining(self, rx):
+        return max(0, self.length - len(rx))
+
+    def end(self, rx):
+        return self.length if len(rx) >= self.length else None
+
+    def __str__(self):
+        return '{} {}, timeout {:g} s'.format(self.name, self.length, self.timeout)
+
+
+class LengthFieldCompletion(GapCompletion):
+    """
+    A response carries its own length in a header field.
+
+    The field is size bytes at offset, and the full response is the field
+    value plus adjust bytes long (header, checksum and so on).
+    """
+    name = 'field'
+
+    def __init__(self, offset, size=1, byteorder='big', adjust=0, gap=None, timeout=1.0):
+        GapCompletion.__init__(self, gap, timeout)
+        self.offset = offset
+        self.size = size
+        self.byteorder = byteorder
+        self.adjust = adjust
+
+    def remaining(self, rx):
+        header = self.offset + self.size
+        if len(rx) < header:
+            return header - len(rx)
+        return max(0, self._length(rx) - len(rx))
+
+    def end(self, rx):
+        if len(rx) < self.offset + self.size:
+            return None
+        length = self._length(rx)
+        return length if len(rx) >= length else None
+
+    def _length(self, rx):
+        header = rx[self.offset:self.offset + self.size]
+        return max(int.from_bytes(header, self.byteorder) + self.adjust, self.offset + self.size)
+
+    def __str__(self):
+        return '{} offset {} size {} {} adjust {}, timeout {:g} s'.format(
+            self.name, self.offset, self.size, self.byteorder, self.adjust, self.timeout)
+
+
+class FramerCompletion(GapCompletion):
+    """A response is complete once a protocol framer found a whole frame."""
+    name = 'framer'
+
+    def __init__(self, framer, gap=None, timeout=1.0):
+        GapCompletion.__init__(self, gap, timeout)
+        self.framer = framer
+        self.reset()
+
+    def reset(self):
+        self.framer.reset()
+        self.fed = 0
+        self.base = 0
+        self.ends = deque()
+
+    def _feed(self, rx):
+        if len(rx) > self.fed:
+            self.ends.extend(end for end, _ in self.framer.feed_spans(rx[self.fed:]))
+            self.fed = len(rx)
+
+    def remaining(self, rx):
+        self._feed(rx)
+        return 0 if self.ends else self.framer.missing()
+
+    def end(self, rx):
+        self._feed(rx)
+        if not self.ends:
+            return None
+        # the caller cuts rx at the returned length, shift our offsets with it
+        end = self.ends.popleft()
+        length, self.base = end - self.base, end
+        self.fed -= length
+        return length
+
+    def __str__(self):
+        return '{} {}, timeout {:g} s'.format(self.name, self.framer, self.timeout)
+
+
+COMPLETION_USAGE = 'gap MS | terminator HEX | length N | field OFFSET [SIZE] [big|little] [ADJUST] | framer FRAMER'
+
+
+def parse_completion(text, timeout=1.0):
+    """
+    Build a strategy from its text form, e.g. "terminator 0d0a" or "gap 20".
+
+    Raises ValueError with a usage hint if text is not understood.
+    """
+    parts = text.split()
+    try:
+        if len(parts) == 2 and parts[0] == 'gap':
+            return GapCompletion(float(parts[1]) / 1E3, timeout)
+        if len(parts) == 2 and parts[0] == 'terminator':
+            return TerminatorCompletion(bytes.fromhex(parts[1]), timeout=timeout)
+        if len(parts) == 2 and parts[0] == 'length':
+            return LengthCompletion(int(parts[1]), timeout=timeout)
+        if 2 <= len(parts) <= 5 and parts[0] == 'field' and parts[3:4] in ([], ['big'], ['little']):
+            return LengthFieldCompletion(
+                int(parts[1]),
+                int(parts[2]) if len(parts) > 2 else 1,
+                parts[3] if len(parts) > 3 else 'big',
+                int(parts[4]) if len(parts) > 4 else 0,
+                timeout=timeout)
+        if len(parts) > 1 and parts[0] == 'framer':
+            return FramerCompletion(parse_framer(' '.join(parts[1:])), timeout=timeout)
+    except ValueError:
+        pass
+    raise ValueError('expected {}, FRAMER being {}'.format(COMPLETION_USAGE, FRAMER_USAGE))
+
+
+class PortTimeout(object):
+    """
+    Read timeout of a session that is only set when it has to change.
+
+    Setting the timeout of a real port reconfigures it (tcsetattr on
+    POSIX), which is too slow to do before every read.  wait() rounds up to
+    whole milliseconds and keeps the current timeout while it is no more
+    than twice the wait asked for, so a wait shrinking towards a deadline
+    changes it a handful of times instead of on every read.  A read may
+    then block up to twice as long as asked when nothing arrives.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.saved = self.current = session.timeout
+
+    def wait(self, seconds):
+        seconds = math.ceil(seconds * 1E3) / 1E3
+        current = self.current
+        if current is None or seconds > current or seconds < current / 2:
+            self.session.timeout = self.current = seconds
+
+    def restore(self):
+        """Put back the timeout the session had before."""
+        if self.current != self.saved:
+            self.session.timeout = self.current = self.saved
+
+
+def read_response(session, completion):
+    """
+    Read one response from a serial session.
+
+    Returns the received bytes and the clock() time the last byte arrived
+    (or the time reading gave up if nothing arrived).  The port's timeout
+    is changed through PortTimeout.
+    """
+    rx = bytearray()
+    completion.reset()
+    deadline = clock() + completion.timeout
+    last = None
+    timeout = PortTimeout(session)
+    try:
+        while True:
+            missing = completion.remaining(rx)
+            if missing == 0:
+                break
+            wait = deadline - clock()
+            if rx and completion.gap is not None:
+                wait = min(wait, completion.gap)
+            if wait <= 0:
+                break
+            timeout.wait(wait)
+            chunk = session.read(max(missing or 1, session.in_waiting))
+            if not chunk:
+                break
+            rx += chunk
+            last = clock()
+    finally:
+        timeout.restore()
+    return bytes(rx), last or clock()
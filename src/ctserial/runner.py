@@ -0,0 +1,251 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""
+Run prompt commands from a script, without the user interface.
+
+A script (.cts) holds one command per line, exactly as typed at the
+ctserial> prompt; blank lines and lines starting with # are skipped:
+
+    connect /dev/ttyUSB0 19200
+    response framer modbus
+    sendmacro readreg addr=0-99
+
+Output goes to stdout as the prompt would show it, or with --json to a
+file as one record per command with its output, duration and
+transactions.  The run stops at the first command that is not
+understood unless --keep-going is given; the exit status is 1 then.
+
+Nothing of prompt_toolkit is imported, and the database only when
+recording or loading macros, so a run starts quickly.
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+
+from .commands import Commands, OUTPUT_FORMATS
+from .output import Scrollback
+from .response import COMPLETION_USAGE, GapCompletion, parse_completion
+from .sessions import SessionManager
+
+
+class Transcript(object):
+    """
+    Recorder stand-in that keeps the transactions of the current command,
+    passing them on to a real Recorder if there is one and forward is set.
+    The Recorder's database is available through filename and model.
+    """
+    def __init__(self, recorder=None, forward=True):
+        self.recorder = recorder
+        self.forward = forward and recorder is not None
+        self.devices = {}
+        self.keys = {}
+        self.next_key = 0
+        self.transactions = []
+
+    def open_session(self, name, command):
+        self.next_key += 1
+        self.devices[self.next_key] = name
+        if self.forward:
+            self.keys[self.next_key] = self.recorder.open_session(name, command)
+        return self.next_key
+
+    @property
+    def filename(self):
+        """The database transactions go to, None if they are not stored."""
+        return self.recorder.filename if self.forward else None
+
+    @property
+    def model(self):
+        return self.recorder.model if self.recorder else None
+
+    def record(self, session_key, tx, rx, rtt=None, command=None, timestamp=None):
+        self.transactions.append((self.devices[session_key], bytes(tx), bytes(rx), rtt))
+        if self.forward:
+            self.recorder.record(self.keys[session_key], tx, rx, rtt, command, timestamp)
+
+    def close_session(self, session_key):
+        if self.forward:
+            self.recorder.close_session(self.keys.pop(session_key))
+
+    def take(self):
+        """Return and forget the transactions kept so far."""
+        transactions, self.transactions = self.transactions, []
+        return transactions
+
+    def close(self):
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+            self.forward = False
+
+
+class HeadlessApp(object):
+    """
+    What Commands expects of the application and the key press event.
+
+    Unsolicited frames from the session readers are written to out as they
+    arrive, or kept for the JSON record of the command running then.
+    """
+    def __init__(self, transcript, out=None, output_format='hex'):
+        self.app = self
+        self.sessions = SessionManager()
+        self.completion = GapCompletion()
+        self.output_format = output_format
+        self.recorder = transcript
+        self.recording = True
+        self.scrollback = Scrollback()
+        self.history = []
+        self.out = out
+        self.lock = threading.Lock()
+        self.unsolicited = []
+        self.exited = False
+
+    def post_output(self, text):
+        with self.lock:
+            if self.out is None:
+                self.unsolicited.append(text)
+            else:
+                self.out.write(text)
+                self.out.flush()
+
+    def take_unsolicited(self):
+        with self.lock:
+            unsolicited, self.unsolicited = self.unsolicited, []
+        return unsolicited
+
+    def exit(self):
+        self.exited = True
+
+
+def read_script(path):
+    """Return (line number, command) for every command of a script, - reads stdin."""
+    if path == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    return [(number, line.strip()) for number, line in enumerate(lines, 1)
+            if line.strip() and not line.strip().startswith('#')]
+
+
+def run_script(commands, app, cmd=None, keep_going=False, echo=None, verbose=False):
+    """
+    Execute (line number, command) pairs, return a result dict for each.
+
+    echo, if given, is a stream every command's output is written to as
+    soon as it finishes, after the command itself if verbose.
+    """
+    cmd = cmd or Commands()
+    results = []
+    for number, line in commands:
+        if echo is not None and verbose:
+            echo.write('ctserial> {}\n'.format(line))
+        app.history.append(line + '\n')
+        start = time.perf_counter()
+        output = cmd.execute(line, '', app)
+        seconds = time.perf_counter() - start
+        ok = output is not False
+        if not ok:
+            output = 'Invalid command or arguments: {}\n'.format(line)
+        result = {'line': number, 'command': line, 'ok': ok, 'seconds': seconds,
+                  'output': output or '',
+                  'transactions': [{'device': device, 'tx': tx.hex(), 'rx': rx.hex(), 'rtt': rtt}
+                                   for device, tx, rx, rtt in app.recorder.take()]}
+        unsolicited = app.take_unsolicited()
+        if unsolicited:
+            result['unsolicited'] = ''.join(unsolicited)
+        results.append(result)
+        if echo is not None:
+            echo.write(result['output'])
+            echo.flush()
+        if app.exited or (not ok and not keep_going):
+            break
+    return results
+
+
+def add_arguments(parser):
+    parser.add_argument('script', nargs='?', help='file of prompt commands, one per line, - for stdin')
+    parser.add_argument('-e', '--execute', action='append', default=[], metavar='COMMAND', help='run a command, may be repeated; runs before the script')
+    parser.add_argument('-d', '--device', help='connect to this device before anything else')
+    parser.add_argument('-b', '--baudrate', help='baudrate for --device, or auto')
+    parser.add_argument('-r', '--response', metavar='STRATEGY', help='How the end of a response is detected: ' + COMPLETION_USAGE)
+    parser.add_argument('-t', '--timeout', type=float, default=1.0, metavar='SECONDS', help='Time to wait for each response.')
+    parser.add_argument('-f', '--format', choices=OUTPUT_FORMATS, default='hex', help='how data is shown in the output')
+    parser.add_argument('-j', '--json', metavar='FILE', help='write the results as JSON to FILE, - for stdout')
+    parser.add_argument('-k', '--keep-going', action='store_true', help='run the rest of the script after a command that is not understood')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every command before its output')
+    parser.add_argument('--record', action='store_true', help='record transactions in the database')
+    parser.add_argument('--macros', action='store_true', help='load the macros stored in the database')
+    parser.add_argument('--database', metavar='FILE', help='database for --record and --macros, default ~/.ctserial/ctserial.sqlite')
+
+
+def run(args):
+    """Run a script from parsed command line arguments, exit 1 if a command failed."""
+    commands = [(0, 'connect {} {}'.format(args.device, args.baudrate or '').strip())] if args.device else []
+    commands += [(0, line) for line in args.execute]
+    if args.script:
+        try:
+            commands += read_script(args.script)
+        except OSError as e:
+            sys.exit(str(e))
+    if not commands:
+        sys.exit('nothing to run, give a script or --execute')
+    try:
+        completion = parse_completion(args.response, args.timeout) if args.response else GapCompletion(timeout=args.timeout)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    cmd = Commands()
+    recorder = None
+    if args.record or args.macros:
+        from .recorder import DEFAULT_DATABASE, Recorder
+        recorder = Recorder(args.database or DEFAULT_DATABASE, on_error=sys.stderr.write)
+        if args.macros:
+            cmd.macros.attach(recorder.model)
+    transcript = Transcript(recorder, args.record)
+    to_json = args.json is not None
+    out = None if to_json else sys.stdout
+    app = HeadlessApp(transcript, out, args.format)
+    app.completion = completion
+
+    start = time.perf_counter()
+    try:
+        results = run_script(commands, app, cmd, args.keep_going, out, args.verbose)
+    except KeyboardInterrupt:
+        sys.exit(1)
+    finally:
+        app.sessions.close()
+        transcript.close()
+    ok = all(result['ok'] for result in results)
+    if to_json:
+        report = {'script': args.script, 'ok': ok, 'seconds': time.perf_counter() - start, 'results': results}
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=1)
+            sys.stdout.write('\n')
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=1)
+    if not ok:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    add_arguments(parser)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
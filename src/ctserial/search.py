@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Control Things Serial search, find byte patterns in recorded traffic
+
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import re
+import struct
+import sys
+from array import array
+from collections import namedtuple
+
+from .capture import CaptureReader
+
+# kinds of searchable payloads
+KIND_TX, KIND_RX, KIND_FRAME = range(3)
+KIND_NAMES = ('tx', 'rx', 'frame')
+
+GRAM = 2
+INDEX_MAGIC = b'CTSRCH03'
+DEFAULT_INDEX = os.path.join('~', '.ctserial', 'search.idx')
+
+Hit = namedtuple('Hit', 'kind source key offset data')
+
+
+def database_identity(filename):
+    """
+    The path of a database with its device and inode, so an index is not
+    reused for another database or one that was deleted and created again.
+    """
+    st = os.stat(filename)
+    return '{}\t{}:{}'.format(filename, st.st_dev, st.st_ino)
+
+
+def parse_pattern(text):
+    """
+    Compile a hex search pattern.
+
+    Pairs of hex digits are literal bytes, ?? matches any single byte and *
+    any number of bytes; spaces, 0x and \\x are ignored.  Returns the compiled
+    regular expression and the literal runs usable for the index.
+    """
+    text = re.sub(r'0x|\\x|\s', '', text.lower())
+    tokens = re.findall(r'\?\?|\*|[0-9a-f]{2}', text)
+    if not tokens or ''.join(tokens) != text:
+        raise ValueError('patterns are hex bytes, ?? for any byte and * for any run of bytes')
+    regex, runs, run = b'', [], b''
+    for token in tokens:
+        if token in ('??', '*'):
+            regex += b'.' if token == '??' else b'.*?'
+            runs.append(run)
+            run = b''
+        else:
+            byte = bytes.fromhex(token)
+            regex += re.escape(byte)
+            run += byte
+    runs.append(run)
+    return re.compile(regex, re.DOTALL), [r for r in runs if len(r) >= GRAM]
+
+
+class SearchIndex(object):
+    """
+    Bigram index over recorded payloads and capture frames.
+
+    Every payload is appended to one corpus bytearray and every distinct
+    2 byte sequence in it maps to a sorted array of payload ids.  Pairs keep
+    the index to at most 65536 lists and still cover two byte status words.
+    A query intersects the lists of its literal pairs and only runs the full
+    pattern over the surviving payloads.  add() is incremental, so new
+    transactions and frames are cheap to pick up.  The index remembers
+    which database file it was built from and starts over when it is
+    updated from another one; for every capture it keeps the frame count,
+    size, mtime and CaptureReader.fingerprint(), and drops the capture's
+    payloads when the file was replaced rather than appended to.
+    """
+    def __init__(self, path=None):
+        self.path = path and os.path.expanduser(path)
+        self._clear()
+        if self.path and os.path.exists(self.path):
+            self._load()
+
+    def _clear(self):
+        self.corpus = bytearray()
+        self.offsets = array('Q', [0])
+        self.kinds = array('B')
+        self.sources = array('H')
+        self.keys = array('Q')
+        self.source_names = ['database']
+        self.postings = {}
+        self.last_transaction = 0
+        self.capture_frames = {}
+        self.database = ''
+        self.changed = False
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, kind, source, key, data):
+        """Index one payload, source is a name from source_names (e.g. a capture path)."""
+        if source not in self.source_names:
+            self.source_names.append(source)
+        doc = len(self.keys)
+        self.corpus += data
+        self.offsets.append(len(self.corpus))
+        self.kinds.append(kind)
+        self.sources.append(self.source_names.index(source))
+        self.keys.append(key)
+        postings = self.postings
+        for gram in {data[i:i + GRAM] for i in range(len(data) - GRAM + 1)}:
+            ids = postings.get(gram)
+            if ids is None:
+                ids = postings[gram] = array('I')
+            ids.append(doc)
+        self.changed = True
+        return doc
+
+    def update_from_database(self, model):
+        """Index transactions recorded since the last update, the model must be bound."""
+        database = database_identity(model.filename)
+        if database != self.database:
+            self._clear()
+            self.database = database
+            self.changed = True
+        with model.db_session:
+            rows = model.select((t.id, t.tx, t.rx) for t in model.Transaction
+                                if t.id > self.last_transaction).order_by(1)
+            for tid, tx, rx in rows:
+                self.add(KIND_TX, 'database', tid, tx)
+                self.add(KIND_RX, 'database', tid, rx)
+                self.last_transaction = tid
+
+    def update_from_capture(self, reader):
+        """Index frames of a CaptureReader that were not indexed before."""
+        path = os.path.abspath(reader.path)
+        start, size, mtime, fingerprint = self.capture_frames.get(path, (0, None, None, 0))
+        if (size, mtime) == (reader.size, reader.mtime):
+            return
+        if start > len(reader) or reader.fingerprint(start) != fingerprint:
+            self._drop(path)
+            start = 0
+        for frame in reader.frames(start):
+            self.add(KIND_FRAME, path, frame.number, frame.data)
+        self.capture_frames[path] = (len(reader), reader.size, reader.mtime, reader.fingerprint(len(reader)))
+        self.changed = True
+
+    def _drop(self, source):
+        """Index everything again except the payloads of source."""
+        keep = [(self.kinds[doc], self.source_names[self.sources[doc]], self.keys[doc], self.payload(doc))
+                for doc in range(len(self.keys)) if self.source_names[self.sources[doc]] != source]
+        database, last_transaction, captures = self.database, self.last_transaction, self.capture_frames
+        self._clear()
+        self.database, self.last_transaction, self.capture_frames = database, last_transaction, captures
+        self.capture_frames.pop(source, None)
+        for doc in keep:
+            self.add(*doc)
+        self.changed = True
+
+    def payload(self, doc):
+        return bytes(self.corpus[self.offsets[doc]:self.offsets[doc + 1]])
+
+    def _candidates(self, runs):
+        lists = []
+        for run in runs:
+            for i in range(len(run) - GRAM + 1):
+                ids = self.postings.get(run[i:i + GRAM])
+                if ids is None:
+                    return []
+                lists.append(ids)
+        if not lists:
+            return range(len(self.keys))
+        lists.sort(key=len)
+        result = set(lists[0])
+        for ids in lists[1:]:
+            result.intersection_update(ids)
+            if not result:
+                break
+        return sorted(result)
+
+    def search(self, pattern, limit=None, kinds=None):
+        """Yield a Hit for every payload matching a hex pattern, see parse_pattern()."""
+        regex, runs = parse_pattern(pattern)
+        found = 0
+        for doc in self._candidates(runs):
+            if kinds is not None and self.kinds[doc] not in kinds:
+                continue
+            data = self.payload(doc)
+            match = regex.search(data)
+            if match:
+                yield Hit(KIND_NAMES[self.kinds[doc]], self.source_names[self.sources[doc]],
+                          self.keys[doc], match.start(), data)
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+
+    def save(self):
+        """Write the index to its file if anything was added."""
+        if not self.path or not self.changed:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        names = '\n'.join(self.source_names).encode('utf-8')
+        database = self.database.encode('utf-8')
+        captures = '\n'.join('{}\t{}\t{}\t{}\t{}'.format(path, *state)
+                             for path, state in self.capture_frames.items()).encode('utf-8')
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(INDEX_MAGIC)
+            f.write(struct.pack('<QQQIII', len(self.keys), len(self.corpus), self.last_transaction,
+                                len(database), len(names), len(captures)))
+            f.write(database)
+            f.write(names)
+            f.write(captures)
+            f.write(self.corpus)
+            for arr in (self.offsets, self.kinds, self.sources, self.keys):
+                arr.tofile(f)
+            f.write(struct.pack('<Q', len(self.postings)))
+            for gram, ids in self.postings.items():
+                f.write(gram + struct.pack('<I', len(ids)))
+                ids.tofile(f)
+        os.replace(self.path + '.tmp', self.path)
+        self.changed = False
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                return
+            count, corpus_len, self.last_transaction, database_len, names_len, captures_len = \
+                struct.unpack('<QQQIII', f.read(36))
+            self.database = f.read(database_len).decode('utf-8')
+            self.source_names = f.read(names_len).decode('utf-8').split('\n')
+            captures = f.read(captures_len).decode('utf-8')
+            for line in captures.split('\n') if captures else []:
+                path, frames, size, mtime, fingerprint = line.rsplit('\t', 4)
+                self.capture_frames[path] = (int(frames), int(size), int(mtime), int(fingerprint))
+            self.corpus = bytearray(f.read(corpus_len))
+            self.offsets = array('Q')
+            self.offsets.fromfile(f, count + 1)
+            for arr in (self.kinds, self.sources, self.keys):
+                arr.fromfile(f, count)
+            grams, = struct.unpack('<Q', f.read(8))
+            for _ in range(grams):
+                head = f.read(GRAM + 4)
+                ids = array('I')
+                ids.fromfile(f, struct.unpack('<I', head[GRAM:])[0])
+                self.postings[head[:GRAM]] = ids
+
+
+def format_hit(hit):
+    if hit.kind == 'frame':
+        where = '{} frame {}'.format(hit.source, hit.key)
+    else:
+        where = 'transaction {} {}'.format(hit.key, hit.kind)
+    return '{} at byte {}: {}'.format(where, hit.offset, hit.data.hex())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('pattern', help='hex bytes, ?? for any byte, * for any run of bytes, e.g. "01 03 ?? 00 *0d0a"')
+    parser.add_argument('-d', '--database', metavar='FILE', help='Search transactions recorded in this database. The default is ~/.ctserial/ctserial.sqlite if it exists.')
+    parser.add_argument('-c', '--capture', metavar='FILE', action='append', default=[], help='Also search the frames of a pcapng capture. Use multiple times for more captures.')
+    parser.add_argument('-x', '--index', metavar='FILE', default=DEFAULT_INDEX, help='Where the search index is kept. The default is ~/.ctserial/search.idx.')
+    parser.add_argument('-n', '--limit', type=int, help='Stop after this many hits.')
+    args = parser.parse_args()
+
+    try:
+        parse_pattern(args.pattern)
+    except ValueError as e:
+        parser.error(str(e))
+    index = SearchIndex(args.index)
+    database = args.database
+    if database is None:
+        from .recorder import DEFAULT_DATABASE
+        if os.path.exists(os.path.expanduser(DEFAULT_DATABASE)):
+            database = os.path.expanduser(DEFAULT_DATABASE)
+    if database:
+        from . import model
+        model.bind(database)
+        index.update_from_database(model)
+    for path in args.capture:
+        with CaptureReader(path) as reader:
+            index.update_from_capture(reader)
+    index.save()
+    try:
+        for hit in index.search(args.pattern, args.limit):
+            sys.stdout.write(format_hit(hit) + '\n')
+    except BrokenPipeError:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""Several named serial connections open at the same time."""
+
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from .stats import LinkStats
+
+# transactions kept in each connection's log
+LOG_LENGTH = 1000
+MAX_WORKERS = 16
+
+
+@contextmanager
+def _unclaimed(port):
+    yield port
+
+
+class Connection(object):
+    """
+    One open device: its serial port, background reader, record key,
+    counters and a log of its most recent transactions.
+
+    The lock makes sure only one transaction talks to a device at a time,
+    while transactions on different devices run side by side.
+    """
+    def __init__(self, name, serial_port, reader=None, record_key=None):
+        self.name = name
+        self.serial = serial_port
+        self.reader = reader
+        self.record_key = record_key
+        self.lock = threading.Lock()
+        self.log = deque(maxlen=LOG_LENGTH)
+        self.stats = LinkStats()
+
+    def claim(self):
+        """Context manager yielding the port a transaction should use."""
+        if self.reader:
+            return self.reader.claim()
+        return _unclaimed(self.serial)
+
+    def note(self, timestamp, tx, rx, rtt):
+        """Count a finished transaction and keep it in the log."""
+        self.stats.transaction(tx, rx, rtt)
+        self.log.append((timestamp, tx, rx, rtt))
+
+    def close(self):
+        if self.reader:
+            self.reader.stop()
+            self.reader = None
+        self.serial.close()
+
+    def __str__(self):
+        return '{} {}@{} '.format(self.name, self.serial.port, self.serial.baudrate) + \
+            ' '.join('{}={}'.format(k, v) for k, v in self.stats.counters().items())
+
+
+class SessionManager(object):
+    """Named connections, the one commands use by default and a pool to drive several at once."""
+    def __init__(self):
+        self.connections = OrderedDict()
+        self.current = None
+        self.pool = None
+
+    def __len__(self):
+        return len(self.connections)
+
+    def add(self, connection):
+        """Register a connection and make it the current one."""
+        self.connections[connection.name] = connection
+        self.current = connection
+
+    def get(self, name=None):
+        """Return a connection by name, the current one if name is None."""
+        if name is None:
+            return self.current
+        return self.connections.get(name)
+
+    def unique_name(self, name):
+        base, count = name, 1
+        while name in self.connections:
+            count += 1
+            name = '{}-{}'.format(base, count)
+        return name
+
+    def remove(self, name):
+        """Close and forget a connection, return it."""
+        connection = self.connections.pop(name)
+        connection.close()
+        if self.current is connection:
+            self.current = next(reversed(self.connections.values()), None)
+        return connection
+
+    def resolve(self, names):
+        """
+        Turn a list of names into connections.
+
+        None means the current connection and 'all' every connection.
+        Raises KeyError for an unknown name.
+        """
+        if names is None:
+            return [self.current] if self.current else []
+        if 'all' in names:
+            return list(self.connections.values())
+        return [self.connections[name] for name in names]
+
+    def _pool(self):
+        if self.pool is None:
+            # concurrent.futures pulls in logging, keep it off the startup path
+            from concurrent.futures import ThreadPoolExecutor
+            self.pool = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        return self.pool
+
+    def map(self, func, connections):
+        """Call func(connection) for each connection concurrently, return results in order."""
+        if len(connections) <= 1:
+            return [func(c) for c in connections]
+        return list(self._pool().map(func, connections))
+
+    def submit(self, func):
+        """Call func() on the pool, return its Future at once."""
+        return self._pool().submit(func)
+
+    def close(self):
+        for name in list(self.connections):
+            self.remove(name)
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
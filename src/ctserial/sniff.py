@@ -15,6 +15,10 @@ Control Things Serial, aka ctserial.py
 """
 
 import argparse
+import base64
+import json
+import selectors
+import signal
 import sys
 import time
 import textwrap
@@ -22,11 +26,29 @@ from datetime import datetime as dt
 
 import serial
 
+from . import autobaud
+from .capture import CaptureWriter, monotonic_ns, time_ns
+from .checksum import CHECKSUMS, get_checksum
+from .formatting import hexdump
+from .framing import FRAMER_USAGE, parse_framer
+from .stats import LinkStats
+
 try:
     clock = time.perf_counter
 except AttributeError:
     clock = time.time
 
+# how often ports without a pollable file descriptor (e.g. on Windows) are read
+POLL_INTERVAL = 0.001
+
+OUTPUT_FORMATS = ('hexdump', 'jsonl', 'csv', 'raw')
+PAYLOAD_ENCODINGS = {
+    'hex': lambda frame: frame.hex(),
+    'base64': lambda frame: base64.b64encode(frame).decode('ascii'),
+}
+# stdout buffer of the machine readable formats
+RECORD_BUFFER = 1 << 16
+
 class MultiArg(argparse.Action):
     """
     An action adding the supplied values of multiple
@@ -43,6 +65,14 @@ class MultiArg(argparse.Action):
             parser.set_defaults(**{self.dest:None})
         dest.append(values)
 
+def baudrate_def(string):
+    if string == 'auto':
+        return string
+    try:
+        return int(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError('the specified baudrate is not an integer or auto')
+
 def port_def(string):
     if ':' in string:
         port, _, alias = string.partition(':')
@@ -50,38 +80,229 @@ def port_def(string):
         port, alias = string, None
     if '@' in port:
         port, _, baudrate = port.partition('@')
-        try:
-            baudrate = int(baudrate)
-        except ValueError:
-            raise argparse.ArgumentTypeError('the specified baudrate is not an integer')
+        baudrate = baudrate_def(baudrate)
     else:
         baudrate = None
     return {'port': port, 'alias': alias, 'baudrate': baudrate}
 
-def hex_format(chunk):
-    try:
-        return ' '.join('{:02X}'.format(byte) for byte in chunk)
-    except ValueError:
-        return ' '.join('{:02X}'.format(ord(byte)) for byte in chunk)
+class FrameBuffer(object):
+    """
+    Preallocated bytearray that collects the bytes of one frame.
 
-def ascii_format(chunk):
-    printable = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~'
-    try:
-        chars = [chr(i) for i in chunk]
-        return ''.join([char if char in printable else '.' for char in chars])
-    except TypeError:
-        chars = chunk
-        return ''.join([char if char in printable else '.' for char in chars])
+    Reads are copied into the existing storage, which only grows when a frame
+    is larger than anything seen before, so assembling a frame is O(n).
+    """
+    def __init__(self, size=4096):
+        self.data = bytearray(size)
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def extend(self, chunk):
+        end = self.length + len(chunk)
+        if end > len(self.data):
+            self.data.extend(bytes(max(end, 2 * len(self.data)) - len(self.data)))
+        self.data[self.length:end] = chunk
+        self.length = end
+
+    def view(self):
+        """Return the frame as a memoryview; valid until the next extend()."""
+        return memoryview(self.data)[:self.length]
+
+    def clear(self):
+        self.length = 0
+
+class Sniffer(object):
+    """
+    Watch several serial ports at once and split their traffic into frames.
+
+    Every port is registered with a selector, so the process sleeps until one
+    of them has data or the oldest pending frame reaches the timing delta.
+    Ports without a pollable file descriptor are read every POLL_INTERVAL.
+    Completed frames are handed to on_frame(tty, frame) as a memoryview into
+    the port's FrameBuffer, callbacks must copy it if they keep it around.
+    tty['frame_start'] holds the monotonic_ns() arrival time of its first byte,
+    tty['first_byte'] the same on the clock() of tty['last_byte'].  Reads
+    are counted in tty['stats'] if the port has one.
+
+    A port with a tty['framer'] is split by that protocol framer as bytes
+    arrive instead, the timing delta then only flushes incomplete frames.
+
+    With a tick_interval, on_tick() is called about that often in between.
+    """
+    def __init__(self, ttys, timing_delta, on_frame, on_tick=None, tick_interval=None):
+        self.ttys = ttys
+        self.timing_delta = timing_delta
+        self.on_frame = on_frame
+        self.on_tick = on_tick
+        self.tick_interval = tick_interval
+        self.next_tick = clock() + tick_interval if tick_interval else None
+        self.selector = selectors.DefaultSelector()
+        self.polled = []
+        for tty in ttys:
+            try:
+                self.selector.register(tty['ser'].fileno(), selectors.EVENT_READ, tty)
+            except (AttributeError, ValueError, OSError):
+                self.polled.append(tty)
+
+    def _timeout(self):
+        """Seconds until the next frame timer expires, None if no frame is open."""
+        deadlines = [tty['last_byte'] + self.timing_delta for tty in self.ttys if _pending(tty)]
+        timeout = max(0, min(deadlines) - clock()) if deadlines else None
+        if self.polled:
+            timeout = POLL_INTERVAL if timeout is None else min(timeout, POLL_INTERVAL)
+        if self.next_tick is not None:
+            wait = max(0, self.next_tick - clock())
+            timeout = wait if timeout is None else min(timeout, wait)
+        return timeout
+
+    def poll(self):
+        """Wait for data or an expired frame timer once and handle both."""
+        timeout = self._timeout()
+        if self.selector.get_map():
+            ready = [key.data for key, _ in self.selector.select(timeout)]
+        else:
+            time.sleep(timeout)
+            ready = []
+        for tty in ready + self.polled:
+            ser = tty['ser']
+            new_data = ser.read(ser.in_waiting or 1)
+            if len(new_data) > 0:
+                now = clock()
+                if not _pending(tty):
+                    tty['frame_start'] = monotonic_ns()
+                    tty['first_byte'] = now
+                if 'stats' in tty:
+                    tty['stats'].read(len(new_data))
+                tty['last_byte'] = now
+                framer = tty.get('framer')
+                if framer is None:
+                    tty['buffer'].extend(new_data)
+                else:
+                    for frame in framer.feed(new_data):
+                        self.on_frame(tty, memoryview(frame))
+                        tty['frame_start'] = monotonic_ns()
+                        tty['first_byte'] = now
+        now = clock()
+        for tty in self.ttys:
+            if _pending(tty) and (now - tty['last_byte']) >= self.timing_delta:
+                if tty.get('framer') is not None:
+                    self.on_frame(tty, memoryview(tty['framer'].flush()))
+                    continue
+                with tty['buffer'].view() as frame:
+                    self.on_frame(tty, frame)
+                tty['buffer'].clear()
+        if self.next_tick is not None and now >= self.next_tick:
+            self.next_tick = now + self.tick_interval
+            self.on_tick()
+
+    def run(self):
+        while True:
+            self.poll()
+
+    def close(self):
+        self.selector.close()
+        for tty in self.ttys:
+            tty['ser'].close()
+
+def _pending(tty):
+    """Bytes of an unfinished frame buffered for a port."""
+    framer = tty.get('framer')
+    return len(tty['buffer']) if framer is None else framer.pending
+
+def write_hexdump(out, tty, frame, width, show_ascii, checksum=None, valid=None):
+    """
+    Write one frame as a timestamped hexdump block, noting whether its
+    checksum is valid; valid saves checking it again if already known.
+    """
+    if checksum is None:
+        out.write('{0}: {1}\n'.format(dt.now().isoformat(' '), tty['alias']))
+    else:
+        if valid is None:
+            valid = checksum.verify(frame)
+        out.write('{0}: {1} {2} {3}\n'.format(dt.now().isoformat(' '), tty['alias'], checksum,
+                                              'ok' if valid else 'BAD'))
+    out.write(hexdump(frame, width, show_ascii))
+    out.flush()
+
+class RecordWriter(object):
+    """
+    Write frames as JSON Lines, CSV or raw bytes into a binary stream.
+
+    A jsonl or csv record holds the port alias, the wall clock time of the
+    frame's first byte in seconds, its length, the payload in hex or
+    base64 and, with a checksum, ok or BAD.  raw writes the payloads only.
+    Aliases are escaped once per port, so a record is a single format()
+    call; out should be block buffered and is only flushed by flush().
+    """
+    def __init__(self, out, output_format, payload='hex', checksum=None):
+        self.out = out
+        self.output_format = output_format
+        self.encode = PAYLOAD_ENCODINGS[payload]
+        self.checksum = checksum
+        self.wall_offset = time_ns() - monotonic_ns()
+        self.ports = {}
+        if output_format == 'jsonl':
+            self.template = '{{"port":{0},"ts":{1:.6f},"len":{2},"data":"{3}"{4}}}\n'
+            self.valid = (',"checksum":"BAD"', ',"checksum":"ok"')
+        elif output_format == 'csv':
+            self.template = '{0},{1:.6f},{2},{3}{4}\n'
+            self.valid = (',BAD', ',ok')
+            out.write(b'port,time,length,data' + (b',checksum\n' if checksum else b'\n'))
+
+    def _port(self, alias):
+        if self.output_format == 'jsonl':
+            return json.dumps(alias)
+        if any(c in alias for c in ',"\r\n'):
+            return '"{}"'.format(alias.replace('"', '""'))
+        return alias
+
+    def write(self, tty, frame, valid=None):
+        """Write one frame of tty, valid being the result of checking its checksum."""
+        if self.output_format == 'raw':
+            self.out.write(frame)
+            return
+        alias = tty['alias']
+        port = self.ports.get(alias)
+        if port is None:
+            port = self.ports[alias] = self._port(alias)
+        self.out.write(self.template.format(
+            port, (tty['frame_start'] + self.wall_offset) / 1E9, len(frame), self.encode(frame),
+            '' if valid is None else self.valid[valid]).encode('utf-8'))
+
+    def flush(self):
+        self.out.flush()
+
+def write_stats(out, ttys):
+    """
+    Write the statistics of every port; the rtt of a port is the time from
+    the end of a frame on another port to the start of its next frame.
+    """
+    for tty in ttys:
+        out.write(tty['stats'].format('{0} ({1})'.format(tty['alias'], tty['port'])))
+        framer = tty.get('framer')
+        if framer is not None and framer.errors:
+            out.write('  framer resyncs {0}\n'.format(framer.errors))
+    out.flush()
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
     parser.add_argument('-r', '--read', action='store_true', help='Put the program in read mode. This way you read the data from the given serial device(s) and write it to the file given or stdout if none given. See the read options section for more read specific options.')
     parser.add_argument('-t', '--tty', type=port_def, dest='ttys', action=MultiArg, metavar='NAME@BAUDRATE:ALIAS', help="The serial device to read from. Use multiple times to read from more than one serial device(s). For handy reference you can also separate an alias from the tty name with a collon ':'. If an alias is given it will be used as the name of the serial device.")
     parser.add_argument('-e', '--timing-delta', type=int, metavar='MICROSECONDS', default=100000, help='The timing delta is the amount of microseconds between two bytes that the latter is considered to be part of a new package. The default is 100 miliseconds. Use this option in conjunction with the --timing-print option.')
+    parser.add_argument('-f', '--framer', metavar='FRAMER', help='Split frames with a protocol framer instead of the timing delta, one of: {}. Quote framers with arguments, e.g. -f "delimiter 0d0a". Incomplete frames are still flushed after the timing delta.'.format(FRAMER_USAGE))
+    parser.add_argument('-c', '--checksum', metavar='NAME', help='Check that every frame ends in a valid checksum and mark it ok or BAD, one of: {}.'.format(', '.join(CHECKSUMS)))
     parser.add_argument('-g', '--timing-print', action='store_true', help='Print a line of timing information before every continues stream of bytes. When multiple serial devices are given also print the name or alias of the device where the data is coming from.')
     parser.add_argument('-a', '--ascii', action='store_true', help="Besides the hexadecimal output also display an extra column with the data in the ASCII representation. Non printable characters are displayed as a dot '.'. The ASCII data is displayed after the hexadecimal data.")
-    parser.add_argument('-u', '--baudrate', type=int, default=9600, help='The baudrate to open the serial port at.')
+    parser.add_argument('-u', '--baudrate', type=baudrate_def, default=9600, help="The baudrate to open the serial port at, or 'auto' to use the setting autobaud found for the port before or detect it now.")
     parser.add_argument('-i', '--width', type=int, default=16, help='The number of bytes to display on one line. The default is 16.')
+    parser.add_argument('-w', '--write', metavar='FILE', help='Also stream every frame to FILE in pcapng format, one interface per serial device named after its alias.')
+    parser.add_argument('-s', '--stats', action='store_true', help='Print byte and frame counts, rates, errors, overruns and response time percentiles of every port to stderr on exit, and whenever the process receives SIGUSR1. The response time of a port is the time from the end of a frame on another port to the start of its next frame.')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='hexdump', help='How frames are printed to stdout: hexdump blocks, or one JSON Lines or CSV record per frame with the port alias, the time of its first byte in seconds since the epoch, its length, its payload and with --checksum ok or BAD. raw writes the payloads only. All but hexdump are block buffered, see --flush.')
+    parser.add_argument('--payload', choices=sorted(PAYLOAD_ENCODINGS), default='hex', help='How the payload is encoded in jsonl and csv records. The default is hex.')
+    parser.add_argument('--flush', type=float, metavar='SECONDS', help='Flush jsonl, csv and raw output at least this often instead of only when the buffer is full.')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not print frames to stdout, useful together with --write.')
     parser.add_argument('-v', '--version', action='store_true', help='Output the version information, a small GPL notice and exit.')
     args = parser.parse_args()
 
@@ -93,41 +314,95 @@ def main():
 
     if not args.ttys:
         parser.error('please provide at least one --tty')
+    if args.framer:
+        try:
+            parse_framer(args.framer)
+        except ValueError as e:
+            parser.error('--framer: {}'.format(e))
+    checksum = None
+    if args.checksum:
+        try:
+            checksum = get_checksum(args.checksum)
+        except ValueError as e:
+            parser.error('--checksum: {}'.format(e))
 
     num = 0
     ttys = args.ttys
     for tty in ttys:
         if not tty['baudrate']: tty['baudrate'] = args.baudrate
         if not tty['alias']: tty['alias'] = 'Port' + str(num)
-        tty['buffer'] = b''
-        tty['ser'] = serial.Serial(tty['port'], baudrate=tty['baudrate'], timeout=0)
+        tty['buffer'] = FrameBuffer()
+        tty['stats'] = LinkStats()
+        if args.framer:
+            tty['framer'] = parse_framer(args.framer)
+        if tty['baudrate'] == 'auto':
+            setting = autobaud.cached_setting(tty['port'])
+            if setting is None:
+                results = autobaud.detect(tty['port'])
+                if not results or results[0].score == 0:
+                    parser.error('not enough traffic on {} to detect its baudrate'.format(tty['port']))
+                setting = results[0].setting
+            sys.stderr.write('{0}: {1}\n'.format(tty['port'], autobaud.setting_str(setting)))
+            tty['baudrate'] = setting.baudrate
+            tty['ser'] = serial.Serial(tty['port'], baudrate=setting.baudrate, bytesize=setting.bytesize,
+                                       parity=setting.parity, stopbits=setting.stopbits, timeout=0)
+        else:
+            tty['ser'] = serial.Serial(tty['port'], baudrate=tty['baudrate'], timeout=0)
         tty['last_byte'] = clock()
         num += 1
 
+    writer = None
+    if args.write:
+        writer = CaptureWriter(args.write)
+        for tty in ttys:
+            tty['interface'] = writer.add_interface(
+                tty['alias'], '{0}@{1}'.format(tty['port'], tty['baudrate']))
+
+    records = None
+    if args.format != 'hexdump' and not args.quiet:
+        out = open(sys.stdout.fileno(), 'wb', buffering=RECORD_BUFFER, closefd=False)
+        records = RecordWriter(out, args.format, args.payload, checksum)
+
+    previous = {'tty': None, 'end': 0.0}
+
+    def on_frame(tty, frame):
+        stats = tty['stats']
+        stats.frame(len(frame))
+        # a frame answering one on another port, e.g. the two lines of a link
+        if previous['tty'] not in (None, tty) and tty['first_byte'] >= previous['end']:
+            stats.latency.add(tty['first_byte'] - previous['end'])
+        previous['tty'], previous['end'] = tty, tty['last_byte']
+        valid = None
+        if checksum is not None:
+            valid = checksum.verify(frame)
+            if not valid:
+                stats.errors += 1
+        if writer:
+            writer.write_frame(tty['interface'], frame, tty['frame_start'])
+        if records:
+            records.write(tty, frame, valid)
+        elif not args.quiet:
+            write_hexdump(sys.stdout, tty, frame, args.width, args.ascii, checksum, valid)
+
+    if records and args.flush:
+        sniffer = Sniffer(ttys, args.timing_delta/1E6, on_frame, records.flush, args.flush)
+    else:
+        sniffer = Sniffer(ttys, args.timing_delta/1E6, on_frame)
+    # turn a kill into SystemExit so the capture file is flushed and closed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: write_stats(sys.stderr, ttys))
     try:
-        while True:
-            for tty in ttys:
-                new_data = tty['ser'].read()
-                if len(new_data) > 0:
-                    tty['buffer'] += new_data
-                    tty['last_byte'] = clock()
-            for tty in ttys:
-                if tty['buffer'] and (clock() - tty['last_byte']) > args.timing_delta/1E6:
-                    line = '{0}: {1}\n'.format(dt.now().isoformat(' '), tty['alias'])
-                    sys.stdout.write(line)
-                    while tty['buffer']:
-                        chunk = tty['buffer'][:args.width]
-                        tty['buffer'] = tty['buffer'][args.width:]
-                        fmt = "{{hex:{0}s}}".format(args.width*3)
-                        line = fmt.format(hex=hex_format(chunk))
-                        if args.ascii:
-                            fmt = "{{ascii:{0}s}}".format(args.width)
-                            line += ' ' + fmt.format(ascii=ascii_format(chunk))
-                        line = line.strip()
-                        line += '\n'
-                        sys.stdout.write(line)
-                    sys.stdout.flush()
+        sniffer.run()
     except KeyboardInterrupt:
         sys.exit(1)
+    finally:
+        sniffer.close()
+        if writer:
+            writer.close()
+        if records:
+            records.flush()
+        if args.stats:
+            write_stats(sys.stderr, ttys)
 
 if __name__ == "__main__": main()
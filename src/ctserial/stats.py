@@ -0,0 +1,179 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""
+Link statistics kept in the I/O path.
+
+Counting is a handful of integer additions per read or transaction; the
+latency histogram has a fixed set of log-linear buckets, so recording a
+round trip is one frexp() and one list increment and percentiles never
+need the samples themselves.  Everything that costs more (rates,
+percentiles, the text) is only computed when somebody looks.
+"""
+
+import math
+import struct
+import sys
+import time
+from collections import OrderedDict
+
+# buckets per power of two of microseconds, the percentiles are within 1/SUB_BUCKETS
+SUB_BUCKETS = 8
+# powers of two covered, 2**40 us is about 12 days
+OCTAVES = 40
+PERCENTILES = (50, 90, 99, 99.9)
+# a read that drains this much found the kernel's tty buffer full, so
+# bytes were probably dropped before the tool got to them
+OVERRUN_SIZE = 4095
+COUNTERS = ('tx_frames', 'tx_bytes', 'rx_frames', 'rx_bytes',
+            'timeouts', 'errors', 'overruns', 'unsolicited')
+
+# struct serial_icounter_struct of linux/serial.h
+TIOCGICOUNT = 0x545D
+ICOUNT_FIELDS = ('cts', 'dsr', 'rng', 'dcd', 'rx', 'tx', 'frame', 'overrun',
+                 'parity', 'brk', 'buf_overrun')
+
+
+class Histogram(object):
+    """Log-linear histogram of durations in seconds."""
+    def __init__(self):
+        self.counts = [0] * (OCTAVES * SUB_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        mantissa, exponent = math.frexp(seconds * 1E6)
+        if exponent < 1:
+            index = 0
+        else:
+            index = min((exponent - 1) * SUB_BUCKETS + int((2 * mantissa - 1) * SUB_BUCKETS),
+                        len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    @staticmethod
+    def _upper(index):
+        """Upper bound of a bucket in seconds."""
+        octave, sub = divmod(index + 1, SUB_BUCKETS)
+        return 2 ** octave * (1 + sub / SUB_BUCKETS) / 1E6
+
+    def percentile(self, percent):
+        """Duration percent of the samples are at or below, None without samples."""
+        if not self.count:
+            return None
+        wanted = max(1, math.ceil(self.count * percent / 100.0))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(max(self._upper(index), self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+def _ms(seconds):
+    return '-' if seconds is None else '{:.2f}'.format(1E3 * seconds)
+
+
+class LinkStats(object):
+    """
+    Counters and a latency histogram for one link, a session or a sniffed port.
+
+    Updated from reader threads without a lock: a lost increment under
+    contention is an acceptable price for keeping the I/O path cheap.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        for counter in COUNTERS:
+            setattr(self, counter, 0)
+        self.latency = Histogram()
+        self.started = time.perf_counter()
+
+    def transaction(self, tx, rx, rtt):
+        """Count a request and its response, rx empty for a timeout."""
+        self.tx_frames += 1
+        self.tx_bytes += len(tx)
+        if rx:
+            self.rx_frames += 1
+            self.rx_bytes += len(rx)
+            if rtt is not None:
+                self.latency.add(rtt)
+        else:
+            self.timeouts += 1
+
+    def read(self, size):
+        """Count bytes read from the port in one go, noting reads that found it full."""
+        if size >= OVERRUN_SIZE:
+            self.overruns += 1
+
+    def frame(self, size):
+        """Count a received frame that was not a response, e.g. sniffed or unsolicited."""
+        self.rx_frames += 1
+        self.rx_bytes += size
+
+    def counters(self):
+        return OrderedDict((counter, getattr(self, counter)) for counter in COUNTERS)
+
+    def summary(self):
+        """One short line for the status bar."""
+        text = 'tx {}/{}B rx {}/{}B'.format(self.tx_frames, self.tx_bytes, self.rx_frames, self.rx_bytes)
+        if self.latency.count:
+            text += ' rtt {}/{}ms'.format(_ms(self.latency.percentile(50)), _ms(self.latency.percentile(99)))
+        for counter in ('timeouts', 'errors', 'overruns'):
+            if getattr(self, counter):
+                text += ' {} {}'.format(counter, getattr(self, counter))
+        return text
+
+    def format(self, name):
+        """Every counter, the rates and the latency percentiles as text."""
+        elapsed = max(time.perf_counter() - self.started, 1E-9)
+        lines = ['{}  over {:.1f} s'.format(name, elapsed)]
+        for direction in ('tx', 'rx'):
+            frames, size = getattr(self, direction + '_frames'), getattr(self, direction + '_bytes')
+            lines.append('  {} {:8d} frames {:10d} bytes  {:9.1f} frames/s {:11.1f} B/s'.format(
+                direction, frames, size, frames / elapsed, size / elapsed))
+        lines.append('  timeouts {}  errors {}  overruns {}  unsolicited {}'.format(
+            self.timeouts, self.errors, self.overruns, self.unsolicited))
+        latency = self.latency
+        if latency.count:
+            lines.append('  rtt ms  n {}  min {}  mean {}  {}  max {}'.format(
+                latency.count, _ms(latency.min), _ms(latency.mean),
+                '  '.join('p{:g} {}'.format(p, _ms(latency.percentile(p))) for p in PERCENTILES),
+                _ms(latency.max)))
+        return '\n'.join(lines) + '\n'
+
+
+def driver_counters(port):
+    """
+    Error counters the Linux serial driver keeps for a port (frame, overrun,
+    parity, brk, buf_overrun), or None where they are not available.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import fcntl
+        data = fcntl.ioctl(port.fileno(), TIOCGICOUNT, bytes(80))
+    except (ImportError, AttributeError, ValueError, OSError):
+        return None
+    values = dict(zip(ICOUNT_FIELDS, struct.unpack('11i', data[:44])))
+    return OrderedDict((field, values[field]) for field in ICOUNT_FIELDS[6:])
@@ -0,0 +1,256 @@
+# Copyright (C) 2018  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+
+"""
+Virtual serial devices on ptys.
+
+A VirtualDevice owns the master side of a pty and runs a behavior on it;
+anything that opens the slave path (ctserial itself, sniff, a proxy) sees a
+serial device.  Behaviors get every chunk the device receives and answer
+through send(), optionally after a delay, so echoing, slow, chatty and
+protocol speaking devices are a few lines each.  Used by the benchmarks
+and handy for trying commands without hardware:
+
+    python -m ctserial.virtual modbus
+"""
+
+import argparse
+import heapq
+import os
+import selectors
+import signal
+import struct
+import sys
+import threading
+import time
+import tty as termios_tty
+from array import array
+
+from .checksum import CRC16_MODBUS
+from .framing import ModbusRtuFramer
+
+clock = time.perf_counter
+
+# Modbus RTU frames end after 3.5 characters of silence, this is that at 9600 baud
+MODBUS_GAP = 0.004
+
+
+def open_pty():
+    """Return (master fd, slave fd, slave path) of a new raw pty pair."""
+    master, slave = os.openpty()
+    termios_tty.setraw(master)
+    termios_tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
+
+
+class VirtualDevice(object):
+    """
+    Run a behavior on the master side of a pty, in a thread of its own.
+
+    The slave side is kept open too, so the device survives programs
+    opening and closing self.path.
+    """
+    def __init__(self, behavior):
+        self.master, self.slave, self.path = open_pty()
+        self.behavior = behavior
+        self.timers = []
+        self.sequence = 0
+        self.running = False
+        self.thread = None
+        self.received = 0
+        self.sent = 0
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='ctserial-virtual')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def send(self, data, delay=0.0):
+        """Transmit data now, or after delay seconds without blocking the device."""
+        if delay <= 0:
+            self._write(data)
+            return
+        self.sequence += 1
+        heapq.heappush(self.timers, (clock() + delay, self.sequence, data))
+        os.write(self.wakeup_w, b'.')
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.master, view):]
+        self.sent += len(data)
+
+    def run(self):
+        """Serve until stop(), in the calling thread."""
+        self.running = True
+        selector = selectors.DefaultSelector()
+        selector.register(self.master, selectors.EVENT_READ)
+        selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.behavior.started(self)
+        try:
+            while self.running:
+                timeout = max(0, self.timers[0][0] - clock()) if self.timers else None
+                for key, _ in selector.select(timeout):
+                    if key.fd == self.wakeup_r:
+                        os.read(self.wakeup_r, 4096)
+                        continue
+                    data = os.read(self.master, 65536)
+                    self.received += len(data)
+                    self.behavior.received(self, data)
+                now = clock()
+                while self.timers and self.timers[0][0] <= now:
+                    self._write(heapq.heappop(self.timers)[2])
+        finally:
+            selector.close()
+
+    def stop(self):
+        self.running = False
+        os.write(self.wakeup_w, b'.')
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def close(self):
+        self.stop()
+        for fd in (self.master, self.slave, self.wakeup_r, self.wakeup_w):
+            os.close(fd)
+
+
+class Behavior(object):
+    """Does nothing; subclasses override started() and received()."""
+    def started(self, device):
+        pass
+
+    def received(self, device, data):
+        pass
+
+
+class Echo(Behavior):
+    """Send back everything received, after delay seconds if given."""
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def received(self, device, data):
+        device.send(data, self.delay)
+
+
+class FixedResponse(Behavior):
+    """Answer every chunk with the same bytes after delay seconds."""
+    def __init__(self, response, delay=0.0):
+        self.response = bytes(response)
+        self.delay = delay
+
+    def received(self, device, data):
+        device.send(self.response, self.delay)
+
+
+class BurstStreamer(Behavior):
+    """Stream count copies of frame unprompted, interval seconds apart or back to back."""
+    def __init__(self, frame, count, interval=0.0):
+        self.frame = bytes(frame)
+        self.count = count
+        self.interval = interval
+
+    def started(self, device):
+        if self.interval <= 0:
+            device.send(self.frame * self.count)
+            return
+        for number in range(self.count):
+            device.send(self.frame, self.interval * (number + 1))
+
+
+class ModbusResponder(Behavior):
+    """
+    A Modbus RTU server with one block of registers, served as both holding
+    and input registers: reads (3, 4), single and multiple writes (6, 16),
+    exception 1 for other functions and 2 for addresses out of range.
+    Requests with a bad CRC or for another unit are ignored, and bytes the
+    framer still holds after a gap of silence are dropped, so a malformed
+    request does not swallow the ones after it.
+    """
+    def __init__(self, unit=1, registers=1000, delay=0.0, gap=MODBUS_GAP):
+        self.unit = unit
+        self.registers = array('H', range(registers))
+        self.delay = delay
+        self.gap = gap
+        self.framer = ModbusRtuFramer()
+        self.last_byte = 0.0
+
+    def received(self, device, data):
+        now = clock()
+        if self.framer.pending and now - self.last_byte >= self.gap:
+            self.framer.flush()
+        self.last_byte = now
+        for frame in self.framer.feed(data):
+            if frame[0] != self.unit or not CRC16_MODBUS.verify(frame):
+                continue
+            device.send(CRC16_MODBUS.apply(self.answer(frame[1], frame[2:-2])), self.delay)
+
+    def answer(self, function, body):
+        unit = bytes([self.unit])
+        registers = self.registers
+        if function in (3, 4) and len(body) == 4:
+            start, count = struct.unpack('>HH', body)
+            if not 1 <= count <= 125 or start + count > len(registers):
+                return unit + bytes([function | 0x80, 2])
+            values = registers[start:start + count]
+            return unit + struct.pack('>BB{}H'.format(count), function, 2 * count, *values)
+        if function == 6 and len(body) == 4:
+            start, value = struct.unpack('>HH', body)
+            if start >= len(registers):
+                return unit + bytes([function | 0x80, 2])
+            registers[start] = value
+            return unit + bytes([function]) + body
+        if function == 16 and len(body) >= 5:
+            start, count, size = struct.unpack('>HHB', body[:5])
+            if size != 2 * count or len(body) != 5 + size or start + count > len(registers):
+                return unit + bytes([function | 0x80, 2])
+            registers[start:start + count] = array('H', struct.unpack('>{}H'.format(count), body[5:]))
+            return unit + bytes([function]) + body[:4]
+        return unit + bytes([function | 0x80, 1])
+
+
+def behavior_from_args(args):
+    if args.behavior == 'echo':
+        return Echo(args.delay / 1E3)
+    if args.behavior == 'fixed':
+        return FixedResponse(bytes.fromhex(args.hex), args.delay / 1E3)
+    if args.behavior == 'burst':
+        return BurstStreamer(bytes.fromhex(args.hex), args.count, args.interval / 1E3)
+    return ModbusResponder(args.unit, delay=args.delay / 1E3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('behavior', choices=['echo', 'fixed', 'burst', 'modbus'], help='what the device does')
+    parser.add_argument('hex', nargs='?', default='00', help='response for fixed, frame for burst')
+    parser.add_argument('-d', '--delay', type=float, default=0.0, metavar='MS', help='delay before every answer')
+    parser.add_argument('-n', '--count', type=int, default=1000, help='frames a burst sends')
+    parser.add_argument('-i', '--interval', type=float, default=0.0, metavar='MS', help='time between burst frames, 0 sends them back to back')
+    parser.add_argument('-u', '--unit', type=int, default=1, help='Modbus unit id to answer as')
+    args = parser.parse_args()
+
+    device = VirtualDevice(behavior_from_args(args))
+    print('pty ready at {}'.format(device.path))
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        device.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        device.close()
+
+
+if __name__ == '__main__':
+    main()